@@ -4,40 +4,43 @@
 
 from __future__ import unicode_literals
 import json
+import math
 import frappe
-import requests
 import time
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils.password import get_decrypted_password
-from erpnext_shipping.erpnext_shipping.utils import show_error_alert
+from frappe.utils import flt
+from erpnext_shipping.erpnext_shipping import transport
+from erpnext_shipping.erpnext_shipping.rate_cache import RateQuoteCache
+from erpnext_shipping.erpnext_shipping.utils import (
+    clear_carrier_config,
+    get_carrier_config,
+    show_error_alert,
+)
 
 ARAMEX_PROVIDER = "Aramex"
-CALCULATE_RATE_URL = "https://ws.aramex.net/ShippingAPI.V2/RateCalculator/Service_1_0.svc/json/CalculateRate"
-CREATE_SHIPMENTS_URL = (
-    "https://ws.aramex.net/ShippingAPI.V2/Shipping/Service_1_0.svc/json/CreateShipments"
-)
-PRINT_LABEL_URL = (
-    "https://ws.aramex.net/ShippingAPI.V2/Shipping/Service_1_0.svc/json/PrintLabel"
-)
-TRACK_SHIPMENTS_URL = (
-    "https://ws.aramex.net/ShippingAPI.V2/Tracking/Service_1_0.svc/json/TrackShipments"
-)
+ARAMEX_API_URL = "https://ws.aramex.net/ShippingAPI.V2"
+CALCULATE_RATE_URL = f"{ARAMEX_API_URL}/RateCalculator/Service_1_0.svc/json/CalculateRate"
+CREATE_SHIPMENTS_URL = f"{ARAMEX_API_URL}/Shipping/Service_1_0.svc/json/CreateShipments"
+PRINT_LABEL_URL = f"{ARAMEX_API_URL}/Shipping/Service_1_0.svc/json/PrintLabel"
+TRACK_SHIPMENTS_URL = f"{ARAMEX_API_URL}/Tracking/Service_1_0.svc/json/TrackShipments"
+# AWBs tracked per TrackShipments call
+TRACKING_CHUNK_SIZE = 50
+# Shipments booked per CreateShipments call
+CREATE_SHIPMENTS_CHUNK_SIZE = 50
 
 
 class Aramex(Document):
-    pass
+    def on_update(self):
+        clear_carrier_config(ARAMEX_PROVIDER)
 
 
 class AramexUtils:
     def __init__(self):
-        # self.config.password = get_decrypted_password(
-        #     'Aramex', 'Aramex', 'password', raise_exception=False)
-        self.enabled = frappe.db.get_single_value("Aramex", "enabled")
-        self.config = frappe.db.get_singles_dict("Aramex")
-        self.config["password"] = get_decrypted_password(
-            "Aramex", "Aramex", "password", raise_exception=False
-        )
+        self.config = get_carrier_config(ARAMEX_PROVIDER)
+        self.enabled = self.config["enabled"]
+        # `shipping_aramex_api_url` in site_config.json points the API at a stand-in server
+        self.api_url = frappe.conf.get("shipping_aramex_api_url") or ARAMEX_API_URL
 
         if not self.enabled:
             link = frappe.utils.get_link_to_form(
@@ -58,13 +61,31 @@ class AramexUtils:
         # url = self.get_formatted_request_url(
         #     pickup_address, delivery_address, shipment_parcel_params)
 
-        if not self.config["account_number"] or not self.config["account_pin"]:
+        rate_request = self.get_rate_request(
+            pickup_address, delivery_address, shipment_parcel, pickup_date
+        )
+        if not rate_request:
             return []
 
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
+        rate_cache = RateQuoteCache(ARAMEX_PROVIDER)
+        available_services = rate_cache.get(rate_request.lane)
+        if available_services is not None:
+            return available_services
+
+        try:
+            response = self.request_rates(rate_request.payload)
+            available_services = self.get_services_from_response(response)
+            if available_services:
+                rate_cache.set(rate_request.lane, available_services)
+            return available_services
+        except Exception:
+            show_error_alert("fetching Aramex prices")
+
+        return []
+
+    def get_rate_request(self, pickup_address, delivery_address, shipment_parcel, pickup_date):
+        if not self.config["account_number"] or not self.config["account_pin"]:
+            return None
 
         payload = self.generate_rate_calculation_payload(
             pickup_address=pickup_address,
@@ -72,30 +93,38 @@ class AramexUtils:
             shipment_parcel=shipment_parcel,
             pickup_date=pickup_date,
         )
+        return frappe._dict(lane=self.get_rate_lane(payload), payload=payload)
 
-        try:
-            response_data = requests.post(
-                url=CALCULATE_RATE_URL, headers=headers, data=json.dumps(payload)
-            )
-            response_data = json.loads(response_data.text)
-            if response_data["HasErrors"]:
-                return []
-            available_services = []
-            available_service = {
-                "carrier": "Aramex",
-                # "carrier_name": "Aramex",
-                "service_name": "PPX",
-                "is_preferred": 0,
-                "real_weight": 0,
-                "total_price": response_data["TotalAmount"]["Value"],
-                "price_info": response_data["TotalAmount"],
-            }
-            available_services.append(available_service)
-            return available_services
-        except Exception:
-            show_error_alert("fetching Aramex prices")
+    def request_rates(self, payload):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        return transport.request(
+            "POST",
+            url=self.get_url(CALCULATE_RATE_URL),
+            headers=headers,
+            data=json.dumps(payload),
+            carrier=ARAMEX_PROVIDER,
+            endpoint="calculate_rate",
+        )
 
-        return []
+    def get_services_from_response(self, response):
+        response_data = json.loads(response.text)
+        if response_data["HasErrors"]:
+            return []
+        available_services = []
+        available_service = {
+            "carrier": "Aramex",
+            # "carrier_name": "Aramex",
+            "service_name": "PPX",
+            "is_preferred": 0,
+            "real_weight": 0,
+            "total_price": response_data["TotalAmount"]["Value"],
+            "price_info": response_data["TotalAmount"],
+        }
+        available_services.append(available_service)
+        return available_services
 
     def create_shipment(
         self,
@@ -129,8 +158,16 @@ class AramexUtils:
             delivery_company_name,
         )
         try:
-            response_data = requests.post(
-                url=CREATE_SHIPMENTS_URL, headers=headers, data=json.dumps(payload)
+            response_data = transport.request_with_retry(
+                lambda: transport.request(
+                    "POST",
+                    url=self.get_url(CREATE_SHIPMENTS_URL),
+                    headers=headers,
+                    data=json.dumps(payload),
+                    carrier=ARAMEX_PROVIDER,
+                    endpoint="create_shipments",
+                ),
+                idempotent=False,
             )
 
             response_data = json.loads(response_data.text)
@@ -139,28 +176,92 @@ class AramexUtils:
                 return {}
             shipmet = response_data["Shipments"][0]
 
-            return {
-                "shipment_id": shipmet["ID"],
-                "carrier": "Aramex",
-                "carrier_service": shipmet["ShipmentDetails"]["ProductType"],
-                "shipment_label": shipmet["ShipmentLabel"]["LabelURL"],
-                "awb_number": shipmet["ID"],
-                "tracking_url": f'https://www.aramex.com/us/en/track/results?mode=0&ShipmentNumber={shipmet["ID"]}',
-            }
+            return self.get_shipment_info(shipmet)
         except Exception:
             show_error_alert("creating Aramex Shipment")
 
-    def get_label(self, awb_number):
-        # Retrieve shipment label from Aramex
+    def create_shipments(self, shipments):
+        """Books `shipments` with one CreateShipments call per chunk.
+
+        Each item holds a unique `reference` and the arguments of `generate_shipment_entry`.
+        Returns a dict by reference with the shipment info of every booked shipment or
+        an `error` message for the ones Aramex rejected.
+        """
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        payload = self.generate_shipment_label_payload(awb_number)
-        try:
-            shipment_label_response = requests.post(
-                url=PRINT_LABEL_URL, headers=headers, data=json.dumps(payload)
+        results = {}
+        for start in range(0, len(shipments), CREATE_SHIPMENTS_CHUNK_SIZE):
+            chunk = shipments[start : start + CREATE_SHIPMENTS_CHUNK_SIZE]
+            payload = {
+                "ClientInfo": self.get_client_info(),
+                "LabelInfo": {"ReportID": 9729, "ReportType": "URL"},
+                "Shipments": [self.generate_shipment_entry(**shipment) for shipment in chunk],
+            }
+            references = [shipment["reference"] for shipment in chunk]
+            try:
+                response = transport.request_with_retry(
+                    lambda: transport.request(
+                        "POST",
+                        url=self.get_url(CREATE_SHIPMENTS_URL),
+                        headers=headers,
+                        data=json.dumps(payload),
+                        carrier=ARAMEX_PROVIDER,
+                        endpoint="create_shipments",
+                    ),
+                    idempotent=False,
+                )
+                response_data = json.loads(response.text)
+            except Exception as e:
+                if not isinstance(e, transport.CarrierUnavailable):
+                    frappe.log_error(frappe.get_traceback(), _("Aramex bulk booking failed"))
+                for reference in references:
+                    results[reference] = {"error": _("Could not reach Aramex")}
+                continue
+
+            results.update(self.get_shipment_results(references, response_data))
+        return results
+
+    def get_shipment_results(self, references, response_data):
+        # Processed shipments echo Reference1, fall back on the position in the request
+        results = {}
+        for idx, processed in enumerate(response_data.get("Shipments") or []):
+            reference = processed.get("Reference1") or (
+                references[idx] if idx < len(references) else None
             )
+            if reference not in references:
+                continue
+            if processed.get("HasErrors"):
+                results[reference] = {"error": self.get_notifications(processed)}
+            else:
+                results[reference] = self.get_shipment_info(processed)
+
+        error = self.get_notifications(response_data) or _("Not processed by Aramex")
+        for reference in references:
+            results.setdefault(reference, {"error": error})
+        return results
+
+    def get_notifications(self, response_data):
+        return ", ".join(
+            notification.get("Message") or notification.get("Code") or ""
+            for notification in response_data.get("Notifications") or []
+        )
+
+    def get_shipment_info(self, processed_shipment):
+        return {
+            "shipment_id": processed_shipment["ID"],
+            "carrier": "Aramex",
+            "carrier_service": processed_shipment["ShipmentDetails"]["ProductType"],
+            "shipment_label": processed_shipment["ShipmentLabel"]["LabelURL"],
+            "awb_number": processed_shipment["ID"],
+            "tracking_url": f'https://www.aramex.com/us/en/track/results?mode=0&ShipmentNumber={processed_shipment["ID"]}',
+        }
+
+    def get_label(self, awb_number):
+        # Retrieve shipment label from Aramex
+        try:
+            shipment_label_response = self.request_label(awb_number)
             shipment_label = json.loads(shipment_label_response.text)
             if shipment_label["HasErrors"]:
                 message = _(
@@ -174,30 +275,39 @@ class AramexUtils:
             show_error_alert("printing Aramex Label")
         return []
 
-    def get_tracking_data(self, awb_number):
-        # Get Aramex Tracking Info
-        from erpnext_shipping.erpnext_shipping.utils import get_tracking_url
-
+    def request_label(self, awb_number):
         headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        payload = self.generate_tracking_payload(awb_number)
+        payload = self.generate_shipment_label_payload(awb_number)
+        return transport.request_with_retry(
+            lambda: transport.request(
+                "POST",
+                url=self.get_url(PRINT_LABEL_URL),
+                headers=headers,
+                data=json.dumps(payload),
+                carrier=ARAMEX_PROVIDER,
+                endpoint="print_label",
+            ),
+        )
+
+    def get_label_urls(self, response):
+        shipment_label = json.loads(response.text)
+        if shipment_label["HasErrors"]:
+            raise frappe.ValidationError(self.get_notifications(shipment_label))
+        return [shipment_label["ShipmentLabel"]["LabelURL"]]
+
+    def get_tracking_data(self, awb_number):
+        # Get Aramex Tracking Info
+        from erpnext_shipping.erpnext_shipping.utils import get_tracking_url
+
         try:
-            tracking_data_response = requests.post(
-                url=TRACK_SHIPMENTS_URL, headers=headers, data=json.dumps(payload)
-            )
-            tracking_data = json.loads(tracking_data_response.text)
+            tracking_data = self.request_tracking_data([awb_number])
             if tracking_data["HasErrors"]:
                 return {}
             trackingResult = tracking_data["TrackingResults"][0]
-            return {
-                "tracking_status": trackingResult["Value"][0]["UpdateDescription"]
-                if len(trackingResult["Value"])
-                else "",
-                # 'tracking_status_info': tracking_data['state'],
-                "tracking_url": f"https://www.aramex.com/us/en/track/results?mode=0&ShipmentNumber={awb_number}",
-            }
+            return self.get_tracking_info(awb_number, trackingResult)
 
             # if 'trackings' in tracking_data:
             #     tracking_status = 'In Progress'
@@ -216,6 +326,33 @@ class AramexUtils:
             show_error_alert("updating Aramex Shipment")
         return []
 
+    def request_tracking_data(self, awb_numbers):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        payload = self.generate_tracking_payload(awb_numbers)
+        tracking_data_response = transport.request_with_retry(
+            lambda: transport.request(
+                "POST",
+                url=self.get_url(TRACK_SHIPMENTS_URL),
+                headers=headers,
+                data=json.dumps(payload),
+                carrier=ARAMEX_PROVIDER,
+                endpoint="track_shipments",
+            ),
+        )
+        return json.loads(tracking_data_response.text)
+
+    def get_tracking_info(self, awb_number, tracking_result):
+        latest_update = tracking_result["Value"][0] if len(tracking_result["Value"]) else {}
+        return {
+            "tracking_status": latest_update.get("UpdateDescription") or "",
+            "event_time": latest_update.get("UpdateDateTime"),
+            # 'tracking_status_info': tracking_data['state'],
+            "tracking_url": f"https://www.aramex.com/us/en/track/results?mode=0&ShipmentNumber={awb_number}",
+        }
+
     def get_formatted_request_url(
         self, pickup_address, delivery_address, shipment_parcel_params
     ):
@@ -352,6 +489,20 @@ class AramexUtils:
         }
         return payload
 
+    def get_rate_lane(self, payload):
+        # Requests with the same lane signature are quoted the same price
+        origin = payload["OriginAddress"]
+        destination = payload["DestinationAddress"]
+        details = payload["ShipmentDetails"]
+        return {
+            "origin": [origin["PostCode"], origin["CountryCode"]],
+            "destination": [destination["PostCode"], destination["CountryCode"]],
+            # Weights are rounded up to the next half kilogram
+            "weight": math.ceil(flt(details["ActualWeight"]["Value"]) * 2) / 2,
+            "pieces": details["NumberOfPieces"],
+            "product_type": [details["ProductGroup"], details["ProductType"]],
+        }
+
     def generate_create_shipment_payload(
         self,
         pickup_address,
@@ -365,136 +516,166 @@ class AramexUtils:
         value_of_goods,
         delivery_company_name,
     ):
-        shipment_parcel = json.loads(shipment_parcel)
         payload = {
             "ClientInfo": self.get_client_info(),
             "LabelInfo": {"ReportID": 9729, "ReportType": "URL"},
             "Shipments": [
-                {
-                    "Shipper": {
-                        "AccountNumber": self.config["account_number"],
-                        "PartyAddress": {
-                            "Line1": pickup_address["address_line1"],
-                            "Line2": pickup_address["address_line2"] or "",
-                            "Line3": "",
-                            "City": pickup_address["city"],
-                            "StateOrProvinceCode": "",
-                            "PostCode": pickup_address["pincode"],
-                            "CountryCode": pickup_address["country_code"],
-                        },
-                        "Contact": {
-                            "Department": "",
-                            "PersonName": f"{pickup_contact['first_name']} {pickup_contact['last_name']}",
-                            "Title": "",
-                            "CompanyName": pickup_contact["company_name"] or "",
-                            "PhoneNumber1": pickup_contact["phone"],
-                            "PhoneNumber1Ext": "",
-                            "PhoneNumber2": "",
-                            "PhoneNumber2Ext": "",
-                            "CellPhone": pickup_contact["phone"],
-                            "EmailAddress": pickup_contact["email"],
-                            "Type": "",
-                        },
+                self.generate_shipment_entry(
+                    pickup_address,
+                    pickup_contact,
+                    delivery_address,
+                    delivery_contact,
+                    pickup_date,
+                    pickup_time,
+                    shipment_parcel,
+                    description_of_content,
+                    value_of_goods,
+                    delivery_company_name,
+                )
+            ],
+        }
+        return payload
+
+    def generate_shipment_entry(
+        self,
+        pickup_address,
+        pickup_contact,
+        delivery_address,
+        delivery_contact,
+        pickup_date,
+        pickup_time,
+        shipment_parcel,
+        description_of_content,
+        value_of_goods,
+        delivery_company_name,
+        reference=None,
+    ):
+        # A single entry of the "Shipments" list of a CreateShipments payload,
+        # `reference` is echoed back by Aramex to match results to their source
+        shipment_parcel = json.loads(shipment_parcel)
+        return {
+            "Reference1": reference or "",
+            "Shipper": {
+                "AccountNumber": self.config["account_number"],
+                "PartyAddress": {
+                    "Line1": pickup_address["address_line1"],
+                    "Line2": pickup_address["address_line2"] or "",
+                    "Line3": "",
+                    "City": pickup_address["city"],
+                    "StateOrProvinceCode": "",
+                    "PostCode": pickup_address["pincode"],
+                    "CountryCode": pickup_address["country_code"],
+                },
+                "Contact": {
+                    "Department": "",
+                    "PersonName": f"{pickup_contact['first_name']} {pickup_contact['last_name']}",
+                    "Title": "",
+                    "CompanyName": pickup_contact["company_name"] or "",
+                    "PhoneNumber1": pickup_contact["phone"],
+                    "PhoneNumber1Ext": "",
+                    "PhoneNumber2": "",
+                    "PhoneNumber2Ext": "",
+                    "CellPhone": pickup_contact["phone"],
+                    "EmailAddress": pickup_contact["email"],
+                    "Type": "",
+                },
+            },
+            "Consignee": {
+                "AccountNumber": self.config["account_number"],
+                "PartyAddress": {
+                    "Line1": delivery_address["address_line1"],
+                    "Line2": delivery_address["address_line2"] or "",
+                    "Line3": "",
+                    "City": delivery_address["city"],
+                    "StateOrProvinceCode": "",
+                    "PostCode": delivery_address["pincode"],
+                    "CountryCode": delivery_address["country_code"],
+                },
+                "Contact": {
+                    "Department": "",
+                    "PersonName": f"{delivery_contact['first_name']} {delivery_contact['last_name']}",
+                    "Title": "",
+                    "CompanyName": delivery_company_name,
+                    "PhoneNumber1": delivery_contact["phone"],
+                    "PhoneNumber1Ext": "",
+                    "PhoneNumber2": "",
+                    "PhoneNumber2Ext": "",
+                    "CellPhone": delivery_contact["phone"],
+                    "EmailAddress": delivery_contact["email_id"],
+                    "Type": "",
+                },
+            },
+            "ShippingDateTime": self.getShippingDate(
+                f"{pickup_date} {pickup_time}"
+            ),
+            "Details": {
+                "Dimensions": {
+                    "Length": shipment_parcel[0]["length"],
+                    "Width": shipment_parcel[0]["width"],
+                    "Height": shipment_parcel[0]["height"],
+                    "Unit": "CM",
+                },
+                "ActualWeight": {
+                    "Unit": "KG",
+                    "Value": shipment_parcel[0]["weight"],
+                },
+                "ChargeableWeight": None,
+                "DescriptionOfGoods": description_of_content,
+                "GoodsOriginCountry": "IN",
+                "NumberOfPieces": shipment_parcel[0]["count"],
+                "ProductGroup": "EXP",
+                "ProductType": "PPX",
+                "PaymentType": "P",
+                "PaymentOptions": "",
+                "CustomsValueAmount": {
+                    "CurrencyCode": "INR",
+                    "Value": value_of_goods,
+                },
+                "InsuranceAmount": None,
+                "AdditionalProperties": [
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "ShipperTaxIdVATEINNumber",
+                        "Value": "123456789101",
                     },
-                    "Consignee": {
-                        "AccountNumber": self.config["account_number"],
-                        "PartyAddress": {
-                            "Line1": delivery_address["address_line1"],
-                            "Line2": delivery_address["address_line2"] or "",
-                            "Line3": "",
-                            "City": delivery_address["city"],
-                            "StateOrProvinceCode": "",
-                            "PostCode": delivery_address["pincode"],
-                            "CountryCode": delivery_address["country_code"],
-                        },
-                        "Contact": {
-                            "Department": "",
-                            "PersonName": f"{delivery_contact['first_name']} {delivery_contact['last_name']}",
-                            "Title": "",
-                            "CompanyName": delivery_company_name,
-                            "PhoneNumber1": delivery_contact["phone"],
-                            "PhoneNumber1Ext": "",
-                            "PhoneNumber2": "",
-                            "PhoneNumber2Ext": "",
-                            "CellPhone": delivery_contact["phone"],
-                            "EmailAddress": delivery_contact["email_id"],
-                            "Type": "",
-                        },
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "ConsigneeTaxIdVATEINNumber",
+                        "Value": "987654321012",
                     },
-                    "ShippingDateTime": self.getShippingDate(
-                        f"{pickup_date} {pickup_time}"
-                    ),
-                    "Details": {
-                        "Dimensions": {
-                            "Length": shipment_parcel[0]["length"],
-                            "Width": shipment_parcel[0]["width"],
-                            "Height": shipment_parcel[0]["height"],
-                            "Unit": "CM",
-                        },
-                        "ActualWeight": {
-                            "Unit": "KG",
-                            "Value": shipment_parcel[0]["weight"],
-                        },
-                        "ChargeableWeight": None,
-                        "DescriptionOfGoods": description_of_content,
-                        "GoodsOriginCountry": "IN",
-                        "NumberOfPieces": shipment_parcel[0]["count"],
-                        "ProductGroup": "EXP",
-                        "ProductType": "PPX",
-                        "PaymentType": "P",
-                        "PaymentOptions": "",
-                        "CustomsValueAmount": {
-                            "CurrencyCode": "INR",
-                            "Value": value_of_goods,
-                        },
-                        "InsuranceAmount": None,
-                        "AdditionalProperties": [
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "ShipperTaxIdVATEINNumber",
-                                "Value": "123456789101",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "ConsigneeTaxIdVATEINNumber",
-                                "Value": "987654321012",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "TaxPaid",
-                                "Value": "1",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "InvoiceDate",
-                                "Value": "08/17/2020",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "InvoiceNumber",
-                                "Value": "Inv123456",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "TaxAmount",
-                                "Value": "120.52",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "IOSS",
-                                "Value": "IM1098494352",
-                            },
-                            {
-                                "CategoryName": "CustomsClearance",
-                                "Name": "ExporterType",
-                                "Value": "UT",
-                            },
-                        ],
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "TaxPaid",
+                        "Value": "1",
                     },
-                }
-            ],
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "InvoiceDate",
+                        "Value": "08/17/2020",
+                    },
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "InvoiceNumber",
+                        "Value": "Inv123456",
+                    },
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "TaxAmount",
+                        "Value": "120.52",
+                    },
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "IOSS",
+                        "Value": "IM1098494352",
+                    },
+                    {
+                        "CategoryName": "CustomsClearance",
+                        "Name": "ExporterType",
+                        "Value": "UT",
+                    },
+                ],
+            },
         }
-        return payload
 
     def generate_shipment_label_payload(self, awb_number):
         payload = {
@@ -504,11 +685,13 @@ class AramexUtils:
         }
         return payload
 
-    def generate_tracking_payload(self, awb_number):
+    def generate_tracking_payload(self, awb_numbers):
+        if isinstance(awb_numbers, str):
+            awb_numbers = [awb_numbers]
         payload = {
             "ClientInfo": self.get_client_info(),
             "GetLastTrackingUpdateOnly": True,
-            "Shipments": [awb_number],
+            "Shipments": list(awb_numbers),
         }
         return payload
 
@@ -517,6 +700,9 @@ class AramexUtils:
         epoch = int(time.mktime(time.strptime(shippingDate, pattern))) * 1000
         return r"/Date(" + epoch.__str__() + ")/"
 
+    def get_url(self, url):
+        return self.api_url.rstrip("/") + url[len(ARAMEX_API_URL) :]
+
     def get_client_info(self):
         return {
             "UserName": self.config["user_name"],
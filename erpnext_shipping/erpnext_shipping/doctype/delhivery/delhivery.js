@@ -2,7 +2,34 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('Delhivery', {
-	// refresh: function(frm) {
+	refresh: function(frm) {
+		frappe.call({
+			method: 'erpnext_shipping.erpnext_shipping.transport.get_circuit_breaker_state',
+			args: {carrier: 'Delhivery'},
+			callback: function(r) {
+				if (!r.message) return;
+				const state = r.message;
+				const colors = {'Closed': 'green', 'Open': 'red', 'Half Open': 'orange'};
+				const breaker = __('Circuit Breaker: {0}. {1} of {2} calls failed in the current window.', [
+					__(state.state).bold(), state.failures, state.calls
+				]);
+				frm.dashboard.set_headline_alert(breaker, colors[state.state]);
 
-	// }
+				frappe.call({
+					method: 'erpnext_shipping.erpnext_shipping.rate_cache.get_rate_cache_stats',
+					args: {carrier: 'Delhivery'},
+					callback: function(r) {
+						if (!r.message) return;
+						const stats = r.message;
+						frm.dashboard.set_headline_alert(
+							breaker + ' ' + __('Rate Cache: {0} hits, {1} misses ({2}% hit ratio), {3} lanes cached.', [
+								stats.hits, stats.misses, (stats.hit_ratio * 100).toFixed(1), stats.entries
+							]),
+							colors[state.state]
+						);
+					}
+				});
+			}
+		});
+	}
 });
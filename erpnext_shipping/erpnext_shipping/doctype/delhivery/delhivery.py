@@ -2,30 +2,64 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
+import base64
 import json
+import math
 import frappe
-import requests
 import zeep
 import time
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils.password import get_decrypted_password
-from erpnext_shipping.erpnext_shipping.utils import show_error_alert
+from frappe.utils import flt
+from erpnext_shipping.erpnext_shipping import transport
+from erpnext_shipping.erpnext_shipping.rate_cache import RateQuoteCache
+from erpnext_shipping.erpnext_shipping.utils import (
+    clear_carrier_config,
+    get_carrier_config,
+    show_error_alert,
+)
 
 DELHIVERY_PROVIDER = "Delhivery"
+DELHIVERY_TRACKING_STATUS_MAP = {
+    "MANIFESTED": "PICKUP_REQUESTED",
+    "PICKED_UP": "SHIPPED",
+    "LEFT_ORIGIN": "SHIPPED",
+    "REACH_DESTINATION": "SHIPPED",
+    "UNDEL_REATTEMPT": "OUT_FOR_DELIVERY",
+    "PART_DEL": "SHIPPED",
+    "OFD": "OUT_FOR_DELIVERY",
+    "DELIVERED": "DELIVERED",
+}
+MANIFESTING_STATUS = "MANIFESTING"
+MANIFEST_FAILED_STATUS = "MANIFEST_FAILED"
+MANIFEST_JOBS_CACHE_KEY = "delhivery_manifest_jobs"
+# Seconds between checks of a pending job, doubled on every attempt up to the max
+MANIFEST_POLL_MIN_DELAY = 2
+MANIFEST_POLL_MAX_DELAY = 60
+# Seconds after booking before a job that never completed is marked as failed
+MANIFEST_POLL_DEADLINE = 30 * 60
+# Seconds a single poller run keeps waiting on pending jobs
+MANIFEST_POLL_RUN_TIME = 50
+# Seconds a single check of a job may take including retries
+MANIFEST_CHECK_DEADLINE = 10
+TOKEN_CACHE_KEY = "delhivery_token"
+# Seconds before expiry at which the token is renewed
+TOKEN_REFRESH_MARGIN = 300
+# Seconds a worker waits for another worker renewing the token
+TOKEN_LOCK_TIMEOUT = 30
+# Seconds a token without an `exp` claim is kept
+TOKEN_DEFAULT_TTL = 12 * 60 * 60
 
 
 class Delhivery(Document):
-    pass
+    def on_update(self):
+        clear_carrier_config(DELHIVERY_PROVIDER)
 
 
 class DelhiveryUtils:
     def __init__(self):
-        self.enabled = frappe.db.get_single_value("Delhivery", "enabled")
-        self.config = frappe.db.get_singles_dict("Delhivery")
-        self.config["password"] = get_decrypted_password(
-            "Delhivery", "Delhivery", "password", raise_exception=False
-        )
+        self.config = get_carrier_config(DELHIVERY_PROVIDER)
+        self.enabled = self.config["enabled"]
 
         if not self.enabled:
             link = frappe.utils.get_link_to_form(
@@ -36,6 +70,112 @@ class DelhiveryUtils:
                 title=_("Mandatory"),
             )
 
+        # Fetched on first use, building requests or parsing responses needs none
+        self._token = None
+
+    @property
+    def token(self):
+        self.authenticate()
+        return self._token
+
+    @token.setter
+    def token(self, token):
+        self._token = token
+
+    def authenticate(self, deadline=None):
+        # Worker threads can't read the shared token, call this before handing them the
+        # utils. A login it needs takes at most `deadline` seconds.
+        if not getattr(self, "_token", None):
+            self._token = get_token(self.config, deadline=deadline)
+
+    def get_available_services(
+        self, pickup_address, delivery_address, shipment_parcel, pickup_date
+    ):
+        # Retrieve the freight estimate at Delhivery for the given parcels
+        rate_request = self.get_rate_request(
+            pickup_address, delivery_address, shipment_parcel, pickup_date
+        )
+        if not rate_request:
+            return []
+
+        rate_cache = RateQuoteCache(DELHIVERY_PROVIDER)
+        available_services = rate_cache.get(rate_request.lane)
+        if available_services is not None:
+            return available_services
+
+        try:
+            response = self.request_rates(rate_request.payload)
+            available_services = self.get_services_from_response(response)
+            if available_services:
+                rate_cache.set(rate_request.lane, available_services)
+            return available_services
+        except Exception:
+            show_error_alert("fetching Delhivery prices")
+
+        return []
+
+    def get_rate_request(self, pickup_address, delivery_address, shipment_parcel, pickup_date):
+        if not self.config.get("rate_calculation_url"):
+            return None
+
+        shipment_parcel = json.loads(shipment_parcel)
+        payload = {
+            "source_pin": pickup_address["pincode"],
+            "consignee_pin": delivery_address["pincode"],
+            "payment_mode": "prepaid",
+            "weight_g": sum(
+                flt(parcel["weight"]) * (parcel.get("count") or 1) for parcel in shipment_parcel
+            )
+            * 1000,
+            "dimensions": [
+                {
+                    "length_cm": parcel["length"],
+                    "width_cm": parcel["width"],
+                    "height_cm": parcel["height"],
+                    "box_count": parcel.get("count") or 1,
+                }
+                for parcel in shipment_parcel
+            ],
+        }
+        lane = {
+            "origin": payload["source_pin"],
+            "destination": payload["consignee_pin"],
+            # Weights are rounded up to the next half kilogram
+            "weight": math.ceil(payload["weight_g"] / 500) / 2,
+            "pieces": sum(parcel.get("count") or 1 for parcel in shipment_parcel),
+        }
+        return frappe._dict(lane=lane, payload=payload)
+
+    def request_rates(self, payload):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.token}",
+        }
+        return transport.request(
+            "POST",
+            url=self.config["rate_calculation_url"],
+            headers=headers,
+            data=json.dumps(payload),
+            carrier=DELHIVERY_PROVIDER,
+            endpoint="freight_estimate",
+        )
+
+    def get_services_from_response(self, response):
+        response.raise_for_status()
+        response_data = json.loads(response.text)
+        estimate = response_data["data"]
+        return [
+            {
+                "carrier": "Delhivery",
+                "service_name": "",
+                "is_preferred": 0,
+                "real_weight": 0,
+                "total_price": estimate["total"],
+                "price_info": estimate,
+            }
+        ]
+
     def create_shipment(
         self,
         pickup_address,
@@ -55,112 +195,85 @@ class DelhiveryUtils:
             value_of_goods,
             delivery_company_name,
         )
-        count = 0
-
-        create_shipment_url = self.config["create_shipment_url"]
-
-        while count < 3:
-            try:
-                headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.config['token']}",
-                }
-                response = requests.post(
-                    url=create_shipment_url,
-                    headers=headers,
-                    data=json.dumps(payload),
-                )
-                if response.status_code == 200:
-                    break
-                if response.status_code == 401:
-                    self.generate_token()
-                    count += 1
-                    continue
-            except Exception as e:
-                frappe.throw(e)
-
+        response = self.send(lambda: self.request_create_shipment(payload), idempotent=False)
         response_data = json.loads(response.text)
-        time.sleep(2)
-
-        shipment = self.get_shipment(response_data["job_id"])
-
-        shipment_value = shipment["status"]["value"]
 
+        # Manifesting runs as a job at Delhivery, the LR Number and master waybill
+        # are filled in by poll_manifest_jobs once it completes.
         return {
-            "shipment_id": shipment_value["lrnum"],
+            "shipment_id": "",
             "carrier": "Delhivery",
             "carrier_service": "",
             "shipment_label": "",
-            "awb_number": shipment_value["master_waybill"],
+            "awb_number": "",
+            "job_id": response_data["job_id"],
+            "tracking_status": MANIFESTING_STATUS,
         }
 
+    def request_create_shipment(self, payload):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.token}",
+        }
+        return transport.request(
+            "POST",
+            url=self.config["create_shipment_url"],
+            headers=headers,
+            data=json.dumps(payload),
+            carrier=DELHIVERY_PROVIDER,
+            endpoint="create",
+        )
+
     def get_label(self, awb_number):
         # Retrieve shipment label from Delhivery
-        count = 0
+        response = self.send(lambda: self.request_label(awb_number))
+        return self.get_label_urls(response)
+
+    def request_label(self, awb_number):
         print_label_url = self.config["print_label_url"]
-        while count < 3:
-            try:
-                headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.config['token']}",
-                }
-                response = requests.get(
-                    url=f"{print_label_url}/{awb_number}?document=true", headers=headers
-                )
-                if response.status_code == 200:
-                    break
-                elif response.status_code == 401:
-                    self.generate_token()
-                    count += 1
-                    continue
-                else:
-                    response.raise_for_status()
-            except Exception as e:
-                frappe.throw(e)
-        shipment_label = json.loads(response.text)
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.token}",
+        }
+        return transport.request(
+            "GET",
+            url=f"{print_label_url}/{awb_number}?document=true",
+            headers=headers,
+            carrier=DELHIVERY_PROVIDER,
+            endpoint="label",
+        )
 
+    def get_label_urls(self, response):
+        shipment_label = json.loads(response.text)
         return shipment_label["data"]
 
     def get_tracking_data(self, awb_number, lrnum):
-        count = 0
+        response = self.send(lambda: self.request_tracking_data(lrnum))
+        tracking_data = json.loads(response.text)
+        return self.get_tracking_info(awb_number, tracking_data)
+
+    def request_tracking_data(self, lrnum):
         track_shipment_url = self.config["track_shipment_url"]
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.token}",
+        }
+        return transport.request(
+            "GET",
+            url=f"{track_shipment_url}/{lrnum}",
+            headers=headers,
+            carrier=DELHIVERY_PROVIDER,
+            endpoint="track",
+        )
+
+    def get_tracking_info(self, awb_number, tracking_data):
         tracking_page_url = self.config["tracking_page_url"]
-        while count < 3:
-            try:
-                headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.config['token']}",
-                }
-                response = requests.get(
-                    url=f"{track_shipment_url}/{lrnum}", headers=headers
-                )
-                if response.status_code == 200:
-                    break
-                elif response.status_code == 401:
-                    self.generate_token()
-                    count += 1
-                    continue
-                else:
-                    response.raise_for_status()
-            except Exception as e:
-                frappe.throw(e)
-        tracking_data = json.loads(response.text)
         status = tracking_data["data"]["status"]
-        delhivery_tracking_status_map = {
-            "MANIFESTED": "PICKUP_REQUESTED",
-            "PICKED_UP": "SHIPPED",
-            "LEFT_ORIGIN": "SHIPPED",
-            "REACH_DESTINATION": "SHIPPED",
-            "UNDEL_REATTEMPT": "OUT_FOR_DELIVERY",
-            "PART_DEL": "SHIPPED",
-            "OFD": "OUT_FOR_DELIVERY",
-            "DELIVERED": "DELIVERED",
-        }
         return {
-            "tracking_status": delhivery_tracking_status_map.get(status),
+            "tracking_status": DELHIVERY_TRACKING_STATUS_MAP.get(status),
             "tracking_url": f"{tracking_page_url}/{awb_number}",
         }
 
@@ -207,55 +320,244 @@ class DelhiveryUtils:
         return payload
 
     def get_shipment(self, job_id):
-        count = 0
-        get_shipment_url = self.config["get_shipment_url"]
-        while count < 3:
-            try:
-                headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.config['token']}",
-                }
-                response = requests.get(
-                    url=f"{get_shipment_url}?job_id={job_id}", headers=headers
-                )
-                if response.status_code == 200:
-                    response_data = json.loads(response.text)
-                    if not response_data["status"]["type"] == "Complete":
-                        time.sleep(1)
-                        continue
-                    else:
-                        break
-                if response.status_code == 401:
-                    self.generate_token()
-                    count += 1
-                    continue
-                else:
-                    response.raise_for_status()
-            except Exception as e:
-                frappe.throw(e)
-
-        return response_data
+        # Returns the manifest job, its status type is "Complete" once the LR Number is assigned
+        response = self.send(
+            lambda: self.request_shipment(job_id), deadline=MANIFEST_CHECK_DEADLINE
+        )
+        return json.loads(response.text)
+
+    def request_shipment(self, job_id):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.token}",
+        }
+        return transport.request(
+            "GET",
+            url=f"{self.config['get_shipment_url']}?job_id={job_id}",
+            headers=headers,
+            carrier=DELHIVERY_PROVIDER,
+            endpoint="get_shipment",
+        )
+
+    def send(self, request, idempotent=True, deadline=None):
+        # Sends `request` with the shared retry policy, renewing the token on a 401
+        try:
+            response = transport.request_with_retry(
+                request,
+                refresh_auth=self.generate_token,
+                idempotent=idempotent,
+                deadline=deadline,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            frappe.throw(e)
+        return response
 
     def generate_token(self):
+        # Called after a 401, renews the token unless another worker already did
+        self.token = refresh_token(self.config, stale_token=self.token)
+
+
+def get_token(config, deadline=None):
+    # Returns the shared Delhivery token, renewing it shortly before it expires
+    cache = frappe.cache()
+    token = cache.get(cache.make_key(TOKEN_CACHE_KEY))
+    token = token.decode() if token else config["token"]
+    if token and not is_token_expiring(token):
+        return token
+    return refresh_token(config, stale_token=token, deadline=deadline)
+
+
+def refresh_token(config, stale_token=None, deadline=None):
+    # Only one worker logs in at a time, the others wait on the lock and
+    # then reuse the token it stored. Waiting and logging in share the `deadline`.
+    deadline_at = time.monotonic() + (deadline or TOKEN_LOCK_TIMEOUT)
+    cache = frappe.cache()
+    lock = cache.lock(
+        cache.make_key("delhivery_token_refresh"),
+        timeout=TOKEN_LOCK_TIMEOUT,
+        blocking_timeout=min(deadline or TOKEN_LOCK_TIMEOUT, TOKEN_LOCK_TIMEOUT),
+    )
+    if not lock.acquire():
+        token = cache.get(cache.make_key(TOKEN_CACHE_KEY))
+        return token.decode() if token else stale_token
+
+    try:
+        token = cache.get(cache.make_key(TOKEN_CACHE_KEY))
+        token = token.decode() if token else None
+        if token and token != stale_token and not is_token_expiring(token):
+            return token
+
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            }
-            payload = {
-                "username": self.config["user_name"],
-                "password": self.config["password"],
-            }
+            token = request_token(
+                config, deadline=deadline and max(deadline_at - time.monotonic(), 0.1)
+            )
+        except Exception:
+            frappe.log_error(title=_("Delhivery token could not be renewed"))
+            return stale_token
+
+        expiry = get_token_expiry(token)
+        ttl = int(expiry - time.time()) if expiry else TOKEN_DEFAULT_TTL
+        cache.set(cache.make_key(TOKEN_CACHE_KEY), token, ex=max(ttl, 1))
+        # Keep the last token in the settings so it survives a cache flush
+        frappe.db.set_single_value("Delhivery", "token", token, update_modified=False)
+        return token
+    finally:
+        lock.release()
+
+
+def request_token(config, deadline=None):
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+    }
+    payload = {
+        "username": config["user_name"],
+        "password": config["password"],
+    }
 
-            generate_token_url = self.config["generate_token_url"]
+    generate_token_url = config["generate_token_url"]
 
-            response = requests.post(
-                url=generate_token_url, headers=headers, data=json.dumps(payload)
+    response = transport.request_with_retry(
+        lambda: transport.request(
+            "POST",
+            url=generate_token_url,
+            headers=headers,
+            data=json.dumps(payload),
+            carrier=DELHIVERY_PROVIDER,
+            endpoint="token",
+        ),
+        deadline=deadline,
+    )
+    response.raise_for_status()
+    response_data = json.loads(response.text)
+    return response_data["jwt"]
+
+
+def get_token_expiry(token):
+    # Reads the `exp` claim of the JWT, the signature is not verified
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+    except Exception:
+        return None
+
+
+def is_token_expiring(token):
+    expiry = get_token_expiry(token)
+    return bool(expiry) and expiry - time.time() < TOKEN_REFRESH_MARGIN
+
+
+def queue_manifest_job(job_id):
+    # Start polling the manifest job of a Shipment booked with `delhivery_job_id`
+    frappe.cache().hset(
+        MANIFEST_JOBS_CACHE_KEY, job_id, {"created": time.time(), "attempts": 0, "next_check": 0}
+    )
+    frappe.enqueue(
+        "erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery.poll_manifest_jobs",
+        queue="short",
+        enqueue_after_commit=True,
+    )
+
+
+def poll_manifest_jobs():
+    # Check all pending Delhivery manifest jobs together, backing off per job
+    # until it completes or its deadline passes. Only one poller runs at a time.
+    lock = frappe.cache().lock(
+        frappe.cache().make_key("delhivery_manifest_poller"),
+        timeout=MANIFEST_POLL_RUN_TIME + MANIFEST_POLL_MAX_DELAY,
+        blocking_timeout=0,
+    )
+    if not lock.acquire():
+        return
+
+    try:
+        run_until = time.time() + MANIFEST_POLL_RUN_TIME
+        delhivery = None
+        while True:
+            pending = get_pending_manifest_jobs()
+            if not pending:
+                break
+
+            delhivery = delhivery or DelhiveryUtils()
+            now = time.time()
+            for shipment, job_id, state in pending:
+                if state["next_check"] <= now:
+                    check_manifest_job(delhivery, shipment, job_id, state)
+            frappe.db.commit()
+
+            next_check = min(
+                (state["next_check"] for shipment, job_id, state in get_pending_manifest_jobs()),
+                default=None,
             )
-            response_data = json.loads(response.text)
-            self.config["token"] = response_data["jwt"]
-            frappe.db.set_value("Delhivery", "Delhivery", "token", response_data["jwt"])
+            if next_check is None or next_check > run_until:
+                break
+            time.sleep(max(0, next_check - time.time()))
+    finally:
+        lock.release()
 
-        except Exception as e:
-            print(e)
+
+def get_pending_manifest_jobs():
+    shipments = frappe.get_all(
+        "Shipment",
+        filters={
+            "carrier": DELHIVERY_PROVIDER,
+            "delhivery_job_id": ["is", "set"],
+            "shipment_id": ["is", "not set"],
+            "tracking_status": MANIFESTING_STATUS,
+        },
+        fields=["name", "delhivery_job_id"],
+    )
+    pending = []
+    for shipment in shipments:
+        state = frappe.cache().hget(MANIFEST_JOBS_CACHE_KEY, shipment.delhivery_job_id)
+        if not state:
+            # Cache was cleared, restart the backoff and the deadline from now
+            state = {"created": time.time(), "attempts": 0, "next_check": 0}
+            frappe.cache().hset(MANIFEST_JOBS_CACHE_KEY, shipment.delhivery_job_id, state)
+        pending.append((shipment.name, shipment.delhivery_job_id, state))
+    return pending
+
+
+def check_manifest_job(delhivery, shipment, job_id, state):
+    try:
+        job = delhivery.get_shipment(job_id)
+    except Exception:
+        job = None
+        frappe.clear_messages()
+
+    if job and job["status"]["type"] == "Complete":
+        shipment_value = job["status"]["value"]
+        frappe.db.set_value(
+            "Shipment",
+            shipment,
+            {
+                "shipment_id": shipment_value["lrnum"],
+                "awb_number": shipment_value["master_waybill"],
+                "tracking_status": DELHIVERY_TRACKING_STATUS_MAP["MANIFESTED"],
+            },
+        )
+        frappe.cache().hdel(MANIFEST_JOBS_CACHE_KEY, job_id)
+
+        from erpnext_shipping.erpnext_shipping.labels import queue_label_prefetch
+
+        queue_label_prefetch(shipment, DELHIVERY_PROVIDER, shipment_value["master_waybill"])
+        return
+
+    if time.time() - state["created"] > MANIFEST_POLL_DEADLINE:
+        frappe.db.set_value("Shipment", shipment, "tracking_status", MANIFEST_FAILED_STATUS)
+        frappe.log_error(
+            title=_("Delhivery manifest job {0} did not complete").format(job_id),
+            message=json.dumps(job, indent=1) if job else "",
+            reference_doctype="Shipment",
+            reference_name=shipment,
+        )
+        frappe.cache().hdel(MANIFEST_JOBS_CACHE_KEY, job_id)
+        return
+
+    state["attempts"] += 1
+    delay = min(MANIFEST_POLL_MIN_DELAY * 2 ** (state["attempts"] - 1), MANIFEST_POLL_MAX_DELAY)
+    state["next_check"] = time.time() + delay
+    frappe.cache().hset(MANIFEST_JOBS_CACHE_KEY, job_id, state)
@@ -5,6 +5,14 @@
 from __future__ import unicode_literals
 import frappe
 from frappe.model.document import Document
+from erpnext_shipping.erpnext_shipping.utils import clear_parcel_service_index
 
 class ParcelService(Document):
-	pass
+	def on_update(self):
+		clear_parcel_service_index()
+
+	def on_trash(self):
+		clear_parcel_service_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_parcel_service_index()
@@ -5,18 +5,27 @@
 from __future__ import unicode_literals
 import frappe
 from frappe.model.document import Document
+from erpnext_shipping.erpnext_shipping.utils import (
+	clear_parcel_service_index,
+	get_parcel_service_index,
+)
 
 class ParcelServiceType(Document):
-	pass
+	def on_update(self):
+		clear_parcel_service_index()
+
+	def on_trash(self):
+		clear_parcel_service_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_parcel_service_index()
 
 def match_parcel_service_type_alias(parcel_service_type, parcel_service):
 	# Match and return Parcel Service Type Alias to Parcel Service Type if exists.
-	if frappe.db.exists('Parcel Service', parcel_service):
+	index = get_parcel_service_index()
+	if parcel_service in index['parcel_services']:
 		matched_parcel_service_type = \
-			frappe.db.get_value('Parcel Service Type Alias', {
-				'parcel_type_alias': parcel_service_type,
-				'parcel_service': parcel_service
-			}, 'parent')
+			index['aliases'].get((parcel_service, parcel_service_type))
 		if matched_parcel_service_type:
 			parcel_service_type = matched_parcel_service_type
 	return parcel_service_type
\ No newline at end of file
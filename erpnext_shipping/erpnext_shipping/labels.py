@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import base64
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe import _
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+from erpnext_shipping.erpnext_shipping import transport
+from erpnext_shipping.erpnext_shipping.metrics import set_thread_site
+from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import ARAMEX_PROVIDER, AramexUtils
+from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import (
+    DELHIVERY_PROVIDER,
+    DelhiveryUtils,
+)
+
+LABEL_FILE_PREFIX = "label"
+# Parallel label downloads of a bulk print, see `shipping_label_concurrency`
+DEFAULT_LABEL_CONCURRENCY = 4
+
+
+def get_shipping_label(shipment, carrier, awb_number, refresh=False):
+    """Returns the URLs of the label files of a Shipment.
+
+    Labels are fetched from the carrier once and kept as private File attachments
+    named after their content, the carrier is only called again on `refresh`. A
+    refresh that gets no label back keeps the cached files.
+    """
+    file_urls = [] if refresh else get_label_file_urls(shipment, awb_number)
+    if not file_urls:
+        file_urls = store_labels(shipment, awb_number, fetch_labels(carrier, awb_number))
+    return file_urls
+
+
+def get_label_file_urls(shipment, awb_number):
+    return frappe.get_all(
+        "File",
+        filters={
+            "attached_to_doctype": "Shipment",
+            "attached_to_name": shipment,
+            "file_name": ["like", f"{LABEL_FILE_PREFIX}-{awb_number}-%"],
+        },
+        order_by="creation asc",
+        pluck="file_url",
+    )
+
+
+def fetch_labels(carrier, awb_number):
+    # Returns the content of every label document of a shipment
+    if carrier == ARAMEX_PROVIDER:
+        label_urls = [AramexUtils().get_label(awb_number)]
+    elif carrier == DELHIVERY_PROVIDER:
+        label_urls = DelhiveryUtils().get_label(awb_number)
+    else:
+        frappe.throw(_("Labels of {0} Shipments can not be printed").format(carrier))
+
+    return [
+        get_label_content(label_url, carrier) for label_url in label_urls or [] if label_url
+    ]
+
+
+def get_label_content(label, carrier=None):
+    # Delhivery links to a base64 data URI, Aramex straight to the document
+    if not label.startswith("data:"):
+        response = transport.request(
+            "GET", url=label, carrier=carrier, endpoint="label_document"
+        )
+        response.raise_for_status()
+        if not response.content.startswith(b"data:"):
+            return response.content
+        label = response.text
+    return base64.b64decode(label.split(",", 1)[1])
+
+
+def store_labels(shipment, awb_number, contents):
+    existing = frappe.get_all(
+        "File",
+        filters={
+            "attached_to_doctype": "Shipment",
+            "attached_to_name": shipment,
+            "file_name": ["like", f"{LABEL_FILE_PREFIX}-{awb_number}-%"],
+        },
+        fields=["name", "file_name", "file_url"],
+        order_by="creation asc",
+    )
+    if not contents:
+        # Nothing came back, e.g. during an outage: keep the cached labels
+        return [label_file.file_url for label_file in existing]
+
+    existing = {label_file.file_name: label_file for label_file in existing}
+
+    file_urls = []
+    for content in contents:
+        file_name = "{0}-{1}-{2}.pdf".format(
+            LABEL_FILE_PREFIX, awb_number, hashlib.sha1(content).hexdigest()[:16]
+        )
+        if file_name in existing:
+            file_urls.append(existing.pop(file_name).file_url)
+            continue
+
+        label_file = frappe.get_doc(
+            {
+                "doctype": "File",
+                "file_name": file_name,
+                "attached_to_doctype": "Shipment",
+                "attached_to_name": shipment,
+                "is_private": 1,
+                "content": content,
+            }
+        ).insert(ignore_permissions=True)
+        file_urls.append(label_file.file_url)
+
+    # Labels the carrier no longer returns were replaced
+    for label_file in existing.values():
+        frappe.delete_doc("File", label_file.name, ignore_permissions=True)
+
+    return file_urls
+
+
+def queue_label_prefetch(shipment, carrier, awb_number):
+    if not awb_number or carrier not in (ARAMEX_PROVIDER, DELHIVERY_PROVIDER):
+        return
+    frappe.enqueue(
+        "erpnext_shipping.erpnext_shipping.labels.prefetch_shipping_label",
+        queue="short",
+        enqueue_after_commit=True,
+        shipment=shipment,
+        carrier=carrier,
+        awb_number=awb_number,
+    )
+
+
+def prefetch_shipping_label(shipment, carrier, awb_number):
+    # Background job run after booking so the first print is served locally
+    try:
+        get_shipping_label(shipment, carrier, awb_number)
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(
+            title=_("Could not prefetch the label of Shipment {0}").format(shipment),
+            message=frappe.get_traceback(),
+            reference_doctype="Shipment",
+            reference_name=shipment,
+        )
+
+
+def get_merged_labels_response(shipments):
+    """Returns a response streaming the labels of all `shipments` as one PDF.
+
+    Missing labels are fetched concurrently and cached first. The label files are
+    copied into a temporary file one at a time by `MergedPdfWriter`, which is
+    streamed back, so memory does not grow with the number of labels.
+    """
+    order = {shipment: idx for idx, shipment in enumerate(shipments)}
+    shipments = frappe.get_list(
+        "Shipment",
+        filters={"name": ["in", shipments], "docstatus": 1, "awb_number": ["is", "set"]},
+        fields=["name", "carrier", "awb_number"],
+    )
+    # Labels come out in the order they were selected in
+    shipments.sort(key=lambda shipment: order[shipment.name])
+    label_files = get_label_files([shipment.name for shipment in shipments])
+    missing = [
+        shipment
+        for shipment in shipments
+        if not label_files.get((shipment.name, shipment.awb_number))
+    ]
+    if missing:
+        fetch_missing_labels(missing)
+        label_files = get_label_files([shipment.name for shipment in shipments])
+
+    merged = tempfile.TemporaryFile()
+    writer = MergedPdfWriter(merged)
+    for shipment in shipments:
+        for file_url in label_files.get((shipment.name, shipment.awb_number)) or []:
+            writer.add_document(get_label_path(file_url))
+
+    if not writer.page_ids:
+        merged.close()
+        frappe.throw(_("No labels found for the selected Shipments"))
+
+    writer.close()
+    merged.seek(0)
+
+    response = Response(
+        wrap_file(frappe.local.request.environ, merged),
+        mimetype="application/pdf",
+        direct_passthrough=True,
+    )
+    response.headers["Content-Disposition"] = 'inline; filename="shipping-labels.pdf"'
+    return response
+
+
+class MergedPdfWriter:
+    """Writes the pages of many PDF documents to `stream` as one document.
+
+    Every document is read and its pages copied with the objects they use before
+    the next one is opened, only the object offsets and page ids are kept until
+    `close` writes the page tree and cross-reference table.
+    """
+
+    # Object numbers of the catalog and the page tree, written by `close`
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.offsets = [None, None]
+        self.page_ids = []
+        self.stream.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def add_document(self, path):
+        reader = PdfReader(path)
+        # New object numbers by (number, generation) in the document
+        ids = {}
+        pending = []
+
+        def get_reference(reference, obj=None):
+            key = (reference.idnum, reference.generation)
+            if key not in ids:
+                self.offsets.append(None)
+                ids[key] = len(self.offsets)
+                pending.append((ids[key], reference if obj is None else obj))
+            return IndirectObject(ids[key], 0, None)
+
+        def renumber(value):
+            if isinstance(value, IndirectObject):
+                return get_reference(value)
+            if isinstance(value, DictionaryObject):
+                for key, item in list(value.items()):
+                    value[key] = renumber(item)
+            elif isinstance(value, ArrayObject):
+                for idx, item in enumerate(value):
+                    value[idx] = renumber(item)
+            return value
+
+        page_ids = []
+        for page in reader.pages:
+            # PdfReader sets the inherited attributes on its pages, so the page
+            # tree of the document is left out
+            del page[NameObject("/Parent")]
+            page_ids.append(get_reference(page.indirect_reference, page).idnum)
+
+        while pending:
+            idnum, obj = pending.pop()
+            if isinstance(obj, IndirectObject):
+                obj = obj.get_object()
+            obj = NullObject() if obj is None else renumber(obj)
+            if idnum in page_ids:
+                obj[NameObject("/Parent")] = IndirectObject(self.PAGES_ID, 0, None)
+            self.write_object(idnum, obj)
+        self.page_ids.extend(page_ids)
+
+    def write_object(self, idnum, obj):
+        self.offsets[idnum - 1] = self.stream.tell()
+        self.stream.write(f"{idnum} 0 obj\n".encode())
+        if isinstance(obj, bytes):
+            self.stream.write(obj)
+        else:
+            obj.write_to_stream(self.stream)
+        self.stream.write(b"\nendobj\n")
+
+    def close(self):
+        self.write_object(
+            self.CATALOG_ID, f"<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>".encode()
+        )
+        kids = " ".join(f"{idnum} 0 R" for idnum in self.page_ids)
+        self.write_object(
+            self.PAGES_ID,
+            f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode(),
+        )
+
+        xref = self.stream.tell()
+        self.stream.write(f"xref\n0 {len(self.offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in self.offsets:
+            self.stream.write(f"{offset:010d} 00000 n \n".encode())
+        self.stream.write(
+            f"trailer\n<< /Size {len(self.offsets) + 1} /Root {self.CATALOG_ID} 0 R >>\n"
+            f"startxref\n{xref}\n%%EOF\n".encode()
+        )
+
+
+def get_label_files(shipments):
+    # Label file URLs by (Shipment, AWB) in one query
+    label_files = {}
+    for label_file in frappe.get_all(
+        "File",
+        filters={
+            "attached_to_doctype": "Shipment",
+            "attached_to_name": ["in", shipments],
+            "file_name": ["like", f"{LABEL_FILE_PREFIX}-%"],
+        },
+        fields=["attached_to_name", "file_name", "file_url"],
+        order_by="creation asc",
+    ):
+        awb_number = label_file.file_name[len(LABEL_FILE_PREFIX) + 1 :].rsplit("-", 1)[0]
+        label_files.setdefault((label_file.attached_to_name, awb_number), []).append(
+            label_file.file_url
+        )
+    return label_files
+
+
+def get_label_path(file_url):
+    return frappe.get_site_path(*file_url.lstrip("/").split("/"))
+
+
+def fetch_missing_labels(shipments):
+    # Downloads run in worker threads, storing the files stays on this thread
+    utils = {}
+    for shipment in shipments:
+        if shipment.carrier == ARAMEX_PROVIDER and ARAMEX_PROVIDER not in utils:
+            utils[ARAMEX_PROVIDER] = AramexUtils()
+        elif shipment.carrier == DELHIVERY_PROVIDER and DELHIVERY_PROVIDER not in utils:
+            utils[DELHIVERY_PROVIDER] = DelhiveryUtils()
+            utils[DELHIVERY_PROVIDER].authenticate()
+    shipments = [shipment for shipment in shipments if shipment.carrier in utils]
+
+    concurrency = frappe.conf.get("shipping_label_concurrency") or DEFAULT_LABEL_CONCURRENCY
+    with ThreadPoolExecutor(
+        max_workers=concurrency,
+        thread_name_prefix="labels",
+        initializer=set_thread_site,
+        initargs=(frappe.local.site,),
+    ) as executor:
+        downloads = executor.map(
+            lambda shipment: download_labels(
+                utils[shipment.carrier], shipment.carrier, shipment.awb_number
+            ),
+            shipments,
+        )
+        for shipment, contents in zip(shipments, downloads):
+            try:
+                if isinstance(contents, Exception):
+                    # Expired token or transient failure, retry through the regular call
+                    contents = fetch_labels(shipment.carrier, shipment.awb_number)
+                store_labels(shipment.name, shipment.awb_number, contents)
+            except Exception:
+                frappe.log_error(
+                    title=_("Could not fetch the label of Shipment {0}").format(shipment.name),
+                    message=frappe.get_traceback(),
+                    reference_doctype="Shipment",
+                    reference_name=shipment.name,
+                )
+                frappe.clear_messages()
+
+
+def download_labels(utils, carrier, awb_number):
+    # Runs in a worker thread: no frappe calls beyond the HTTP transport
+    try:
+        response = utils.request_label(awb_number)
+        response.raise_for_status()
+        return [
+            get_label_content(url, carrier)
+            for url in utils.get_label_urls(response) or []
+            if url
+        ]
+    except Exception as e:
+        return e
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+"""Synthetic Shipments and Delivery Notes for load tests.
+
+Run the functions with `bench --site test_site execute` and their arguments as
+`--kwargs`, e.g. `erpnext_shipping.erpnext_shipping.loadtest.data.generate
+--kwargs "{'shipments': 100000}"`:
+
+- `configure_carriers(mock_url)` points Aramex and Delhivery at the mock carrier
+- `generate(shipments)` inserts the Shipments and their Delivery Notes
+- `clear()` deletes them again
+
+Records are written with bulk inserts, without validations or hooks, and named
+with LOAD_TEST_PREFIX so they can be told apart and removed again. Never run
+this on a production site.
+"""
+from __future__ import unicode_literals
+import json
+import random
+from collections import defaultdict
+
+import frappe
+from frappe import _
+from frappe.installer import update_site_config
+from frappe.utils import add_days, add_to_date, cint, now_datetime, nowdate
+from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import ARAMEX_PROVIDER
+from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import DELHIVERY_PROVIDER
+from erpnext_shipping.erpnext_shipping.utils import clear_carrier_config
+
+LOAD_TEST_PREFIX = "LOADTEST-"
+LOAD_TEST_CUSTOMER = "Load Test Customer"
+CARRIERS = (ARAMEX_PROVIDER, DELHIVERY_PROVIDER)
+OPEN_TRACKING_STATUSES = ("PICKUP_REQUESTED", "SHIPPED", "OUT_FOR_DELIVERY")
+INSERT_BATCH_SIZE = 1000
+SHIPMENT_FIELDS = (
+    "name",
+    "creation",
+    "modified",
+    "owner",
+    "modified_by",
+    "docstatus",
+    "pickup_from_type",
+    "pickup_company",
+    "pickup_address_name",
+    "pickup_contact_person",
+    "delivery_to_type",
+    "delivery_customer",
+    "delivery_address_name",
+    "delivery_contact_name",
+    "pickup_date",
+    "pickup_from",
+    "pickup_to",
+    "shipment_type",
+    "pickup_type",
+    "description_of_content",
+    "value_of_goods",
+    "status",
+    "carrier",
+    "service_provider",
+    "shipment_id",
+    "awb_number",
+    "tracking_status",
+    "next_poll_at",
+)
+PARCEL_FIELDS = (
+    "name",
+    "creation",
+    "modified",
+    "parent",
+    "parenttype",
+    "parentfield",
+    "idx",
+    "length",
+    "width",
+    "height",
+    "weight",
+    "count",
+)
+DELIVERY_NOTE_FIELDS = (
+    "name",
+    "creation",
+    "modified",
+    "owner",
+    "modified_by",
+    "docstatus",
+    "status",
+    "customer",
+    "company",
+    "posting_date",
+)
+SHIPMENT_DELIVERY_NOTE_FIELDS = (
+    "name",
+    "creation",
+    "modified",
+    "parent",
+    "parenttype",
+    "parentfield",
+    "idx",
+    "delivery_note",
+)
+
+
+def configure_carriers(mock_url):
+    """Enables both carriers with test credentials pointing at the mock carrier server."""
+    mock_url = mock_url.rstrip("/")
+    update_site_config("shipping_aramex_api_url", f"{mock_url}/ShippingAPI.V2")
+
+    aramex = frappe.get_single(ARAMEX_PROVIDER)
+    aramex.update(
+        {
+            "enabled": 1,
+            "user_name": "loadtest@example.com",
+            "password": "loadtest",
+            "account_number": "20016",
+            "account_pin": "331421",
+            "account_entity": "AMM",
+            "account_country_code": "IN",
+        }
+    )
+    aramex.save(ignore_permissions=True)
+
+    delhivery = frappe.get_single(DELHIVERY_PROVIDER)
+    delhivery.update(
+        {
+            "enabled": 1,
+            "user_name": "loadtest",
+            "password": "loadtest",
+            "token": "",
+            "generate_token_url": f"{mock_url}/delhivery/token",
+            "create_shipment_url": f"{mock_url}/delhivery/manifest",
+            "get_shipment_url": f"{mock_url}/delhivery/manifest",
+            "print_label_url": f"{mock_url}/delhivery/label",
+            "track_shipment_url": f"{mock_url}/delhivery/track",
+            "tracking_page_url": f"{mock_url}/delhivery/tracking",
+            "rate_calculation_url": f"{mock_url}/delhivery/freight/estimate",
+        }
+    )
+    delhivery.save(ignore_permissions=True)
+
+    for carrier in CARRIERS:
+        clear_carrier_config(carrier)
+    frappe.db.commit()
+
+
+def generate(shipments=1000, delivery_notes_per_shipment=1, booked_share=0.8, seed=None):
+    """Inserts `shipments` submitted Shipments with parcels and Delivery Notes.
+
+    A `booked_share` of them is booked with Aramex or Delhivery and due for a
+    tracking refresh, the others can be booked by the load driver.
+    """
+    shipments = cint(shipments)
+    delivery_notes_per_shipment = cint(delivery_notes_per_shipment)
+    rng = random.Random(seed)
+    company, customer, addresses, contact = get_master_data()
+    start = frappe.db.count("Shipment", {"name": ["like", f"{LOAD_TEST_PREFIX}%"]})
+
+    for batch_start in range(start, start + shipments, INSERT_BATCH_SIZE):
+        batch = range(batch_start, min(batch_start + INSERT_BATCH_SIZE, start + shipments))
+        now = now_datetime()
+        rows = {"Shipment": [], "Shipment Parcel": [], "Shipment Delivery Note": []}
+        delivery_notes = []
+
+        for idx in batch:
+            name = f"{LOAD_TEST_PREFIX}SHP-{idx:07d}"
+            carrier = CARRIERS[idx % len(CARRIERS)]
+            booked = rng.random() < booked_share
+            awb_number = f"{idx + 90000000000}" if booked else None
+            rows["Shipment"].append(
+                (
+                    name,
+                    now,
+                    now,
+                    "Administrator",
+                    "Administrator",
+                    1,
+                    "Company",
+                    company,
+                    addresses["pickup"],
+                    "Administrator",
+                    "Customer",
+                    customer,
+                    addresses["delivery"],
+                    contact,
+                    add_days(nowdate(), 1),
+                    "10:00:00",
+                    "17:00:00",
+                    "Goods",
+                    "Pickup",
+                    "Books",
+                    rng.randint(500, 50000),
+                    "Booked" if booked else "Submitted",
+                    carrier if booked else None,
+                    carrier if booked else None,
+                    (awb_number if carrier == ARAMEX_PROVIDER else f"LR{awb_number}")
+                    if booked
+                    else None,
+                    awb_number,
+                    rng.choice(OPEN_TRACKING_STATUSES) if booked else None,
+                    add_to_date(now, minutes=-rng.randint(0, 60)) if booked else None,
+                )
+            )
+            for parcel_idx in range(rng.randint(1, 3)):
+                rows["Shipment Parcel"].append(
+                    (
+                        f"{name}-P{parcel_idx}",
+                        now,
+                        now,
+                        name,
+                        "Shipment",
+                        "shipment_parcel",
+                        parcel_idx + 1,
+                        rng.randint(10, 120),
+                        rng.randint(10, 80),
+                        rng.randint(5, 60),
+                        round(rng.uniform(0.2, 30), 2),
+                        rng.randint(1, 10),
+                    )
+                )
+            for note_idx in range(delivery_notes_per_shipment):
+                delivery_note = f"{LOAD_TEST_PREFIX}DN-{idx:07d}-{note_idx}"
+                delivery_notes.append(
+                    (
+                        delivery_note,
+                        now,
+                        now,
+                        "Administrator",
+                        "Administrator",
+                        1,
+                        "To Bill",
+                        customer,
+                        company,
+                        nowdate(),
+                    )
+                )
+                rows["Shipment Delivery Note"].append(
+                    (
+                        f"{name}-D{note_idx}",
+                        now,
+                        now,
+                        name,
+                        "Shipment",
+                        "shipment_delivery_note",
+                        note_idx + 1,
+                        delivery_note,
+                    )
+                )
+
+        frappe.db.bulk_insert("Shipment", SHIPMENT_FIELDS, rows["Shipment"])
+        frappe.db.bulk_insert("Shipment Parcel", PARCEL_FIELDS, rows["Shipment Parcel"])
+        frappe.db.bulk_insert("Delivery Note", DELIVERY_NOTE_FIELDS, delivery_notes)
+        frappe.db.bulk_insert(
+            "Shipment Delivery Note", SHIPMENT_DELIVERY_NOTE_FIELDS, rows["Shipment Delivery Note"]
+        )
+        frappe.db.commit()
+        print(f"Inserted {batch.stop - start} of {shipments} Shipments")
+
+
+def get_master_data():
+    # The Company, Customer, Addresses and Contact every synthetic Shipment links to
+    company = frappe.defaults.get_global_default("company") or frappe.db.get_value(
+        "Company", {}, "name"
+    )
+    if not company:
+        frappe.throw(_("Create a Company before generating load test data"))
+
+    if not frappe.db.exists("Customer", LOAD_TEST_CUSTOMER):
+        frappe.get_doc(
+            {
+                "doctype": "Customer",
+                "customer_name": LOAD_TEST_CUSTOMER,
+                "customer_type": "Company",
+            }
+        ).insert(ignore_permissions=True, ignore_mandatory=True)
+
+    addresses = {
+        "pickup": get_address("Load Test Pickup", "Mumbai", "400093", "Company", company),
+        "delivery": get_address(
+            "Load Test Delivery", "Bengaluru", "560001", "Customer", LOAD_TEST_CUSTOMER
+        ),
+    }
+
+    contact = frappe.db.get_value("Contact", {"first_name": "Load", "last_name": "Test"})
+    if not contact:
+        contact = (
+            frappe.get_doc(
+                {
+                    "doctype": "Contact",
+                    "first_name": "Load",
+                    "last_name": "Test",
+                    "phone_nos": [{"phone": "+91 98765 43210", "is_primary_phone": 1}],
+                    "email_ids": [{"email_id": "loadtest@example.com", "is_primary": 1}],
+                    "links": [{"link_doctype": "Customer", "link_name": LOAD_TEST_CUSTOMER}],
+                }
+            )
+            .insert(ignore_permissions=True)
+            .name
+        )
+    frappe.db.commit()
+    return company, LOAD_TEST_CUSTOMER, addresses, contact
+
+
+def get_address(address_title, city, pincode, link_doctype, link_name):
+    address = frappe.db.get_value("Address", {"address_title": address_title})
+    if address:
+        return address
+    return (
+        frappe.get_doc(
+            {
+                "doctype": "Address",
+                "address_title": address_title,
+                "address_type": "Shipping",
+                "address_line1": "Plot 42, Industrial Area Phase 2",
+                "city": city,
+                "pincode": pincode,
+                "country": "India",
+                "links": [{"link_doctype": link_doctype, "link_name": link_name}],
+            }
+        )
+        .insert(ignore_permissions=True)
+        .name
+    )
+
+
+def clear():
+    """Deletes all synthetic records again."""
+    pattern = f"{LOAD_TEST_PREFIX}%"
+    frappe.db.delete("Shipment Tracking Event", {"shipment": ["like", pattern]})
+    frappe.db.delete("Shipment Delivery Note", {"parent": ["like", pattern]})
+    frappe.db.delete("Shipment Parcel", {"parent": ["like", pattern]})
+    frappe.db.delete("Shipment", {"name": ["like", pattern]})
+    frappe.db.delete("Delivery Note", {"name": ["like", pattern]})
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_load_test_targets(scenario, carrier=None, limit=1000):
+    """Returns the arguments of up to `limit` calls of `scenario` for the load driver."""
+    frappe.only_for("System Manager")
+
+    filters = {"name": ["like", f"{LOAD_TEST_PREFIX}%"], "docstatus": 1}
+    if scenario == "create_shipment":
+        filters["status"] = "Submitted"
+    else:
+        filters.update({"status": "Booked", "awb_number": ["is", "set"]})
+        if carrier:
+            filters["carrier"] = carrier
+
+    shipments = frappe.get_all(
+        "Shipment",
+        filters=filters,
+        fields=["*"],
+        order_by="name asc",
+        limit=cint(limit),
+    )
+    if scenario == "print_shipping_label":
+        return [
+            {
+                "carrier": shipment.carrier,
+                "awb_number": shipment.awb_number,
+                "shipment": shipment.name,
+            }
+            for shipment in shipments
+        ]
+    if scenario == "update_tracking":
+        return [
+            {
+                "shipment": shipment.name,
+                "carrier": shipment.carrier,
+                "shipment_id": shipment.shipment_id,
+                "awb_number": shipment.awb_number,
+            }
+            for shipment in shipments
+        ]
+    if scenario != "create_shipment":
+        frappe.throw(_("Unknown load test scenario {0}").format(scenario))
+
+    names = [shipment.name for shipment in shipments]
+    parcels = defaultdict(list)
+    for parcel in frappe.get_all(
+        "Shipment Parcel",
+        filters={"parent": ["in", names], "parenttype": "Shipment"},
+        fields=["parent", "length", "width", "height", "weight", "count"],
+        order_by="idx asc",
+    ):
+        parcels[parcel.pop("parent")].append(parcel)
+    delivery_notes = defaultdict(list)
+    for row in frappe.get_all(
+        "Shipment Delivery Note",
+        filters={"parent": ["in", names], "parenttype": "Shipment"},
+        fields=["parent", "delivery_note"],
+    ):
+        delivery_notes[row.parent].append(row.delivery_note)
+
+    targets = []
+    for idx, shipment in enumerate(shipments):
+        shipment_carrier = carrier or CARRIERS[idx % len(CARRIERS)]
+        targets.append(
+            {
+                "shipment": shipment.name,
+                "pickup_from_type": shipment.pickup_from_type,
+                "delivery_to_type": shipment.delivery_to_type,
+                "pickup_address_name": shipment.pickup_address_name,
+                "delivery_address_name": shipment.delivery_address_name,
+                "shipment_parcel": json.dumps(parcels[shipment.name]),
+                "description_of_content": shipment.description_of_content,
+                "pickup_date": str(shipment.pickup_date),
+                "pickup_time": str(shipment.pickup_from),
+                "pickup_contact_name": shipment.pickup_contact_person,
+                "delivery_contact_name": shipment.delivery_contact_name,
+                "value_of_goods": shipment.value_of_goods,
+                "service_data": json.dumps(
+                    {"carrier": shipment_carrier, "service_provider": shipment_carrier}
+                ),
+                "pickup_company_name": shipment.pickup_company,
+                "delivery_company_name": shipment.delivery_customer,
+                "delivery_notes": json.dumps(delivery_notes[shipment.name]),
+            }
+        )
+    return targets
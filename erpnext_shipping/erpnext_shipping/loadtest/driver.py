@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+"""Load driver calling the shipping API of a running bench concurrently.
+
+    python -m erpnext_shipping.erpnext_shipping.loadtest.driver http://test_site:8000 \\
+        --api-key KEY --api-secret SECRET --scenario create_shipment --concurrency 20
+
+Calls go through the web workers like the ones of the Shipment form, so the
+throughput includes request handling, the database and the carrier calls. The
+targets come from the synthetic data of `loadtest.data`, each Shipment is booked
+once while labels and tracking are requested round robin until the duration ends.
+"""
+from __future__ import unicode_literals
+import argparse
+import itertools
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SCENARIOS = ("create_shipment", "print_shipping_label", "update_tracking")
+API_METHOD = "/api/method/erpnext_shipping.erpnext_shipping"
+
+
+class LoadDriver:
+    def __init__(self, site_url, api_key, api_secret, timeout=120):
+        self.site_url = site_url.rstrip("/")
+        self.headers = {"Authorization": f"token {api_key}:{api_secret}"}
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        # One keep-alive session per driver thread
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            self.local.session.headers.update(self.headers)
+        return self.local.session
+
+    def call(self, method, **kwargs):
+        return self.session.post(
+            f"{self.site_url}{API_METHOD}.{method}", json=kwargs, timeout=self.timeout
+        )
+
+    def get_targets(self, scenario, carrier=None, limit=1000):
+        response = self.call(
+            "loadtest.data.get_load_test_targets", scenario=scenario, carrier=carrier, limit=limit
+        )
+        response.raise_for_status()
+        return response.json()["message"]
+
+    def run(self, scenario, targets, concurrency=10, duration=60):
+        """Calls `scenario` from `concurrency` threads for at most `duration` seconds."""
+        targets = iter(targets) if scenario == "create_shipment" else itertools.cycle(targets)
+        targets_lock = threading.Lock()
+        results = []
+        deadline = time.monotonic() + duration
+
+        def worker():
+            while time.monotonic() < deadline:
+                with targets_lock:
+                    target = next(targets, None)
+                if target is None:
+                    return
+                results.append(self.timed_call(scenario, target))
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for idx in range(concurrency)]:
+                future.result()
+        return get_report(scenario, results, time.monotonic() - started, concurrency)
+
+    def timed_call(self, scenario, target):
+        started = time.monotonic()
+        try:
+            response = self.call(f"shipping.{scenario}", **target)
+            status = response.status_code
+            # Booking errors are shown as alerts and return nothing
+            if status == 200 and scenario == "create_shipment":
+                status = 200 if response.json().get("message") else "not_booked"
+        except (requests.RequestException, ValueError) as e:
+            status = type(e).__name__
+        return time.monotonic() - started, status
+
+
+def get_report(scenario, results, elapsed, concurrency):
+    latencies = sorted(latency for latency, status in results)
+    statuses = {}
+    for latency, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items() if status != "200")
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "calls": len(results),
+        "errors": errors,
+        "statuses": statuses,
+        "elapsed": round(elapsed, 2),
+        "calls_per_minute": round(60 * len(results) / elapsed, 1) if elapsed else 0,
+        "successful_calls_per_minute": (
+            round(60 * (len(results) - errors) / elapsed, 1) if elapsed else 0
+        ),
+        "latency": {
+            "p50": get_percentile(latencies, 0.5),
+            "p95": get_percentile(latencies, 0.95),
+            "p99": get_percentile(latencies, 0.99),
+            "max": round(latencies[-1], 3) if latencies else 0,
+        },
+    }
+
+
+def get_percentile(values, percentile):
+    # Nearest rank percentile of sorted `values`
+    if not values:
+        return 0
+    rank = max(1, math.ceil(percentile * len(values)))
+    return round(values[rank - 1], 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("site_url")
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--api-secret", required=True)
+    parser.add_argument("--scenario", choices=SCENARIOS, default="create_shipment")
+    parser.add_argument("--carrier", choices=("Aramex", "Delhivery"))
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--limit", type=int, default=1000, help="Shipments to use")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    driver = LoadDriver(args.site_url, args.api_key, args.api_secret)
+    targets = driver.get_targets(args.scenario, args.carrier, args.limit)
+    if not targets:
+        parser.exit(1, "No load test Shipments found, generate them with loadtest.data\n")
+
+    report = driver.run(args.scenario, targets, args.concurrency, args.duration)
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+
+    latency = report["latency"]
+    print(
+        f"{report['scenario']}: {report['calls']} calls in {report['elapsed']}s "
+        f"from {report['concurrency']} threads, {report['errors']} errors"
+    )
+    print(
+        f"throughput: {report['calls_per_minute']} calls/min "
+        f"({report['successful_calls_per_minute']} successful)"
+    )
+    print(
+        f"latency: p50 {latency['p50']}s, p95 {latency['p95']}s, "
+        f"p99 {latency['p99']}s, max {latency['max']}s"
+    )
+    print("statuses: " + ", ".join(f"{k}: {v}" for k, v in sorted(report["statuses"].items())))
+
+
+if __name__ == "__main__":
+    main()
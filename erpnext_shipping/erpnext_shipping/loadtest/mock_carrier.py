@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+"""Local stand-in for the Aramex and Delhivery APIs used in load tests.
+
+Start it with `python -m erpnext_shipping.erpnext_shipping.loadtest.mock_carrier`
+and point the carriers at it with `loadtest.data.configure_carriers`. Only the
+standard library is used so it runs outside of the bench as well.
+
+Aramex is served under /ShippingAPI.V2, Delhivery under /delhivery:
+
+- POST /delhivery/token
+- POST /delhivery/manifest, GET /delhivery/manifest?job_id=
+- GET /delhivery/label/<awb>
+- GET /delhivery/track/<lrnum>
+- POST /delhivery/freight/estimate
+"""
+from __future__ import unicode_literals
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ARAMEX_PREFIX = "/ShippingAPI.V2"
+DELHIVERY_PREFIX = "/delhivery"
+
+# Behaviour presets, every value can be overridden on the command line
+PROFILES = {
+    # Answers at once, for finding the limits of the bench itself
+    "fast": {},
+    # Latencies as seen from production
+    "realistic": {"latency": 0.3, "jitter": 0.4, "slow_rate": 0.01, "slow_latency": 8},
+    # A carrier in trouble, retries and the circuit breaker kick in
+    "degraded": {"latency": 1, "jitter": 2, "error_rate": 0.2, "slow_rate": 0.05},
+    "outage": {"latency": 0.1, "error_rate": 1},
+    # Delhivery tokens are rejected now and then and have to be renewed
+    "auth": {"latency": 0.3, "jitter": 0.4, "auth_failure_rate": 0.05},
+    # Manifest jobs complete slowly so the poller has a backlog
+    "slow_jobs": {"latency": 0.3, "jitter": 0.4, "job_delay": 120},
+}
+DEFAULT_SETTINGS = {
+    # Seconds every response is delayed by, plus up to `jitter` seconds at random
+    "latency": 0,
+    "jitter": 0,
+    # Share of calls answered with a 503
+    "error_rate": 0,
+    # Share of calls delayed by `slow_latency` seconds instead
+    "slow_rate": 0,
+    "slow_latency": 15,
+    # Share of Delhivery calls with a token answered with a 401
+    "auth_failure_rate": 0,
+    # Seconds before a Delhivery manifest job is complete
+    "job_delay": 2,
+    # Seconds a Delhivery token is valid for
+    "token_ttl": 3600,
+}
+TRACKING_STATUSES = {
+    "Aramex": (
+        "Record created.",
+        "Picked Up From Shipper",
+        "Departed Origin Facility",
+        "Out for Delivery",
+        "Delivered",
+    ),
+    "Delhivery": ("MANIFESTED", "PICKED_UP", "LEFT_ORIGIN", "OFD", "DELIVERED"),
+}
+
+
+class CarrierState:
+    """Manifest jobs and counters shared by all handler threads."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.awb_numbers = itertools.count(44000000000)
+        self.requests = 0
+
+    def next_awb_number(self):
+        with self.lock:
+            return str(next(self.awb_numbers))
+
+    def add_job(self):
+        job_id = str(uuid.uuid4())
+        awb_number = self.next_awb_number()
+        with self.lock:
+            self.jobs[job_id] = (time.time(), awb_number)
+        return job_id
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+
+class CarrierHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockCarrier/1.0"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(CarrierHandler, self).log_message(format, *args)
+
+    def do_GET(self):
+        self.handle_call("GET")
+
+    def do_POST(self):
+        self.handle_call("POST")
+
+    def handle_call(self, method):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        with self.state.lock:
+            self.state.requests += 1
+
+        settings = self.state.settings
+        delay = settings["latency"] + random.uniform(0, settings["jitter"])
+        if random.random() < settings["slow_rate"]:
+            delay = settings["slow_latency"]
+        time.sleep(delay)
+
+        if random.random() < settings["error_rate"]:
+            return self.send_json({"error": "Service Unavailable"}, status=503)
+
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return self.send_json({"error": "Invalid JSON"}, status=400)
+
+        if parts.path.startswith(ARAMEX_PREFIX):
+            return self.handle_aramex(method, parts.path[len(ARAMEX_PREFIX) :], payload)
+        if parts.path.startswith(DELHIVERY_PREFIX):
+            return self.handle_delhivery(
+                method, parts.path[len(DELHIVERY_PREFIX) :], parse_qs(parts.query), payload
+            )
+        if method == "GET" and parts.path.startswith("/labels/"):
+            return self.send_pdf(get_label_pdf(parts.path.rsplit("/", 1)[-1][:-4]))
+        self.send_json({"error": "Not Found"}, status=404)
+
+    def handle_aramex(self, method, path, payload):
+        endpoint = path.rsplit("/", 1)[-1]
+        if method != "POST":
+            return self.send_json({"error": "Method Not Allowed"}, status=405)
+
+        if endpoint == "CalculateRate":
+            pieces = payload.get("ShipmentDetails", {}).get("NumberOfPieces") or 1
+            return self.send_json(
+                {
+                    "HasErrors": False,
+                    "Notifications": [],
+                    "TotalAmount": {"CurrencyCode": "INR", "Value": 250.0 + 40 * pieces},
+                }
+            )
+
+        if endpoint == "CreateShipments":
+            shipments = []
+            for entry in payload.get("Shipments") or []:
+                awb_number = self.state.next_awb_number()
+                shipments.append(
+                    {
+                        "ID": awb_number,
+                        "Reference1": entry.get("Reference1") or "",
+                        "HasErrors": False,
+                        "Notifications": [],
+                        "ShipmentDetails": {"ProductType": "PPX"},
+                        "ShipmentLabel": {"LabelURL": self.get_label_url(awb_number)},
+                    }
+                )
+            return self.send_json(
+                {"HasErrors": False, "Notifications": [], "Shipments": shipments}
+            )
+
+        if endpoint == "PrintLabel":
+            awb_number = payload.get("ShipmentNumber")
+            return self.send_json(
+                {
+                    "HasErrors": False,
+                    "Notifications": [],
+                    "ShipmentNumber": awb_number,
+                    "ShipmentLabel": {"LabelURL": self.get_label_url(awb_number)},
+                }
+            )
+
+        if endpoint == "TrackShipments":
+            results = [
+                {
+                    "Key": awb_number,
+                    "Value": [
+                        {
+                            "WaybillNumber": awb_number,
+                            "UpdateDescription": get_tracking_status("Aramex", awb_number),
+                            "UpdateDateTime": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        }
+                    ],
+                }
+                for awb_number in payload.get("Shipments") or []
+            ]
+            return self.send_json(
+                {"HasErrors": False, "Notifications": [], "TrackingResults": results}
+            )
+
+        self.send_json({"error": "Not Found"}, status=404)
+
+    def handle_delhivery(self, method, path, query, payload):
+        if path == "/token" and method == "POST":
+            expiry = int(time.time() + self.state.settings["token_ttl"])
+            return self.send_json({"jwt": get_token(expiry)})
+
+        if not self.is_authorized():
+            return self.send_json({"error": "Unauthorized"}, status=401)
+
+        if path == "/manifest" and method == "POST":
+            return self.send_json({"job_id": self.state.add_job()})
+
+        if path == "/manifest" and method == "GET":
+            job = self.state.get_job((query.get("job_id") or [""])[0])
+            if not job:
+                return self.send_json({"error": "Job not found"}, status=404)
+            created, awb_number = job
+            if time.time() - created < self.state.settings["job_delay"]:
+                return self.send_json({"status": {"type": "Pending", "value": {}}})
+            return self.send_json(
+                {
+                    "status": {
+                        "type": "Complete",
+                        "value": {"lrnum": f"LR{awb_number}", "master_waybill": awb_number},
+                    }
+                }
+            )
+
+        if path.startswith("/label/") and method == "GET":
+            awb_number = path.rsplit("/", 1)[-1]
+            label = base64.b64encode(get_label_pdf(awb_number)).decode()
+            return self.send_json({"data": [f"data:application/pdf;base64,{label}"]})
+
+        if path.startswith("/track/") and method == "GET":
+            lrnum = path.rsplit("/", 1)[-1]
+            return self.send_json({"data": {"status": get_tracking_status("Delhivery", lrnum)}})
+
+        if path == "/freight/estimate" and method == "POST":
+            weight = float(payload.get("weight_g") or 500)
+            return self.send_json(
+                {"data": {"total": round(80 + weight / 1000 * 35, 2), "currency": "INR"}}
+            )
+
+        self.send_json({"error": "Not Found"}, status=404)
+
+    def is_authorized(self):
+        authorization = self.headers.get("Authorization") or ""
+        if not authorization.startswith("Bearer "):
+            return False
+        return random.random() >= self.state.settings["auth_failure_rate"]
+
+    def get_label_url(self, awb_number):
+        return f"http://{self.headers.get('Host')}/labels/{awb_number}.pdf"
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode(), "application/json", status)
+
+    def send_pdf(self, content):
+        self.send_body(content, "application/pdf")
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_tracking_status(carrier, reference):
+    # Every Shipment moves through the statuses, a step every five minutes
+    statuses = TRACKING_STATUSES[carrier]
+    step = (int(time.time() // 300) + sum(map(ord, reference))) % (len(statuses) * 4)
+    return statuses[min(step, len(statuses) - 1)]
+
+
+def get_token(expiry):
+    # Unsigned JWT, the app only reads its `exp` claim
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return ".".join([encode({"alg": "none"}), encode({"exp": expiry}), "mock"])
+
+
+def get_label_pdf(awb_number):
+    """Returns a single page PDF showing `awb_number`."""
+    text = "".join(char for char in str(awb_number) if char.isalnum())
+    content = f"BT /F1 24 Tf 36 360 Td (AWB {text}) Tj ET".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 288 432] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return pdf
+
+
+def get_server(host="127.0.0.1", port=8765, profile="fast", verbose=False, **overrides):
+    settings = dict(DEFAULT_SETTINGS, **PROFILES[profile])
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+
+    server = ThreadingHTTPServer((host, port), CarrierHandler)
+    server.daemon_threads = True
+    server.state = CarrierState(settings)
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="fast")
+    for setting, default in DEFAULT_SETTINGS.items():
+        parser.add_argument(
+            "--" + setting.replace("_", "-"),
+            dest=setting,
+            type=float,
+            help=f"overrides the profile, defaults to {default}",
+        )
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = vars(parser.parse_args())
+
+    server = get_server(**args)
+    settings = ", ".join(f"{key}={value}" for key, value in server.state.settings.items())
+    print(f"Mock carrier listening on http://{args['host']}:{args['port']} ({settings})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {server.state.requests} requests")
+
+
+if __name__ == "__main__":
+    main()
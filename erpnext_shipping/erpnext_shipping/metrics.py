@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import hmac
+import json
+import threading
+import time
+
+import frappe
+import redis
+from frappe.utils import add_days, now_datetime
+from werkzeug.wrappers import Response
+
+METRICS_KEY = "erpnext_shipping_carrier_metrics"
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_RETENTION_DAYS = 30
+# Site of the worker threads calling carriers, see `set_thread_site`
+_thread_state = threading.local()
+
+
+def record_call(
+    carrier, endpoint, duration, status, request_bytes=0, response_bytes=0, retry=False
+):
+    """Adds an outbound carrier call to the running totals and to the next flush.
+
+    `status` is the HTTP status code or the name of the error that ended the call.
+    Only raw Redis commands are used so calls made in worker threads are recorded too.
+    The running totals cover the whole bench, the calls to flush are kept per site.
+    """
+    bucket = next(
+        (f"le_{bound}" for bound in LATENCY_BUCKETS if duration <= bound), "le_inf"
+    )
+    status = get_status_class(status)
+    site = get_site()
+
+    keys = [f"{METRICS_KEY}:total:{carrier}:{endpoint}"]
+    if site:
+        keys.append(f"{get_pending_key(site)}:{carrier}:{endpoint}")
+
+    pipeline = frappe.cache().pipeline()
+    for key in keys:
+        pipeline.hincrby(key, "calls", 1)
+        pipeline.hincrby(key, f"status_{status}", 1)
+        pipeline.hincrby(key, bucket, 1)
+        pipeline.hincrbyfloat(key, "duration_sum", duration)
+        pipeline.hincrby(key, "request_bytes", request_bytes)
+        pipeline.hincrby(key, "response_bytes", response_bytes)
+        if retry:
+            pipeline.hincrby(key, "retries", 1)
+    pipeline.sadd(f"{METRICS_KEY}:index", f"{carrier}:{endpoint}")
+    if site:
+        pipeline.sadd(f"{get_pending_key(site)}:index", f"{carrier}:{endpoint}")
+    pipeline.execute()
+
+
+def set_thread_site(site):
+    # Initializer of worker threads calling carriers, which have no frappe.local
+    _thread_state.site = site
+
+
+def get_site():
+    return getattr(frappe.local, "site", None) or getattr(_thread_state, "site", None)
+
+
+def get_pending_key(site):
+    return f"{METRICS_KEY}:{site}:pending"
+
+
+def get_status_class(status):
+    if isinstance(status, int):
+        return f"{status // 100}xx"
+    return status
+
+
+def get_metrics():
+    # Returns the running totals of every (carrier, endpoint) as a dict of dicts
+    labels = get_labels()
+    pipeline = frappe.cache().pipeline()
+    for carrier, endpoint in labels:
+        pipeline.hgetall(f"{METRICS_KEY}:total:{carrier}:{endpoint}")
+    return {
+        label: decode_values(values)
+        for label, values in zip(labels, pipeline.execute())
+        if values
+    }
+
+
+def get_labels(index=f"{METRICS_KEY}:index"):
+    # The metric keys are not prefixed like RedisWrapper.smembers would
+    pipeline = frappe.cache().pipeline()
+    pipeline.smembers(index)
+    return sorted(tuple(label.decode().split(":", 1)) for label in pipeline.execute()[0])
+
+
+def decode_values(values):
+    return {
+        field.decode(): float(value) if field == b"duration_sum" else int(value)
+        for field, value in values.items()
+    }
+
+
+def get_latency_quantile(values, quantile):
+    # Upper bound of the histogram bucket the quantile falls in
+    target = quantile * values.get("calls", 0)
+    if not target:
+        return 0
+    seen = 0
+    for bound in LATENCY_BUCKETS:
+        seen += values.get(f"le_{bound}", 0)
+        if seen >= target:
+            return bound
+    return LATENCY_BUCKETS[-1]
+
+
+def flush_carrier_metrics():
+    """Scheduled event storing this site's calls since the last flush as Carrier API Metrics.
+
+    The pending counters of each endpoint are renamed away atomically, so calls
+    recorded while flushing count towards the next period.
+    """
+    cache = frappe.cache()
+    period_end = now_datetime()
+    period_start = cache.get_value(f"{METRICS_KEY}:last_flush") or period_end
+    cache.set_value(f"{METRICS_KEY}:last_flush", period_end)
+
+    pending_key = get_pending_key(frappe.local.site)
+    for carrier, endpoint in get_labels(f"{pending_key}:index"):
+        key = f"{pending_key}:{carrier}:{endpoint}"
+        flushing = f"{key}:flushing:{time.time()}"
+        try:
+            cache.rename(key, flushing)
+        except redis.exceptions.ResponseError:
+            # Nothing recorded since the last flush
+            continue
+        pipeline = cache.pipeline()
+        pipeline.hgetall(flushing)
+        pipeline.delete(flushing)
+        values = decode_values(pipeline.execute()[0])
+
+        calls = values.get("calls", 0)
+        errors = sum(
+            count
+            for field, count in values.items()
+            if field.startswith("status_") and field not in ("status_2xx", "status_3xx")
+        )
+        frappe.get_doc(
+            {
+                "doctype": "Carrier API Metric",
+                "carrier": carrier,
+                "endpoint": endpoint,
+                "period_start": period_start,
+                "period_end": period_end,
+                "calls": calls,
+                "errors": errors,
+                "error_rate": 100 * errors / calls if calls else 0,
+                "retries": values.get("retries", 0),
+                "avg_latency": values.get("duration_sum", 0) / calls if calls else 0,
+                "p50_latency": get_latency_quantile(values, 0.5),
+                "p95_latency": get_latency_quantile(values, 0.95),
+                "p99_latency": get_latency_quantile(values, 0.99),
+                "request_bytes": values.get("request_bytes", 0),
+                "response_bytes": values.get("response_bytes", 0),
+                "counters": json.dumps(values, indent=1, sort_keys=True),
+            }
+        ).db_insert()
+
+    frappe.db.delete(
+        "Carrier API Metric", {"period_end": ("<", add_days(period_end, -METRICS_RETENTION_DAYS))}
+    )
+    frappe.db.commit()
+
+
+@frappe.whitelist(allow_guest=True)
+def prometheus():
+    """Exposes the running totals of the bench in the Prometheus text format.
+
+    Scrapers authenticate with the `shipping_metrics_token` of site_config.json as a
+    bearer token, logged in System Managers can read it as well.
+    """
+    token = frappe.conf.get("shipping_metrics_token")
+    authorization = frappe.get_request_header("Authorization") or ""
+    if not (
+        token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    ):
+        frappe.only_for("System Manager")
+
+    return Response(
+        get_prometheus_text(get_metrics()), mimetype="text/plain; version=0.0.4"
+    )
+
+
+def get_prometheus_text(metrics):
+    prefix = "erpnext_shipping_carrier"
+    lines = [
+        f"# HELP {prefix}_request_duration_seconds Latency of outbound carrier calls.",
+        f"# TYPE {prefix}_request_duration_seconds histogram",
+    ]
+    for (carrier, endpoint), values in metrics.items():
+        labels = f'carrier="{carrier}",endpoint="{endpoint}"'
+        cumulative = 0
+        for bound in LATENCY_BUCKETS:
+            cumulative += values.get(f"le_{bound}", 0)
+            lines.append(
+                f'{prefix}_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+            )
+        lines.append(
+            f'{prefix}_request_duration_seconds_bucket{{{labels},le="+Inf"}} '
+            f'{values.get("calls", 0)}'
+        )
+        lines.append(
+            f"{prefix}_request_duration_seconds_sum{{{labels}}} {values.get('duration_sum', 0)}"
+        )
+        lines.append(
+            f"{prefix}_request_duration_seconds_count{{{labels}}} {values.get('calls', 0)}"
+        )
+
+    counters = (
+        ("requests_total", "Outbound carrier calls by status class or error.", None),
+        ("retries_total", "Outbound carrier calls that were retries.", "retries"),
+        ("request_bytes_total", "Bytes sent to carriers.", "request_bytes"),
+        ("response_bytes_total", "Bytes received from carriers.", "response_bytes"),
+    )
+    for name, description, field in counters:
+        lines.append(f"# HELP {prefix}_{name} {description}")
+        lines.append(f"# TYPE {prefix}_{name} counter")
+        for (carrier, endpoint), values in metrics.items():
+            labels = f'carrier="{carrier}",endpoint="{endpoint}"'
+            if field:
+                lines.append(f"{prefix}_{name}{{{labels}}} {values.get(field, 0)}")
+                continue
+            for status_field, count in sorted(values.items()):
+                if status_field.startswith("status_"):
+                    status = status_field[len("status_") :]
+                    lines.append(f'{prefix}_{name}{{{labels},status="{status}"}} {count}')
+
+    return "\n".join(lines) + "\n"
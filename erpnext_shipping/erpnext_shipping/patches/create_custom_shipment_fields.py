@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+def execute():
+	shipment_fields = {
+		"Shipment": [
+			{
+				"fieldname": "delhivery_job_id",
+				"label": "Delhivery Job ID",
+				"fieldtype": "Data",
+				"read_only": 1,
+				"no_copy": 1,
+				"search_index": 1,
+				"insert_after": "shipment_id"
+			}
+		]
+	}
+
+	if not frappe.get_meta("Shipment").has_field("delhivery_job_id"):
+		create_custom_fields(shipment_fields)
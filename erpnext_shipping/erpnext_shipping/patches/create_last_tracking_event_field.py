@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+def execute():
+	shipment_fields = {
+		"Shipment": [
+			{
+				"fieldname": "last_tracking_event_at",
+				"label": "Last Tracking Event At",
+				"fieldtype": "Datetime",
+				"read_only": 1,
+				"hidden": 1,
+				"no_copy": 1,
+				"insert_after": "tracking_closed"
+			}
+		]
+	}
+
+	if not frappe.get_meta("Shipment").has_field("last_tracking_event_at"):
+		create_custom_fields(shipment_fields)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+from erpnext_shipping.erpnext_shipping.utils import is_final_tracking_status
+
+def execute():
+	shipment_fields = {
+		"Shipment": [
+			{
+				"fieldname": "tracking_closed",
+				"label": "Tracking Closed",
+				"fieldtype": "Check",
+				"default": "0",
+				"read_only": 1,
+				"no_copy": 1,
+				"search_index": 1,
+				"insert_after": "tracking_no_change_count"
+			}
+		]
+	}
+
+	if not frappe.get_meta("Shipment").has_field("tracking_closed"):
+		create_custom_fields(shipment_fields)
+
+	# Close the Shipments whose stored carrier status is final already, compared
+	# once per distinct status since carriers store it unnormalized
+	shipment = frappe.qb.DocType("Shipment")
+	tracking_statuses = (
+		frappe.qb.from_(shipment)
+		.select(shipment.tracking_status)
+		.distinct()
+		.where(shipment.tracking_status.isnotnull())
+	).run(pluck=True)
+	final_statuses = [status for status in tracking_statuses if is_final_tracking_status(status)]
+	if final_statuses:
+		(
+			frappe.qb.update(shipment)
+			.set(shipment.tracking_closed, 1)
+			.where(shipment.tracking_status.isin(final_statuses))
+		).run()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+def execute():
+	shipment_fields = {
+		"Shipment": [
+			{
+				"fieldname": "next_poll_at",
+				"label": "Next Tracking Update",
+				"fieldtype": "Datetime",
+				"read_only": 1,
+				"no_copy": 1,
+				"search_index": 1,
+				"insert_after": "tracking_url"
+			},
+			{
+				"fieldname": "tracking_no_change_count",
+				"label": "Tracking Updates Without Change",
+				"fieldtype": "Int",
+				"read_only": 1,
+				"no_copy": 1,
+				"hidden": 1,
+				"insert_after": "next_poll_at"
+			}
+		]
+	}
+
+	if not frappe.get_meta("Shipment").has_field("next_poll_at"):
+		create_custom_fields(shipment_fields)
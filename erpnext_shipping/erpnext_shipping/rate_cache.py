@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import hashlib
+import json
+import time
+
+import frappe
+
+DEFAULT_TTL = 15 * 60
+DEFAULT_MAX_ENTRIES = 10000
+STATS_CACHE_KEY = "erpnext_shipping_rate_quote_stats"
+
+
+class RateQuoteCache:
+    """Rate quotes of a carrier, shared by all workers through Redis.
+
+    Quotes are keyed by a lane signature, expire after `shipping_rate_cache_ttl`
+    seconds and the least recently used lanes are evicted once more than
+    `shipping_rate_cache_size` lanes are cached.
+    """
+
+    def __init__(self, carrier):
+        self.carrier = carrier
+        self.ttl = frappe.conf.get("shipping_rate_cache_ttl") or DEFAULT_TTL
+        self.max_entries = frappe.conf.get("shipping_rate_cache_size") or DEFAULT_MAX_ENTRIES
+        self.redis = frappe.cache()
+        self.lru_key = self.redis.make_key(f"erpnext_shipping_rate_quote_lru:{carrier}")
+
+    def get(self, lane):
+        key = self.get_key(lane)
+        quote = self.redis.get(key)
+        if quote is None:
+            self.count("misses")
+            return None
+
+        self.redis.zadd(self.lru_key, {key: time.time()})
+        self.count("hits")
+        return json.loads(quote)
+
+    def set(self, lane, quote):
+        key = self.get_key(lane)
+        pipeline = self.redis.pipeline()
+        pipeline.set(key, json.dumps(quote), ex=self.ttl)
+        pipeline.zadd(self.lru_key, {key: time.time()})
+        # Lanes that expired on their own no longer count against the size
+        pipeline.zremrangebyscore(self.lru_key, 0, time.time() - self.ttl)
+        pipeline.zcard(self.lru_key)
+        size = pipeline.execute()[-1]
+
+        if size > self.max_entries:
+            evicted = self.redis.zpopmin(self.lru_key, size - self.max_entries)
+            if evicted:
+                self.redis.delete(*[evicted_key for evicted_key, score in evicted])
+
+    def get_key(self, lane):
+        signature = hashlib.sha1(json.dumps(lane, sort_keys=True).encode()).hexdigest()
+        return self.redis.make_key(f"erpnext_shipping_rate_quote:{self.carrier}:{signature}")
+
+    def count(self, counter):
+        self.redis.hincrby(self.redis.make_key(STATS_CACHE_KEY), f"{self.carrier}:{counter}", 1)
+
+    def get_stats(self):
+        # Read through a pipeline, RedisWrapper.hgetall expects pickled values
+        pipeline = self.redis.pipeline()
+        pipeline.hgetall(self.redis.make_key(STATS_CACHE_KEY))
+        stats = pipeline.execute()[0]
+        hits = int(stats.get(f"{self.carrier}:hits".encode(), 0))
+        misses = int(stats.get(f"{self.carrier}:misses".encode(), 0))
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0,
+            "entries": self.redis.zcard(self.lru_key),
+        }
+
+
+@frappe.whitelist()
+def get_rate_cache_stats(carrier):
+    frappe.only_for("System Manager")
+    return RateQuoteCache(carrier).get_stats()
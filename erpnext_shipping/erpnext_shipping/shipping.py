@@ -3,17 +3,29 @@
 # For license information, please see license.txt
 from __future__ import unicode_literals
 import frappe
+import hashlib
 import json
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from nona.nona.notifications.notifications import send_delivery_status_update_notification
 from six import string_types
 from frappe import _
-from frappe.utils import flt
+from frappe.utils import cint, flt, now_datetime
 from erpnext.stock.doctype.shipment.shipment import get_company_contact
+from erpnext_shipping.erpnext_shipping.metrics import set_thread_site
 from erpnext_shipping.erpnext_shipping.utils import (
     get_address,
+    get_addresses,
+    get_carrier_config,
     get_contact,
+    is_final_tracking_status,
     match_parcel_service_type_carrier,
+    normalize_tracking_status,
+    show_error_alert,
 )
+from erpnext_shipping.erpnext_shipping.labels import get_shipping_label, queue_label_prefetch
+from erpnext_shipping.erpnext_shipping.rate_cache import RateQuoteCache
 from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import (
     ARAMEX_PROVIDER,
     AramexUtils,
@@ -22,39 +34,112 @@ from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import (
 from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import (
     DELHIVERY_PROVIDER,
     DelhiveryUtils,
+    queue_manifest_job,
 )
 
+# Seconds the carriers get to answer a rate request, see `shipping_rate_deadline`
+DEFAULT_RATE_DEADLINE = 4
+
 
 @frappe.whitelist()
 def fetch_shipping_services(
     pickup_address_name,
     delivery_address_name,
+    shipment_parcel=None,
+    pickup_date=None,
 ):
     # Return Shipping Rates for the various Shipping Providers
     shipment_services = [{"carrier": "Custom"}]
-    aramex_enabled = frappe.db.get_single_value("Aramex", "enabled")
+    aramex_enabled = get_carrier_config(ARAMEX_PROVIDER)["enabled"]
     pickup_address = get_address(pickup_address_name)
     delivery_address = get_address(delivery_address_name)
+    carriers = []
 
     if (
         pickup_address.get("country") == "India"
         and delivery_address.get("country") == "India"
     ):
-        delhivery_enabled = frappe.db.get_single_value("Delhivery", "enabled")
+        delhivery_enabled = get_carrier_config(DELHIVERY_PROVIDER)["enabled"]
         if delhivery_enabled:
-            shipment_services.append(
-                {
-                    "carrier": DELHIVERY_PROVIDER,
-                }
-            )
+            carriers.append(DELHIVERY_PROVIDER)
 
     else:
         if aramex_enabled:
-            shipment_services.append({"carrier": ARAMEX_PROVIDER})
+            carriers.append(ARAMEX_PROVIDER)
+
+    if shipment_parcel:
+        shipment_services.extend(
+            get_shipping_rates(
+                carriers, pickup_address, delivery_address, shipment_parcel, pickup_date
+            )
+        )
+    else:
+        shipment_services.extend({"carrier": carrier} for carrier in carriers)
 
     return shipment_services
 
 
+def get_shipping_rates(carriers, pickup_address, delivery_address, shipment_parcel, pickup_date):
+    # Quote all carriers in parallel and return what arrived within the deadline,
+    # cheapest first. Carriers without a quote are listed last, without a price.
+    deadline = flt(frappe.conf.get("shipping_rate_deadline")) or DEFAULT_RATE_DEADLINE
+    deadline_at = time.monotonic() + deadline
+    quotes, pending = {}, {}
+    executor = ThreadPoolExecutor(
+        max_workers=len(carriers) or 1, initializer=set_thread_site, initargs=(frappe.local.site,)
+    )
+    try:
+        for carrier in carriers:
+            carrier_utils = get_carrier_utils(carrier)
+            rate_request = carrier_utils.get_rate_request(
+                pickup_address, delivery_address, shipment_parcel, pickup_date
+            )
+            if not rate_request:
+                continue
+
+            rate_cache = RateQuoteCache(carrier)
+            services = rate_cache.get(rate_request.lane)
+            if services is not None:
+                quotes[carrier] = services
+                continue
+
+            if carrier == DELHIVERY_PROVIDER:
+                # A token login counts against the deadline like the quote itself
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    continue
+                carrier_utils.authenticate(deadline=remaining)
+            future = executor.submit(carrier_utils.request_rates, rate_request.payload)
+            pending[future] = (carrier, carrier_utils, rate_request, rate_cache)
+
+        done, not_done = wait(list(pending), timeout=max(deadline_at - time.monotonic(), 0))
+        for future in done:
+            carrier, carrier_utils, rate_request, rate_cache = pending[future]
+            try:
+                services = carrier_utils.get_services_from_response(future.result())
+            except Exception:
+                show_error_alert(_("fetching {0} prices").format(carrier))
+                continue
+            if services:
+                rate_cache.set(rate_request.lane, services)
+            quotes[carrier] = services
+    finally:
+        # Late answers are dropped, their requests end with the transport timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    rates = [service for services in quotes.values() for service in services]
+    rates.sort(key=lambda service: flt(service.get("total_price")))
+    rates.extend({"carrier": carrier} for carrier in carriers if not quotes.get(carrier))
+    return rates
+
+
+def get_carrier_utils(carrier):
+    if carrier == ARAMEX_PROVIDER:
+        return AramexUtils()
+    if carrier == DELHIVERY_PROVIDER:
+        return DelhiveryUtils()
+
+
 @frappe.whitelist()
 def create_shipment(
     shipment,
@@ -78,20 +163,16 @@ def create_shipment(
 ):
     # Create Shipment for the selected provider
     service_info = json.loads(service_data)
-    shipment_info, pickup_contact, delivery_contact = None, None, None
+    shipment_info = None
     pickup_address = get_address(pickup_address_name)
     delivery_address = get_address(delivery_address_name)
-
-    if pickup_from_type != "Company":
-        pickup_contact = get_contact(pickup_contact_name)
-    else:
-        pickup_contact = get_company_contact(user=pickup_contact_name)
-        pickup_contact["company_name"] = pickup_company_name
-
-    if delivery_to_type != "Company":
-        delivery_contact = get_contact(delivery_contact_name)
-    else:
-        delivery_contact = get_company_contact(user=pickup_contact_name)
+    pickup_contact, delivery_contact = get_shipment_contacts(
+        pickup_from_type,
+        delivery_to_type,
+        pickup_contact_name,
+        delivery_contact_name,
+        pickup_company_name,
+    )
 
     if service_info["carrier"] == ARAMEX_PROVIDER:
         aramex = AramexUtils()
@@ -127,36 +208,202 @@ def create_shipment(
             "awb_number",
             "tracking_status",
         ]
-        for field in fields:
-            frappe.db.set_value("Shipment", shipment, field, service_info.get(field))
-
-        frappe.db.set_value("Shipment", shipment, "status", "Booked")
-        frappe.db.set_value("Shipment", shipment, "service_provider", "Local")
-        frappe.db.set_value("Shipment", shipment, "shipment_id", service_info.get("awb_number"))
+        values = {field: service_info.get(field) for field in fields}
+        values.update(
+            {
+                "status": "Booked",
+                "service_provider": "Local",
+                "shipment_id": service_info.get("awb_number"),
+            }
+        )
+        set_shipment_state(shipment, values)
 
     if shipment_info:
-        fields = [
-            "shipment_id",
-            "carrier",
-            "carrier_service",
-            "shipment_label",
-            "awb_number",
-        ]
-        for field in fields:
-            frappe.db.set_value("Shipment", shipment, field, shipment_info.get(field))
-        frappe.db.set_value("Shipment", shipment, "status", "Booked")
-        frappe.db.set_value("Shipment", shipment, "service_provider", "Partner")
-
-        if delivery_notes:
-            update_delivery_note(
-                delivery_notes=delivery_notes, shipment_info=shipment_info
-            )
+        set_booked_shipment(shipment, shipment_info, delivery_notes)
 
     return shipment_info
 
 
+def get_shipment_contacts(
+    pickup_from_type,
+    delivery_to_type,
+    pickup_contact_name,
+    delivery_contact_name,
+    pickup_company_name,
+):
+    if pickup_from_type != "Company":
+        pickup_contact = get_contact(pickup_contact_name)
+    else:
+        pickup_contact = get_company_contact(user=pickup_contact_name)
+        pickup_contact["company_name"] = pickup_company_name
+
+    if delivery_to_type != "Company":
+        delivery_contact = get_contact(delivery_contact_name)
+    else:
+        delivery_contact = get_company_contact(user=pickup_contact_name)
+
+    return pickup_contact, delivery_contact
+
+
+def set_booked_shipment(shipment, shipment_info, delivery_notes=None):
+    # Store the booking returned by a partner carrier on the Shipment and its Delivery Notes
+    fields = [
+        "shipment_id",
+        "carrier",
+        "carrier_service",
+        "shipment_label",
+        "awb_number",
+    ]
+    values = {field: shipment_info.get(field) for field in fields}
+    values.update({"status": "Booked", "service_provider": "Partner"})
+
+    if shipment_info.get("job_id"):
+        values.update(
+            {
+                "delhivery_job_id": shipment_info["job_id"],
+                "tracking_status": shipment_info["tracking_status"],
+            }
+        )
+    set_shipment_state(shipment, values)
+
+    if shipment_info.get("job_id"):
+        queue_manifest_job(shipment_info["job_id"])
+    else:
+        queue_label_prefetch(
+            shipment, shipment_info.get("carrier"), shipment_info.get("awb_number")
+        )
+
+    if delivery_notes:
+        update_delivery_note(delivery_notes=delivery_notes, shipment_info=shipment_info)
+
+
 @frappe.whitelist()
-def print_shipping_label(carrier, awb_number):
+def create_shipments_bulk(shipments):
+    """Books the given Shipments with Aramex, many Shipments per CreateShipments call.
+
+    Only Shipments with Aramex as their Carrier are booked. Returns the result of
+    every Shipment, with an `error` for the ones that could not be booked so that one
+    bad Shipment does not fail the others.
+    """
+    if isinstance(shipments, string_types):
+        shipments = json.loads(shipments)
+
+    allowed = set(
+        frappe.get_list("Shipment", filters={"name": ["in", shipments]}, pluck="name")
+    )
+    results = {}
+    docs = {}
+    for shipment in shipments:
+        if shipment not in allowed:
+            results[shipment] = {"error": _("Not permitted")}
+            continue
+        doc = frappe.get_doc("Shipment", shipment)
+        if doc.docstatus != 1 or doc.status == "Booked":
+            results[shipment] = {"error": _("Only submitted, unbooked Shipments can be booked")}
+            continue
+        if doc.carrier != ARAMEX_PROVIDER:
+            results[shipment] = {
+                "error": _("Carrier is {0}, only Aramex Shipments can be booked in bulk").format(
+                    doc.carrier or _("not set")
+                )
+            }
+            continue
+        docs[shipment] = doc
+
+    addresses = get_addresses(
+        [doc.pickup_address_name for doc in docs.values()]
+        + [doc.delivery_address_name for doc in docs.values()]
+    )
+    bookings = []
+    delivery_notes = {}
+    for shipment, doc in docs.items():
+        try:
+            bookings.append(get_shipment_booking(doc, addresses))
+        except Exception as e:
+            results[shipment] = {"error": str(e)}
+            continue
+        delivery_notes[shipment] = [row.delivery_note for row in doc.shipment_delivery_note]
+
+    if bookings:
+        booked = AramexUtils().create_shipments(bookings)
+        results.update(booked)
+        for shipment, shipment_info in booked.items():
+            if shipment_info.get("error"):
+                continue
+            # Bookings exist at Aramex now, keep each one even if a later one fails
+            try:
+                set_booked_shipment(shipment, shipment_info, delivery_notes.get(shipment))
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(
+                    title=_("Could not save the Aramex booking of Shipment {0}").format(shipment),
+                    message=frappe.get_traceback(),
+                    reference_doctype="Shipment",
+                    reference_name=shipment,
+                )
+                frappe.db.commit()
+                error = _("Booked with Aramex as {0} but not saved, do not book it again")
+                results[shipment] = dict(
+                    shipment_info, error=error.format(shipment_info.get("awb_number"))
+                )
+
+    return [dict(results[shipment], shipment=shipment) for shipment in shipments]
+
+
+def get_shipment_booking(doc, addresses=None):
+    # Arguments of `AramexUtils.generate_shipment_entry` for a Shipment document,
+    # addresses missing from the preloaded `addresses` are loaded one by one
+    addresses = addresses or {}
+    delivery_company_name = {
+        "Customer": doc.delivery_customer,
+        "Supplier": doc.delivery_supplier,
+        "Company": doc.delivery_company,
+    }.get(doc.delivery_to_type)
+    if not delivery_company_name:
+        frappe.throw(_("Please select Delivery Details"))
+
+    pickup_contact, delivery_contact = get_shipment_contacts(
+        doc.pickup_from_type,
+        doc.delivery_to_type,
+        doc.pickup_contact_person
+        if doc.pickup_from_type == "Company"
+        else doc.pickup_contact_name,
+        doc.delivery_contact_name,
+        doc.pickup_company if doc.pickup_from_type == "Company" else "",
+    )
+    shipment_parcel = [
+        {field: row.get(field) for field in ("length", "width", "height", "weight", "count")}
+        for row in doc.shipment_parcel
+    ]
+    return {
+        "reference": doc.name,
+        "pickup_address": addresses.get(doc.pickup_address_name)
+        or get_address(doc.pickup_address_name),
+        "pickup_contact": pickup_contact,
+        "delivery_address": addresses.get(doc.delivery_address_name)
+        or get_address(doc.delivery_address_name),
+        "delivery_contact": delivery_contact,
+        "pickup_date": doc.pickup_date,
+        "pickup_time": doc.pickup_from,
+        "shipment_parcel": json.dumps(shipment_parcel),
+        "description_of_content": doc.description_of_content,
+        "value_of_goods": doc.value_of_goods,
+        "delivery_company_name": delivery_company_name,
+    }
+
+
+@frappe.whitelist()
+def print_shipping_label(carrier, awb_number, shipment=None, refresh=False):
+    # Labels of a Shipment are served from its cached label files, always those of
+    # its own carrier and AWB whatever the client sent
+    if shipment:
+        frappe.has_permission("Shipment", doc=shipment, throw=True)
+        carrier, awb_number = frappe.db.get_value("Shipment", shipment, ["carrier", "awb_number"])
+        if not awb_number:
+            frappe.throw(_("Shipment {0} has no AWB Number to print a label for").format(shipment))
+        return get_shipping_label(shipment, carrier, awb_number, refresh=cint(refresh))
+
     if carrier == ARAMEX_PROVIDER:
         aramex = AramexUtils()
         shipping_label = aramex.get_label(awb_number)
@@ -166,11 +413,21 @@ def print_shipping_label(carrier, awb_number):
     return shipping_label
 
 
+@frappe.whitelist()
+def print_shipping_labels(shipments):
+    # Stream the labels of many Shipments as a single PDF
+    from erpnext_shipping.erpnext_shipping.labels import get_merged_labels_response
+
+    if isinstance(shipments, string_types):
+        shipments = json.loads(shipments)
+    return get_merged_labels_response(shipments)
+
+
 @frappe.whitelist()
 def update_tracking(shipment, carrier, shipment_id, awb_number, tracking_status=None):
     # Update Tracking info in Shipment
-    prev_shipment = frappe.get_doc("Shipment", shipment)
     tracking_data = None
+    values = {}
     if carrier == ARAMEX_PROVIDER:
         aramex = AramexUtils()
         tracking_data = aramex.get_tracking_data(awb_number)
@@ -181,42 +438,215 @@ def update_tracking(shipment, carrier, shipment_id, awb_number, tracking_status=
         tracking_data = delhivery.get_tracking_data(awb_number, lrnum=shipment_id)
 
     else:
-        frappe.db.set_value("Shipment", shipment, "tracking_status", tracking_status)
+        values = {
+            "tracking_status": tracking_status,
+            "tracking_closed": cint(is_final_tracking_status(tracking_status)),
+        }
 
     if tracking_data:
-        # fields = ['awb_number', 'tracking_status',
-        #           'tracking_status_info', 'tracking_url']
-        fields = ["tracking_status", "tracking_url"]
-        for field in fields:
-            frappe.db.set_value("Shipment", shipment, field, tracking_data.get(field))
+        previous, changed = set_tracking_info(shipment, tracking_data)
+    else:
+        previous, changed = set_shipment_state(shipment, values)
+        if changed:
+            notify_tracking_update(shipment, previous)
+
+    if tracking_data and changed:
+        update_shipment_delivery_notes({shipment: dict(tracking_data, awb_number=awb_number)})
+
+
+@frappe.whitelist()
+def update_tracking_bulk(shipments):
+    # Queue a tracking update of the selected Shipments the user may read
+    if isinstance(shipments, string_types):
+        shipments = json.loads(shipments)
+
+    shipments = frappe.get_list(
+        "Shipment",
+        filters={"name": ["in", shipments], "shipment_id": ["!=", ""]},
+        pluck="name",
+    )
+    if shipments:
+        frappe.enqueue(
+            "erpnext_shipping.erpnext_shipping.shipping.refresh_shipments_tracking",
+            queue="long",
+            shipments=shipments,
+        )
+    return len(shipments)
+
+
+def refresh_shipments_tracking(shipments):
+    # Background job of `update_tracking_bulk`
+    from erpnext_shipping.erpnext_shipping.tracking import refresh_tracking
+
+    shipments = frappe.get_all(
+        "Shipment",
+        filters={"name": ["in", shipments]},
+        fields=[
+            "name",
+            "carrier",
+            "shipment_id",
+            "awb_number",
+            "creation",
+            "tracking_no_change_count",
+        ],
+    )
+    refresh_tracking(shipments)
 
-        frappe.db.set_value("Shipment", shipment, "status", "Booked")
 
+def set_tracking_info(shipment, tracking_data):
+    """Records the tracking event and updates the Shipment if its status changed.
+
+    Returns two dicts with the previous and the new value of every changed field.
+    """
+    add_tracking_event(shipment, tracking_data)
+
+    current = frappe.db.get_value("Shipment", shipment, "tracking_status")
+    if normalize_tracking_status(current) == normalize_tracking_status(
+        tracking_data.get("tracking_status")
+    ):
+        return frappe._dict(), frappe._dict()
+
+    previous, changed = set_shipment_state(shipment, get_tracking_values(tracking_data))
+    notify_tracking_update(shipment, previous)
+    return previous, changed
+
+
+def add_tracking_event(shipment, tracking_data):
+    # Events are keyed by Shipment, carrier timestamp and status, so polling the
+    # same status again inserts nothing
+    tracking_status = tracking_data.get("tracking_status")
+    if not tracking_status:
+        return
+
+    event_timestamp = tracking_data.get("event_time") or ""
+    name = hashlib.sha1(
+        "|".join([shipment, event_timestamp, tracking_status]).encode()
+    ).hexdigest()
+    now = now_datetime()
+    frappe.db.bulk_insert(
+        "Shipment Tracking Event",
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "owner",
+            "modified_by",
+            "shipment",
+            "tracking_status",
+            "event_timestamp",
+        ],
+        values=[
+            (
+                name,
+                now,
+                now,
+                frappe.session.user,
+                frappe.session.user,
+                shipment,
+                tracking_status,
+                event_timestamp,
+            )
+        ],
+        ignore_duplicates=True,
+    )
+
+
+def get_tracking_values(tracking_data):
+    # fields = ['awb_number', 'tracking_status',
+    #           'tracking_status_info', 'tracking_url']
+    fields = ["tracking_status", "tracking_url"]
+    values = {field: tracking_data.get(field) for field in fields}
+    values["status"] = "Booked"
+    values["tracking_closed"] = cint(is_final_tracking_status(values["tracking_status"]))
+    return values
+
+
+def set_shipment_state(shipment, values):
+    """Writes the changed `values` to the Shipment in a single UPDATE.
+
+    Returns two dicts with the previous and the new value of every changed field.
+    """
+    if not values:
+        return frappe._dict(), frappe._dict()
+
+    current = frappe.db.get_value("Shipment", shipment, list(values), as_dict=1) or {}
+    # None and "" are the same empty value once stored
+    changed = {
+        field: value
+        for field, value in values.items()
+        if (current.get(field) or None) != (value or None)
+    }
+    if changed:
+        frappe.db.set_value("Shipment", shipment, changed)
+
+    previous = frappe._dict({field: current.get(field) for field in changed})
+    return previous, frappe._dict(changed)
+
+
+def notify_tracking_update(shipment, previous):
+    # The previous state is rebuilt from the current document and the
+    # values that changed instead of loading the document twice
     shipment = frappe.get_doc("Shipment", shipment)
+    prev_shipment = frappe.get_doc(shipment.as_dict())
+    prev_shipment.update(previous)
     send_delivery_status_update_notification(shipment, prev_shipment)
 
-    # if delivery_notes:
-    #     update_delivery_note(delivery_notes=delivery_notes, tracking_info=tracking_data)
-
 
 def update_delivery_note(delivery_notes, shipment_info=None, tracking_info=None):
-    # Update Shipment Info in Delivery Note
-    # Using db_set since some services might not exist
+    # Update Shipment Info in Delivery Notes with a single UPDATE, without loading them
+    # Only fields that exist are set since some might not have been created
     if isinstance(delivery_notes, string_types):
         delivery_notes = json.loads(delivery_notes)
 
     delivery_notes = list(set(delivery_notes))
 
-    for delivery_note in delivery_notes:
-        dl_doc = frappe.get_doc("Delivery Note", delivery_note)
-        if shipment_info:
-            dl_doc.db_set("delivery_type", "Parcel Service")
-            dl_doc.db_set("parcel_service", shipment_info.get("carrier"))
-            dl_doc.db_set("parcel_service_type", shipment_info.get("carrier_service"))
-        if tracking_info:
-            dl_doc.db_set("tracking_number", tracking_info.get("awb_number"))
-            dl_doc.db_set("tracking_url", tracking_info.get("tracking_url"))
-            dl_doc.db_set("tracking_status", tracking_info.get("tracking_status"))
-            dl_doc.db_set(
-                "tracking_status_info", tracking_info.get("tracking_status_info")
-            )
+    values = {}
+    if shipment_info:
+        values.update(
+            {
+                "delivery_type": "Parcel Service",
+                "parcel_service": shipment_info.get("carrier"),
+                "parcel_service_type": shipment_info.get("carrier_service"),
+            }
+        )
+    if tracking_info:
+        values.update(
+            {
+                "tracking_number": tracking_info.get("awb_number"),
+                "tracking_url": tracking_info.get("tracking_url"),
+                "tracking_status": tracking_info.get("tracking_status"),
+                "tracking_status_info": tracking_info.get("tracking_status_info"),
+            }
+        )
+
+    meta = frappe.get_meta("Delivery Note")
+    values = {field: value for field, value in values.items() if meta.has_field(field)}
+    if not delivery_notes or not values:
+        return
+
+    delivery_note = frappe.qb.DocType("Delivery Note")
+    query = frappe.qb.update(delivery_note)
+    for field, value in values.items():
+        query = query.set(delivery_note[field], value)
+    query.set(delivery_note.modified, now_datetime()).set(
+        delivery_note.modified_by, frappe.session.user
+    ).where(delivery_note.name.isin(delivery_notes)).run()
+
+
+def update_shipment_delivery_notes(tracking_info):
+    # Copy tracking info to the Delivery Notes of each Shipment, `tracking_info`
+    # is a dict of tracking info by Shipment name
+    if not tracking_info:
+        return
+
+    delivery_notes = defaultdict(list)
+    for row in frappe.get_all(
+        "Shipment Delivery Note",
+        filters={"parenttype": "Shipment", "parent": ["in", list(tracking_info)]},
+        fields=["parent", "delivery_note"],
+    ):
+        delivery_notes[row.parent].append(row.delivery_note)
+
+    for shipment, shipment_tracking_info in tracking_info.items():
+        if delivery_notes.get(shipment):
+            update_delivery_note(delivery_notes[shipment], tracking_info=shipment_tracking_info)
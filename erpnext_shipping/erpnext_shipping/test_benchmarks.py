@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe and Contributors
+# See license.txt
+"""Micro-benchmarks of payload building, response parsing and Delivery Note updates.
+
+Run them with `bench --site test_site run-tests --module
+erpnext_shipping.erpnext_shipping.test_benchmarks`. No carrier is called, the
+carrier utils are built from a fixed config instead of the settings doctypes.
+
+Every benchmark is timed relative to a fixed pure Python reference workload timed
+in the same run, so its baseline in benchmark_baselines.json holds for any
+machine. A benchmark fails when its relative cost is higher than its baseline by
+more than the threshold of that file, which the SHIPPING_BENCHMARK_THRESHOLD
+environment variable overrides (0.5 = 50% slower). Run with
+SHIPPING_BENCHMARK_UPDATE=1 to record the baselines of new or changed benchmarks,
+and with SHIPPING_BENCHMARK_VERBOSE=1 to print the cost of every benchmark.
+
+Delivery Note updates depend on the database rather than the CPU, they are checked
+against the update of a single note instead.
+"""
+from __future__ import unicode_literals
+import json
+import os
+import random
+import timeit
+import unittest
+
+import frappe
+from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import AramexUtils
+from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import (
+    DELHIVERY_TRACKING_STATUS_MAP,
+    DelhiveryUtils,
+)
+from erpnext_shipping.erpnext_shipping.shipping import update_delivery_note
+from erpnext_shipping.erpnext_shipping.utils import normalize_tracking_status
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baselines.json")
+# Seconds each benchmark is timed for per repeat, the best repeat is kept
+BENCHMARK_TIME = 0.2
+BENCHMARK_REPEAT = 5
+# Times the cost of updating one Delivery Note that updating 200 may take, a
+# single UPDATE stays far below it while updating them one by one does not
+DELIVERY_NOTE_BATCH_LIMIT = 50
+
+ARAMEX_CONFIG = {
+    "enabled": 1,
+    "user_name": "benchmark@example.com",
+    "password": "benchmark",
+    "account_number": "20016",
+    "account_pin": "331421",
+    "account_entity": "AMM",
+    "account_country_code": "JO",
+}
+DELHIVERY_CONFIG = {
+    "enabled": 1,
+    "tracking_page_url": "https://www.delhivery.com/track/package",
+}
+ARAMEX_TRACKING_STATUSES = (
+    "Record created.",
+    "Picked Up From Shipper",
+    "Received at Origin Facility",
+    "Departed Origin Facility",
+    "Out for Delivery",
+    "Delivered",
+)
+
+
+def get_address(city, pincode, state):
+    return frappe._dict(
+        name=f"{city} Warehouse-Billing",
+        address_title=f"{city} Warehouse",
+        address_line1="Plot 42, Industrial Area Phase 2",
+        address_line2="Near Metro Station",
+        city=city,
+        state=state,
+        pincode=pincode,
+        country="India",
+        country_code="IN",
+    )
+
+
+def get_contact(first_name, last_name):
+    email = f"{first_name.lower()}@example.com"
+    return frappe._dict(
+        first_name=first_name,
+        last_name=last_name,
+        company_name="Example Traders",
+        phone="+91 98765 43210",
+        email=email,
+        email_id=email,
+    )
+
+
+def get_shipment_parcel(pieces):
+    # Mixed parcel rows of up to 10 pieces each adding up to `pieces`
+    rng = random.Random(pieces)
+    parcels = []
+    while pieces > 0:
+        count = min(pieces, rng.randint(1, 10))
+        parcels.append(
+            {
+                "length": rng.randint(10, 120),
+                "width": rng.randint(10, 80),
+                "height": rng.randint(5, 60),
+                "weight": round(rng.uniform(0.2, 30), 2),
+                "count": count,
+            }
+        )
+        pieces -= count
+    return parcels
+
+
+def reference_workload():
+    # Builds and serializes rows like the payload builders do, never changes
+    rows = [
+        {"idx": idx, "length": idx % 120, "weight": idx / 7, "unit": "CM"} for idx in range(200)
+    ]
+    return json.dumps({"Items": rows, "Count": len(rows)})
+
+
+def get_relative_cost(function, reference=reference_workload):
+    # Best time per call of `function` over that of `reference`, timed in alternating
+    # repeats so both run at the same CPU clock and load
+    timers = []
+    for timed in (reference, function):
+        timer = timeit.Timer(timed)
+        number, elapsed = timer.autorange()
+        timers.append((timer, max(1, int(number * BENCHMARK_TIME / max(elapsed, 1e-9)))))
+
+    best = [float("inf")] * len(timers)
+    for repeat in range(BENCHMARK_REPEAT):
+        for idx, (timer, number) in enumerate(timers):
+            best[idx] = min(best[idx], timer.timeit(number) / number)
+    return best[1] / best[0]
+
+
+def get_utils(utils_class, config):
+    # Skips __init__, it reads the settings doctypes and fetches a token
+    utils = utils_class.__new__(utils_class)
+    utils.config = frappe._dict(config)
+    utils.enabled = 1
+    utils.token = "benchmark"
+    return utils
+
+
+class TestBenchmarks(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(BASELINES_PATH) as f:
+            cls.baselines = json.load(f)
+        cls.threshold = float(
+            os.environ.get("SHIPPING_BENCHMARK_THRESHOLD") or cls.baselines["threshold"]
+        )
+        cls.update = bool(os.environ.get("SHIPPING_BENCHMARK_UPDATE"))
+        cls.verbose = bool(os.environ.get("SHIPPING_BENCHMARK_VERBOSE"))
+        cls.results = {}
+
+        cls.aramex = get_utils(AramexUtils, ARAMEX_CONFIG)
+        cls.delhivery = get_utils(DelhiveryUtils, DELHIVERY_CONFIG)
+        cls.pickup_address = get_address("Mumbai", "400093", "Maharashtra")
+        cls.delivery_address = get_address("Bengaluru", "560001", "Karnataka")
+        cls.pickup_contact = get_contact("Asha", "Rao")
+        cls.delivery_contact = get_contact("Vikram", "Iyer")
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.update and cls.results:
+            cls.baselines["baselines"].update(cls.results)
+            cls.baselines["baselines"] = dict(sorted(cls.baselines["baselines"].items()))
+            with open(BASELINES_PATH, "w") as f:
+                json.dump(cls.baselines, f, indent=1)
+                f.write("\n")
+
+    def assertNotRegressed(self, name, function):
+        """Times `function` and compares its cost relative to the reference with the baseline."""
+        cost = float(f"{get_relative_cost(function):.4g}")
+        self.results[name] = cost
+
+        # A failed benchmark does not stop the others of the same test
+        with self.subTest(name):
+            if self.update:
+                self.report(f"{name}: {cost:.4g}× the reference, recorded as the baseline")
+                return
+
+            baseline = self.baselines["baselines"].get(name)
+            self.assertTrue(
+                baseline, f"{name} has no baseline, record it with SHIPPING_BENCHMARK_UPDATE=1"
+            )
+            change = cost / baseline - 1
+            self.report(f"{name}: {cost:.4g}× the reference ({change:+.1%} against the baseline)")
+            self.assertLessEqual(
+                change,
+                self.threshold,
+                f"{name} costs {cost:.4g}× the reference, "
+                f"{change:.1%} more than its baseline of {baseline:.4g}×",
+            )
+
+    def report(self, message):
+        if self.verbose:
+            print(f"\n{message}")
+
+    def test_aramex_create_shipment_payload(self):
+        for pieces in (1, 500):
+            shipment_parcel = json.dumps(get_shipment_parcel(pieces))
+            self.assertNotRegressed(
+                f"aramex_create_shipment_payload_{pieces}_pieces",
+                lambda: self.aramex.generate_create_shipment_payload(
+                    self.pickup_address,
+                    self.pickup_contact,
+                    self.delivery_address,
+                    self.delivery_contact,
+                    "2026-10-19",
+                    "10:30:00",
+                    shipment_parcel,
+                    "Books",
+                    12500,
+                    "Example Retail",
+                ),
+            )
+
+    def test_aramex_rate_calculation_payload(self):
+        for pieces in (1, 500):
+            shipment_parcel = json.dumps(get_shipment_parcel(pieces))
+            self.assertNotRegressed(
+                f"aramex_rate_calculation_payload_{pieces}_pieces",
+                lambda: self.aramex.generate_rate_calculation_payload(
+                    self.pickup_address, self.delivery_address, shipment_parcel
+                ),
+            )
+
+    def test_aramex_parcel_list(self):
+        for pieces in (1, 500):
+            shipment_parcel = get_shipment_parcel(pieces)
+            self.assertEqual(len(self.aramex.get_parcel_list(shipment_parcel)), pieces)
+            self.assertNotRegressed(
+                f"aramex_parcel_list_{pieces}_pieces",
+                lambda: self.aramex.get_parcel_list(shipment_parcel),
+            )
+
+    def test_aramex_shipping_date(self):
+        self.assertNotRegressed(
+            "aramex_shipping_date",
+            lambda: self.aramex.getShippingDate("2026-10-19 10:30:00"),
+        )
+
+    def test_delhivery_create_shipment_payload(self):
+        for pieces in (1, 500):
+            shipment_parcel = json.dumps(get_shipment_parcel(pieces))
+            self.assertNotRegressed(
+                f"delhivery_create_shipment_payload_{pieces}_pieces",
+                lambda: self.delhivery.generate_create_shipment_payload(
+                    self.pickup_address,
+                    self.delivery_address,
+                    self.delivery_contact,
+                    shipment_parcel,
+                    "Books",
+                    12500,
+                    "Example Retail",
+                ),
+            )
+
+    def test_tracking_status_mapping(self):
+        # A tracking run of 500 Shipments, mapped and normalized like set_tracking_info does
+        aramex_results = [
+            {"Value": [{"UpdateDescription": status, "UpdateDateTime": "2026-10-19T10:30:00"}]}
+            for status in ARAMEX_TRACKING_STATUSES * 84
+        ][:500]
+        delhivery_results = [
+            {"data": {"status": status}} for status in list(DELHIVERY_TRACKING_STATUS_MAP) * 63
+        ][:500]
+
+        self.assertNotRegressed(
+            "aramex_tracking_status_500_shipments",
+            lambda: [
+                normalize_tracking_status(
+                    self.aramex.get_tracking_info("44149733542", result)["tracking_status"]
+                )
+                for result in aramex_results
+            ],
+        )
+        self.assertNotRegressed(
+            "delhivery_tracking_status_500_shipments",
+            lambda: [
+                normalize_tracking_status(
+                    self.delhivery.get_tracking_info("1490810095125", result)["tracking_status"]
+                )
+                for result in delhivery_results
+            ],
+        )
+
+    def test_update_delivery_note(self):
+        # Writes to Delivery Notes inserted without validation, rolled back afterwards
+        delivery_notes = [f"BENCH-DN-{idx:05d}" for idx in range(200)]
+        now = frappe.utils.now_datetime()
+        frappe.db.bulk_insert(
+            "Delivery Note",
+            fields=["name", "creation", "modified", "owner", "modified_by", "docstatus"],
+            values=[
+                (name, now, now, "Administrator", "Administrator", 1) for name in delivery_notes
+            ],
+        )
+        shipment_info = {"carrier": "Aramex", "carrier_service": "Priority Parcel Express"}
+        tracking_info = {
+            "awb_number": "44149733542",
+            "tracking_url": "https://www.aramex.com/track/results?ShipmentNumber=44149733542",
+            "tracking_status": "SHIPPED",
+            "tracking_status_info": "Departed Origin Facility",
+        }
+
+        def update(count):
+            return lambda: update_delivery_note(
+                delivery_notes[:count], shipment_info=shipment_info, tracking_info=tracking_info
+            )
+
+        try:
+            cost = get_relative_cost(update(200), reference=update(1))
+        finally:
+            frappe.db.rollback()
+
+        self.report(f"update_delivery_note_200_notes: {cost:.1f}× one note")
+        self.assertLess(
+            cost,
+            DELIVERY_NOTE_BATCH_LIMIT,
+            f"Updating 200 Delivery Notes costs {cost:.1f}× updating one",
+        )
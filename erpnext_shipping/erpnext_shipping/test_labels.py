@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe and Contributors
+# See license.txt
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+from pypdf import PdfReader
+from erpnext_shipping.erpnext_shipping.labels import MergedPdfWriter
+from erpnext_shipping.erpnext_shipping.loadtest.mock_carrier import get_label_pdf
+
+
+class TestMergedPdfWriter(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.label_dir = tempfile.mkdtemp()
+        cls.paths = []
+        for idx in range(1000):
+            path = os.path.join(cls.label_dir, f"label-{idx}.pdf")
+            with open(path, "wb") as f:
+                f.write(get_label_pdf(f"44{idx:09d}"))
+            cls.paths.append(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.label_dir)
+
+    def merge(self, paths):
+        # Returns the merged document and the peak memory allocated while merging
+        merged = tempfile.TemporaryFile()
+        tracemalloc.start()
+        try:
+            writer = MergedPdfWriter(merged)
+            for path in paths:
+                writer.add_document(path)
+            writer.close()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        merged.seek(0)
+        return merged, peak
+
+    def test_merge_keeps_pages_in_order(self):
+        merged, peak = self.merge(self.paths)
+        with merged:
+            reader = PdfReader(merged)
+            self.assertEqual(len(reader.pages), 1000)
+            for idx in (0, 1, 500, 999):
+                self.assertIn(f"AWB 44{idx:09d}", reader.pages[idx].extract_text())
+
+    def test_memory_does_not_grow_with_labels(self):
+        merged, few_peak = self.merge(self.paths[:100])
+        merged.close()
+        merged, many_peak = self.merge(self.paths)
+        merged.close()
+        # Only the object offsets and page ids are kept from one label to the next,
+        # collecting the pages in a PdfWriter takes about 17 KB per label
+        self.assertLess((many_peak - few_peak) / 900, 1024)
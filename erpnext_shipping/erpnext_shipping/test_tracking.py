@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe and Contributors
+# See license.txt
+from __future__ import unicode_literals
+import json
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import frappe
+from erpnext_shipping.erpnext_shipping import shipping, tracking
+from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import ARAMEX_PROVIDER
+from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import DELHIVERY_PROVIDER
+
+
+class JobDied(Exception):
+    pass
+
+
+class FakeAramex:
+    def request_tracking_data(self, awb_numbers):
+        return {
+            "TrackingResults": [{"Key": awb_number, "Value": []} for awb_number in awb_numbers]
+        }
+
+    def get_tracking_info(self, awb_number, tracking_result):
+        return {"tracking_status": "SHIPPED"}
+
+
+class FakeDelhivery:
+    def request_tracking_data(self, lrnum):
+        return frappe._dict(status_code=200, text=json.dumps({"data": {"status": "IN_TRANSIT"}}))
+
+    def get_tracking_info(self, awb_number, tracking_data):
+        return {"tracking_status": "SHIPPED"}
+
+
+class TestTrackingShard(unittest.TestCase):
+    def setUp(self):
+        # Mixed carriers in name order, Aramex ones wait for a full TrackShipments chunk
+        self.shipments = [
+            frappe._dict(
+                name=f"SHP-{idx:04d}",
+                carrier=ARAMEX_PROVIDER if idx % 2 else DELHIVERY_PROVIDER,
+                shipment_id=f"LR{idx}",
+                awb_number=f"{idx}",
+            )
+            for idx in range(240)
+        ]
+        self.checkpoints = {}
+        self.written = []
+        self.committed = set()
+        self.commits_before_death = None
+
+    def stream_open_shipments(self, shard=None, shards=None, after=None):
+        return (shipment for shipment in self.shipments if not after or shipment.name > after)
+
+    def set_tracking_info(self, shipment, tracking_data):
+        self.written.append(shipment)
+        return None, {"tracking_status"}
+
+    def commit(self):
+        if self.commits_before_death is not None:
+            if not self.commits_before_death:
+                raise JobDied
+            self.commits_before_death -= 1
+        self.committed.update(self.written)
+        self.written = []
+
+    def refresh_shard(self):
+        with patch.multiple(
+            tracking,
+            stream_open_shipments=self.stream_open_shipments,
+            get_carrier_config=lambda carrier: {"enabled": 1},
+            schedule_next_poll=lambda *args: None,
+            get_shard_checkpoint=lambda run_id, shard: dict(self.checkpoints.get(shard, {})),
+            set_shard_checkpoint=lambda run_id, shard, checkpoint: self.checkpoints.update(
+                {shard: dict(checkpoint)}
+            ),
+            DEFAULT_BATCH_SIZE=10,
+        ), patch.object(
+            tracking.TrackingRefreshEngine,
+            "get_carrier_utils",
+            lambda engine, carrier: FakeAramex() if carrier == ARAMEX_PROVIDER else FakeDelhivery(),
+        ), patch.multiple(
+            shipping,
+            set_tracking_info=self.set_tracking_info,
+            update_shipment_delivery_notes=lambda tracking_info: None,
+        ), patch.object(
+            frappe.db, "commit", self.commit
+        ):
+            tracking.refresh_tracking_shard("test", 0, 1)
+
+    def test_resume_does_not_skip_pending_aramex_shipments(self):
+        self.commits_before_death = 5
+        with self.assertRaises(JobDied):
+            self.refresh_shard()
+        self.assertTrue(self.checkpoints[0]["last"])
+        self.assertFalse(self.checkpoints[0].get("done"))
+
+        # Every Shipment up to the checkpoint was committed by the job that died
+        self.assertTrue(
+            {
+                shipment.name
+                for shipment in self.shipments
+                if shipment.name <= self.checkpoints[0]["last"]
+            }
+            <= self.committed
+        )
+
+        self.commits_before_death = None
+        self.refresh_shard()
+        self.assertTrue(self.checkpoints[0]["done"])
+        self.assertEqual(self.committed, {shipment.name for shipment in self.shipments})
+
+
+class TestTrackingClosed(unittest.TestCase):
+    def test_final_carrier_descriptions_close_tracking(self):
+        # Aramex stores descriptions as it sends them, not the normalized status
+        creation, now = datetime(2026, 10, 1), datetime(2026, 10, 2)
+        for tracking_status in ("Delivered", "DELIVERED", "RTO - Delivered", "cancelled"):
+            self.assertIsNone(tracking.get_next_poll_at(tracking_status, creation, 0, now=now))
+        self.assertEqual(
+            tracking.get_next_poll_at("Out for Delivery", creation, 0, now=now),
+            now + timedelta(minutes=30),
+        )
+
+    def test_delivered_shipment_is_closed(self):
+        shipment = frappe._dict(name="SHP-0001", creation=datetime(2026, 10, 1))
+        with patch.object(frappe.db, "set_value") as set_value:
+            tracking.schedule_next_poll(shipment, "Delivered", True)
+        values = set_value.call_args[0][2]
+        self.assertIsNone(values["next_poll_at"])
+        self.assertEqual(values["tracking_closed"], 1)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe and Contributors
+# See license.txt
+from __future__ import unicode_literals
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import requests
+from erpnext_shipping.erpnext_shipping import transport
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    # /slow answers after 3 seconds, /unavailable-then-slow with a 503 the first time
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.calls += 1
+            first_call = self.server.calls == 1
+        if self.path == "/unavailable-then-slow" and first_call:
+            return self.send_body(503)
+        time.sleep(3)
+        self.send_body(200)
+
+    def send_body(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+class TestRequestDeadline(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.calls = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_port)
+
+        # Connect timeout of half a second, read timeout of 30 seconds
+        settings = patch.object(transport, "get_transport_settings", return_value=(2, (0.5, 30)))
+        settings.start()
+        self.addCleanup(settings.stop)
+        self.addCleanup(transport._sessions.pop, self.url, None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request_with_retry(self, path, deadline):
+        started = time.monotonic()
+        with self.assertRaises(requests.ReadTimeout):
+            transport.request_with_retry(
+                lambda: transport.request("GET", f"{self.url}{path}"), deadline=deadline
+            )
+        return time.monotonic() - started
+
+    def test_slow_response_stops_at_deadline(self):
+        elapsed = self.request_with_retry("/slow", deadline=1)
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(self.server.calls, 1)
+
+    def test_retry_stops_at_deadline(self):
+        elapsed = self.request_with_retry("/unavailable-then-slow", deadline=1.5)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(self.server.calls, 2)
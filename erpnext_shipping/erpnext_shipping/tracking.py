@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import json
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import frappe
+from frappe import _
+from frappe.query_builder import CustomFunction
+from frappe.query_builder.functions import Abs, Coalesce
+from frappe.utils import cint, get_datetime, now_datetime
+from frappe.utils.background_jobs import get_queues_timeout
+from erpnext_shipping.erpnext_shipping.metrics import set_thread_site
+from erpnext_shipping.erpnext_shipping.utils import (
+    get_carrier_config,
+    is_final_tracking_status,
+    normalize_tracking_status,
+    show_error_alert,
+)
+from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import (
+    ARAMEX_PROVIDER,
+    TRACKING_CHUNK_SIZE,
+    AramexUtils,
+)
+from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import (
+    DELHIVERY_PROVIDER,
+    DelhiveryUtils,
+)
+
+# Parallel requests allowed per carrier, overridable with
+# `shipping_tracking_concurrency` in site_config.json
+DEFAULT_CONCURRENCY = {
+    ARAMEX_PROVIDER: 2,
+    DELHIVERY_PROVIDER: 8,
+}
+# Shipments written between two commits, overridable with
+# `shipping_tracking_commit_every` in site_config.json
+DEFAULT_BATCH_SIZE = 100
+STATS_CACHE_KEY = "erpnext_shipping_tracking_refresh_stats"
+
+# Tracking API calls per minute the poll scheduler may spend on each carrier,
+# overridable with `shipping_tracking_poll_budget` in site_config.json
+DEFAULT_POLL_BUDGET = {
+    ARAMEX_PROVIDER: 10,
+    DELHIVERY_PROVIDER: 60,
+}
+POLL_BUDGET_KEY = "erpnext_shipping_tracking_poll_budget"
+SHIPMENTS_PER_CALL = {
+    ARAMEX_PROVIDER: TRACKING_CHUNK_SIZE,
+    DELHIVERY_PROVIDER: 1,
+}
+# Minutes between polls by normalized tracking status, before backing off
+POLL_INTERVALS = {
+    "PICKUP_REQUESTED": 120,
+    "SHIPPED": 240,
+    "OUT_FOR_DELIVERY": 30,
+}
+DEFAULT_POLL_INTERVAL = 360
+MAX_POLL_INTERVAL = 24 * 60
+# Minutes before a Shipment picked by a tick that did not get an answer is retried
+POLL_RETRY_INTERVAL = 30
+# Shipments older than this are polled at most daily, and no longer at all past the max age
+POLL_SLOW_AFTER_DAYS = 14
+POLL_MAX_AGE_DAYS = 60
+
+# Shards of the daily refresh run as parallel jobs, overridable with
+# `shipping_tracking_shards` in site_config.json
+DEFAULT_SHARDS = 4
+# Dedicated queue of the shard jobs, falls back to "long" unless a worker for it
+# is configured under `workers` in common_site_config.json
+TRACKING_QUEUE = "shipping_tracking"
+SHARD_JOB_TIMEOUT = 4 * 60 * 60
+# Shipments read per query while streaming open Shipments
+STREAM_PAGE_SIZE = 500
+# The only columns the tracking jobs read
+OPEN_SHIPMENT_FIELDS = (
+    "name",
+    "carrier",
+    "service_provider",
+    "shipment_id",
+    "awb_number",
+    "tracking_status",
+    "creation",
+    "tracking_no_change_count",
+)
+TRACKING_RUN_KEY = "erpnext_shipping_tracking_run"
+SHARD_CHECKPOINT_KEY = "erpnext_shipping_tracking_shard"
+# Seconds a run and its checkpoints are kept to resume it
+TRACKING_RUN_TTL = 2 * 24 * 60 * 60
+
+
+class TrackingRefreshEngine:
+    """Fetches carrier tracking status concurrently and writes it back in order.
+
+    Only the HTTP round trips run in worker threads; building requests, parsing
+    responses and all database writes stay on the calling thread, which owns the
+    site connection. Results are committed every `batch_size` shipments.
+
+    Aramex shipments wait for a full TrackShipments chunk while Delhivery ones are
+    sent at once, so commits don't follow the order of the given shipments. After
+    every commit `on_commit` is called with the stats so far and the watermark: the
+    last name up to which every shipment read has been committed, given shipments
+    sorted by name, or None while there is none.
+    """
+
+    def __init__(self, concurrency=None, batch_size=None, commit=True, on_commit=None):
+        self.concurrency = dict(DEFAULT_CONCURRENCY)
+        self.concurrency.update(frappe.conf.get("shipping_tracking_concurrency") or {})
+        self.concurrency.update(concurrency or {})
+        self.batch_size = (
+            batch_size or frappe.conf.get("shipping_tracking_commit_every") or DEFAULT_BATCH_SIZE
+        )
+        self.commit = commit
+        self.on_commit = on_commit
+
+        self.in_flight = 0
+        self.fetched = 0
+        self.updated = 0
+        self.failed = 0
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._carriers = {}
+        # Names of the shipments sent to the carriers in the order they were read,
+        # and those whose results are collected, for the commit watermark
+        self._read = deque()
+        self._collected = set()
+
+    def run(self, shipments):
+        self.started_at = time.monotonic()
+        workers = {carrier: max(1, int(limit)) for carrier, limit in self.concurrency.items()}
+        executors = {
+            carrier: ThreadPoolExecutor(
+                max_workers=limit,
+                thread_name_prefix=f"tracking-{carrier}",
+                initializer=set_thread_site,
+                initargs=(frappe.local.site,),
+            )
+            for carrier, limit in workers.items()
+        }
+        max_pending = 2 * sum(workers.values())
+
+        pending = deque()
+        batch = []
+        try:
+            for task in self.get_tasks(shipments):
+                future = executors[task.carrier].submit(self.fetch, task)
+                pending.append((task, future))
+                while len(pending) >= max_pending:
+                    batch.extend(self.collect(*pending.popleft()))
+                    batch = self.flush(batch)
+
+            while pending:
+                batch.extend(self.collect(*pending.popleft()))
+                batch = self.flush(batch)
+            self.flush(batch, force=True)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+        return self.get_stats()
+
+    def get_tasks(self, shipments):
+        # Aramex accepts many AWBs per TrackShipments call, Delhivery one LR Number per call
+        enabled = {
+            carrier: get_carrier_config(carrier)["enabled"]
+            for carrier in (ARAMEX_PROVIDER, DELHIVERY_PROVIDER)
+        }
+        aramex_chunk = []
+        for shipment in shipments:
+            if not enabled.get(shipment.carrier):
+                continue
+            if shipment.carrier == ARAMEX_PROVIDER and shipment.awb_number:
+                self._read.append(shipment.name)
+                aramex_chunk.append(shipment)
+                if len(aramex_chunk) >= TRACKING_CHUNK_SIZE:
+                    yield self.get_task(ARAMEX_PROVIDER, aramex_chunk)
+                    aramex_chunk = []
+            elif shipment.carrier == DELHIVERY_PROVIDER and shipment.shipment_id:
+                self._read.append(shipment.name)
+                yield self.get_task(DELHIVERY_PROVIDER, [shipment])
+
+        if aramex_chunk:
+            yield self.get_task(ARAMEX_PROVIDER, aramex_chunk)
+
+    def get_task(self, carrier, shipments):
+        utils = self.get_carrier_utils(carrier)
+        if carrier == ARAMEX_PROVIDER:
+            awb_numbers = [shipment.awb_number for shipment in shipments]
+            fetch = lambda: utils.request_tracking_data(awb_numbers)  # noqa: E731
+        else:
+            lrnum = shipments[0].shipment_id
+            fetch = lambda: utils.request_tracking_data(lrnum)  # noqa: E731
+        return frappe._dict(carrier=carrier, shipments=shipments, fetch=fetch)
+
+    def get_carrier_utils(self, carrier):
+        if carrier not in self._carriers:
+            if carrier == ARAMEX_PROVIDER:
+                self._carriers[carrier] = AramexUtils()
+            else:
+                self._carriers[carrier] = DelhiveryUtils()
+                self._carriers[carrier].authenticate()
+        return self._carriers[carrier]
+
+    def fetch(self, task):
+        # Runs in a worker thread: no frappe calls beyond the HTTP transport
+        with self._lock:
+            self.in_flight += len(task.shipments)
+        try:
+            return task.fetch()
+        except Exception as e:
+            return e
+        finally:
+            with self._lock:
+                self.in_flight -= len(task.shipments)
+                self.fetched += len(task.shipments)
+
+    def collect(self, task, future):
+        # Returns (shipment, tracking_data) pairs for a finished task
+        response = future.result()
+        self._collected.update(shipment.name for shipment in task.shipments)
+        try:
+            if isinstance(response, Exception):
+                raise response
+            if task.carrier == ARAMEX_PROVIDER:
+                return self.parse_aramex_response(task, response)
+            return self.parse_delhivery_response(task, response)
+        except Exception:
+            self.failed += len(task.shipments)
+            show_error_alert(_("updating {0} Shipments").format(task.carrier))
+            return []
+
+    def parse_aramex_response(self, task, tracking_data):
+        # TrackShipments results come back parsed already
+        aramex = self.get_carrier_utils(ARAMEX_PROVIDER)
+        results = {
+            tracking_result["Key"]: tracking_result
+            for tracking_result in tracking_data.get("TrackingResults") or []
+        }
+        collected = []
+        for shipment in task.shipments:
+            tracking_result = results.get(shipment.awb_number)
+            if tracking_result:
+                collected.append(
+                    (shipment, aramex.get_tracking_info(shipment.awb_number, tracking_result))
+                )
+            else:
+                self.failed += 1
+        return collected
+
+    def parse_delhivery_response(self, task, response):
+        delhivery = self.get_carrier_utils(DELHIVERY_PROVIDER)
+        shipment = task.shipments[0]
+        if response.status_code == 200:
+            tracking_info = delhivery.get_tracking_info(
+                shipment.awb_number, json.loads(response.text)
+            )
+        else:
+            # Token expired or transient failure, retry through the regular call
+            # which renews the token before giving up
+            tracking_info = delhivery.get_tracking_data(
+                shipment.awb_number, lrnum=shipment.shipment_id
+            )
+        return [(shipment, tracking_info)]
+
+    def flush(self, batch, force=False):
+        if not batch or (len(batch) < self.batch_size and not force):
+            return batch
+
+        from erpnext_shipping.erpnext_shipping.shipping import (
+            set_tracking_info,
+            update_shipment_delivery_notes,
+        )
+
+        delivery_note_tracking_info = {}
+        for shipment, tracking_data in batch:
+            if not tracking_data:
+                continue
+            previous, changed = set_tracking_info(shipment.name, tracking_data)
+            schedule_next_poll(
+                shipment, tracking_data.get("tracking_status"), "tracking_status" in changed
+            )
+            if changed:
+                delivery_note_tracking_info[shipment.name] = dict(
+                    tracking_data, awb_number=shipment.awb_number
+                )
+            self.updated += 1
+
+        update_shipment_delivery_notes(delivery_note_tracking_info)
+
+        if self.commit:
+            frappe.db.commit()
+            if self.on_commit:
+                self.on_commit(self.get_watermark(), self.get_stats())
+        frappe.cache().set_value(STATS_CACHE_KEY, self.get_stats())
+        return []
+
+    def get_watermark(self):
+        # Every collected shipment is written by the time of a commit, failed ones
+        # have nothing to write
+        watermark = None
+        while self._read and self._read[0] in self._collected:
+            watermark = self._read.popleft()
+            self._collected.discard(watermark)
+        return watermark
+
+    def get_stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            "in_flight": self.in_flight,
+            "fetched": self.fetched,
+            "updated": self.updated,
+            "failed": self.failed,
+            "elapsed": round(elapsed, 3),
+            "throughput": round(self.fetched / elapsed, 2) if elapsed else 0,
+        }
+
+
+def refresh_tracking(shipments, **kwargs):
+    # Refresh the tracking info of `shipments` (dicts with name, carrier, shipment_id, awb_number)
+    return TrackingRefreshEngine(**kwargs).run(shipments)
+
+
+def poll_due_shipments():
+    # Frequent scheduled event to refresh the Shipments whose next poll is due,
+    # spending at most the API budget of each carrier
+    now = now_datetime()
+    shipments = []
+    for carrier in (ARAMEX_PROVIDER, DELHIVERY_PROVIDER):
+        if not get_carrier_config(carrier)["enabled"]:
+            continue
+        calls = reserve_poll_budget(carrier, get_poll_budget(carrier))
+        if not calls:
+            continue
+
+        due = get_due_shipments(carrier, now, limit=calls * SHIPMENTS_PER_CALL[carrier])
+        unused = calls - math.ceil(len(due) / SHIPMENTS_PER_CALL[carrier])
+        if unused:
+            release_poll_budget(carrier, unused)
+        shipments.extend(due)
+
+    if not shipments:
+        return
+
+    # Push the due date out first so failed fetches and overlapping ticks don't
+    # pick the same Shipments again right away
+    shipment = frappe.qb.DocType("Shipment")
+    (
+        frappe.qb.update(shipment)
+        .set(shipment.next_poll_at, now + timedelta(minutes=POLL_RETRY_INTERVAL))
+        .where(shipment.name.isin([row.name for row in shipments]))
+    ).run()
+    frappe.db.commit()
+
+    refresh_tracking(shipments)
+
+
+def get_due_shipments(carrier, now, limit):
+    return frappe.get_all(
+        "Shipment",
+        filters=[
+            ["docstatus", "=", 1],
+            ["status", "=", "Booked"],
+            ["carrier", "=", carrier],
+            ["shipment_id", "!=", ""],
+            ["tracking_closed", "=", 0],
+            ["creation", ">", now - timedelta(days=POLL_MAX_AGE_DAYS)],
+        ],
+        or_filters=[["next_poll_at", "is", "not set"], ["next_poll_at", "<=", now]],
+        fields=list(OPEN_SHIPMENT_FIELDS),
+        order_by="next_poll_at asc",
+        limit=limit,
+    )
+
+
+def get_poll_budget(carrier):
+    budget = dict(DEFAULT_POLL_BUDGET)
+    budget.update(frappe.conf.get("shipping_tracking_poll_budget") or {})
+    return int(budget.get(carrier) or 0)
+
+
+def reserve_poll_budget(carrier, calls):
+    """Reserves up to `calls` API calls of the current minute, shared by all workers.
+
+    Returns the number of calls granted.
+    """
+    if calls <= 0:
+        return 0
+    redis = frappe.cache()
+    key = get_poll_budget_key(carrier)
+    used = redis.incrby(key, calls)
+    redis.expire(key, 120)
+    granted = max(0, min(calls, get_poll_budget(carrier) - (used - calls)))
+    if granted < calls:
+        redis.decrby(key, calls - granted)
+    return granted
+
+
+def release_poll_budget(carrier, calls):
+    frappe.cache().decrby(get_poll_budget_key(carrier), calls)
+
+
+def get_poll_budget_key(carrier):
+    minute = int(time.time() // 60)
+    return frappe.cache().make_key(f"{POLL_BUDGET_KEY}:{carrier}:{minute}")
+
+
+def schedule_next_poll(shipment, tracking_status, status_changed):
+    # Store when the Shipment is due again, or close its tracking once it no longer
+    # needs polling, without touching its modified timestamp
+    no_change_count = 0 if status_changed else (shipment.get("tracking_no_change_count") or 0) + 1
+    next_poll_at = get_next_poll_at(
+        tracking_status, shipment.get("creation") or now_datetime(), no_change_count
+    )
+    frappe.db.set_value(
+        "Shipment",
+        shipment.name,
+        {
+            "next_poll_at": next_poll_at,
+            "tracking_no_change_count": no_change_count,
+            "tracking_closed": cint(next_poll_at is None),
+        },
+        update_modified=False,
+    )
+
+
+def get_next_poll_at(tracking_status, creation, no_change_count, now=None):
+    """Returns when a Shipment should be polled next, or None once its tracking is closed.
+
+    Active statuses are polled more often, every poll that returned the same status
+    doubles the interval and old Shipments slow down to a daily poll.
+    """
+    now = now or now_datetime()
+    age = now - get_datetime(creation)
+    if is_final_tracking_status(tracking_status) or age > timedelta(days=POLL_MAX_AGE_DAYS):
+        return None
+
+    status = normalize_tracking_status(tracking_status)
+    interval = POLL_INTERVALS.get(status, DEFAULT_POLL_INTERVAL) * 2 ** min(no_change_count, 6)
+    if age > timedelta(days=POLL_SLOW_AFTER_DAYS):
+        interval = MAX_POLL_INTERVAL
+    return now + timedelta(minutes=min(interval, MAX_POLL_INTERVAL))
+
+
+def start_tracking_refresh():
+    """Starts a refresh of the Shipments due for a poll, in shards run as separate jobs.
+
+    It catches up on the due Shipments `poll_due_shipments` did not get to within
+    its budget, backed off and retired Shipments are skipped there as well. Every
+    shard commits and checkpoints its progress page by page, so a shard job that
+    died is resumed where it stopped by `resume_tracking_refresh`.
+    """
+    run = {
+        "run_id": now_datetime().strftime("%Y%m%d%H%M%S"),
+        "shards": max(1, cint(frappe.conf.get("shipping_tracking_shards") or DEFAULT_SHARDS)),
+    }
+    frappe.cache().set_value(TRACKING_RUN_KEY, run, expires_in_sec=TRACKING_RUN_TTL)
+    enqueue_tracking_shards(run["run_id"], run["shards"])
+
+
+def resume_tracking_refresh():
+    # Hourly scheduled event re-enqueuing the unfinished shards of the last run,
+    # shards that are still queued or running are not enqueued twice
+    run = frappe.cache().get_value(TRACKING_RUN_KEY)
+    if run:
+        enqueue_tracking_shards(run["run_id"], run["shards"])
+
+
+def enqueue_tracking_shards(run_id, shards):
+    queue = TRACKING_QUEUE if TRACKING_QUEUE in get_queues_timeout() else "long"
+    for shard in range(shards):
+        if get_shard_checkpoint(run_id, shard).get("done"):
+            continue
+        # A shard holds a lease from being enqueued until its job ends, enqueue's own
+        # job_id deduplication needs Frappe v15
+        if not frappe.cache().set(
+            get_shard_lease_key(run_id, shard), 1, nx=True, ex=SHARD_JOB_TIMEOUT
+        ):
+            continue
+        frappe.enqueue(
+            "erpnext_shipping.erpnext_shipping.tracking.refresh_tracking_shard",
+            queue=queue,
+            timeout=SHARD_JOB_TIMEOUT,
+            run_id=run_id,
+            shard=shard,
+            shards=shards,
+        )
+
+
+def refresh_tracking_shard(run_id, shard, shards):
+    # Background job refreshing a shard of the open Shipments in name order,
+    # starting after the commit watermark of its checkpoint
+    try:
+        refresh_shard(run_id, shard, shards)
+    finally:
+        frappe.cache().delete(get_shard_lease_key(run_id, shard))
+
+
+def refresh_shard(run_id, shard, shards):
+    checkpoint = get_shard_checkpoint(run_id, shard)
+    if checkpoint.get("done"):
+        return
+
+    # Counts of earlier attempts of the job that died
+    updated, failed = checkpoint.get("updated", 0), checkpoint.get("failed", 0)
+
+    def save_checkpoint(watermark, stats):
+        if watermark:
+            checkpoint["last"] = watermark
+        checkpoint.update(updated=updated + stats["updated"], failed=failed + stats["failed"])
+        set_shard_checkpoint(run_id, shard, checkpoint)
+        # Progress extends the lease, it only runs out for a job killed on its timeout
+        frappe.cache().expire(get_shard_lease_key(run_id, shard), SHARD_JOB_TIMEOUT)
+
+    stats = refresh_tracking(
+        stream_open_shipments(shard=shard, shards=shards, after=checkpoint.get("last")),
+        on_commit=save_checkpoint,
+    )
+    checkpoint.update(
+        done=True, updated=updated + stats["updated"], failed=failed + stats["failed"]
+    )
+    set_shard_checkpoint(run_id, shard, checkpoint)
+
+
+def stream_open_shipments(shard=None, shards=None, after=None, page_size=STREAM_PAGE_SIZE):
+    """Yields the open Shipments due for a poll in name order, a page at a time.
+
+    Every page continues after the last name of the previous one, so each query is
+    a short range scan of the primary key and memory stays flat however many
+    Shipments are open. Only OPEN_SHIPMENT_FIELDS are selected. With `shards`, only
+    the Shipments of `shard` are returned. Commits are left to the consumer, which
+    knows which of the Shipments it has written.
+    """
+    now = now_datetime()
+    while True:
+        page = get_open_shipments_page(after, page_size, shard, shards, now=now)
+        yield from page
+        if len(page) < page_size:
+            return
+        after = page[-1].name
+
+
+def get_open_shipments_page(after, limit, shard=None, shards=None, now=None):
+    # Same age and due filters as `get_due_shipments`
+    now = now or now_datetime()
+    shipment = frappe.qb.DocType("Shipment")
+    query = (
+        frappe.qb.from_(shipment)
+        .select(*[shipment[field] for field in OPEN_SHIPMENT_FIELDS])
+        .where(shipment.docstatus == 1)
+        .where(shipment.status == "Booked")
+        .where(Coalesce(shipment.shipment_id, "") != "")
+        .where(shipment.tracking_closed == 0)
+        .where(shipment.creation > now - timedelta(days=POLL_MAX_AGE_DAYS))
+        .where(shipment.next_poll_at.isnull() | (shipment.next_poll_at <= now))
+        .orderby(shipment.name)
+        .limit(limit)
+    )
+    if shards:
+        query = query.where(get_shard_key(shipment.name, shards) == shard)
+    if after:
+        query = query.where(shipment.name > after)
+    return query.run(as_dict=True)
+
+
+def get_shard_key(field, shards):
+    # Stable hash of `field` computed by the database, so shards are selected in SQL
+    if frappe.db.db_type == "postgres":
+        return Abs(CustomFunction("HASHTEXT", ["value"])(field)) % shards
+    return CustomFunction("CRC32", ["value"])(field) % shards
+
+
+def get_shard_checkpoint(run_id, shard):
+    return frappe.cache().hget(f"{SHARD_CHECKPOINT_KEY}:{run_id}", str(shard)) or {}
+
+
+def set_shard_checkpoint(run_id, shard, checkpoint):
+    key = f"{SHARD_CHECKPOINT_KEY}:{run_id}"
+    frappe.cache().hset(key, str(shard), checkpoint)
+    frappe.cache().expire(frappe.cache().make_key(key), TRACKING_RUN_TTL)
+
+
+def get_shard_lease_key(run_id, shard):
+    # Raw key, RedisWrapper.set and expire don't prefix it with the site
+    return frappe.cache().make_key(f"{SHARD_CHECKPOINT_KEY}:{run_id}:{shard}:lease")
+
+
+@frappe.whitelist()
+def get_tracking_refresh_progress():
+    # Checkpoints of the shards of the last daily refresh
+    frappe.only_for("System Manager")
+    run = frappe.cache().get_value(TRACKING_RUN_KEY)
+    if not run:
+        return None
+    return dict(
+        run,
+        shards={
+            shard: get_shard_checkpoint(run["run_id"], shard) for shard in range(run["shards"])
+        },
+    )
+
+
+@frappe.whitelist()
+def get_tracking_refresh_stats():
+    frappe.only_for("System Manager")
+    return frappe.cache().get_value(STATS_CACHE_KEY)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from erpnext_shipping.erpnext_shipping.metrics import record_call
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+
+# Circuit breaker defaults, overridable with `shipping_circuit_breaker` in site_config.json
+DEFAULT_BREAKER_SETTINGS = {
+    # Seconds of calls the error rate is computed over
+    "window": 60,
+    # Calls needed in a window before the breaker may open
+    "min_calls": 10,
+    # Share of failed calls that opens the breaker
+    "error_rate": 0.5,
+    # Seconds after which a call counts as failed even if it succeeds
+    "slow_call": 10,
+    # Seconds the breaker stays open before a trial call is let through
+    "open_for": 30,
+}
+BREAKER_KEY = "erpnext_shipping_circuit_breaker"
+
+# Retry policy defaults, overridable with `shipping_retry` in site_config.json
+DEFAULT_RETRY_SETTINGS = {
+    "attempts": 4,
+    # Seconds of the first backoff, doubled on every attempt up to the max
+    "base_delay": 0.5,
+    "max_delay": 8,
+    # Seconds a call may take including all of its retries
+    "deadline": 30,
+}
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# Responses that guarantee the request was not processed, the only ones
+# retried for calls that are not idempotent
+UNPROCESSED_STATUS_CODES = (429, 503)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_breakers = {}
+# Whether the call being sent on this thread is a retry and when its deadline
+# ends, see `request_with_retry`
+_retry_state = threading.local()
+
+
+class CarrierUnavailable(Exception):
+    """Raised instead of calling a carrier while its circuit breaker is open."""
+
+    def __init__(self, carrier, retry_after):
+        self.carrier = carrier
+        self.retry_after = retry_after
+        super(CarrierUnavailable, self).__init__(
+            f"{carrier} is not responding, calls are paused for {retry_after} seconds"
+        )
+
+
+class CarrierSession(requests.Session):
+    """Keep-alive session for a single carrier host that always applies a timeout."""
+
+    def __init__(self, pool_size, timeout):
+        super(CarrierSession, self).__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(CarrierSession, self).request(method, url, **kwargs)
+
+
+def get_transport_settings():
+    # Pool size and timeouts can be tuned per bench in site_config.json
+    conf = getattr(frappe.local, "conf", None) or {}
+    pool_size = conf.get("shipping_http_pool_size") or DEFAULT_POOL_SIZE
+    timeout = (
+        conf.get("shipping_http_connect_timeout") or DEFAULT_CONNECT_TIMEOUT,
+        conf.get("shipping_http_read_timeout") or DEFAULT_READ_TIMEOUT,
+    )
+    return pool_size, timeout
+
+
+def get_session(url):
+    """Returns the pooled session of this worker for the host of `url`."""
+    parts = urlsplit(url)
+    base_url = "{0}://{1}".format(parts.scheme, parts.netloc)
+
+    session = _sessions.get(base_url)
+    if session:
+        return session
+
+    with _sessions_lock:
+        if base_url not in _sessions:
+            pool_size, timeout = get_transport_settings()
+            _sessions[base_url] = CarrierSession(pool_size, timeout)
+        return _sessions[base_url]
+
+
+def request(method, url, carrier=None, endpoint=None, **kwargs):
+    """Sends a request through the pooled session of the host of `url`.
+
+    Calls labelled with a `carrier` go through its circuit breaker and are recorded
+    in the carrier metrics under `endpoint`. Within `request_with_retry` the read
+    timeout is capped to the time left before its deadline.
+    """
+    session = get_session(url)
+    kwargs["timeout"] = get_attempt_timeout(kwargs.get("timeout") or session.timeout)
+    if not carrier:
+        return session.request(method, url, **kwargs)
+
+    endpoint = endpoint or "other"
+    retry = getattr(_retry_state, "retry", False)
+    request_bytes = get_body_size(kwargs.get("data"))
+    breaker = get_breaker(carrier)
+    try:
+        trial = breaker.before_call()
+    except CarrierUnavailable:
+        record_call(carrier, endpoint, 0, "breaker_open", request_bytes, retry=retry)
+        raise
+
+    started = time.monotonic()
+    try:
+        response = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        duration = time.monotonic() - started
+        breaker.record(False, trial)
+        record_call(carrier, endpoint, duration, type(e).__name__, request_bytes, retry=retry)
+        raise
+
+    duration = time.monotonic() - started
+    failed = response.status_code >= 500 or response.status_code == 429
+    slow = duration > breaker.settings["slow_call"]
+    breaker.record(not (failed or slow), trial)
+    record_call(
+        carrier,
+        endpoint,
+        duration,
+        response.status_code,
+        request_bytes,
+        len(response.content),
+        retry=retry,
+    )
+    return response
+
+
+def get_attempt_timeout(timeout):
+    deadline_at = getattr(_retry_state, "deadline_at", None)
+    if deadline_at is None:
+        return timeout
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return connect, max(0.1, min(read, deadline_at - time.monotonic()))
+
+
+def get_body_size(data):
+    if not data:
+        return 0
+    if isinstance(data, str):
+        return len(data.encode())
+    if isinstance(data, bytes):
+        return len(data)
+    return 0
+
+
+def request_with_retry(send, refresh_auth=None, idempotent=True, deadline=None):
+    """Calls `send` until it returns a response that is not worth retrying.
+
+    A 401 calls `refresh_auth` once before trying again. Connection errors, 429 and
+    5xx responses are retried with capped exponential backoff and full jitter,
+    waiting at least as long as a Retry-After header asks. Every attempt may only
+    read until the `deadline` in seconds, retries stop once the attempts are used up
+    or less than the connect timeout would be left after the backoff. Other
+    responses are returned as they are, the last error is raised otherwise.
+    """
+    settings = get_retry_settings()
+    deadline_at = time.monotonic() + (deadline or settings["deadline"])
+    connect_timeout = get_transport_settings()[1][0]
+    auth_refreshed = False
+
+    attempt = 0
+    while True:
+        response, error = None, None
+        _retry_state.retry = attempt > 0 or auth_refreshed
+        _retry_state.deadline_at = deadline_at
+        try:
+            response = send()
+        except CarrierUnavailable:
+            raise
+        except requests.RequestException as e:
+            # Only a failed connect proves a non idempotent request was not sent
+            if not idempotent and not isinstance(e, requests.ConnectTimeout):
+                raise
+            error = e
+        finally:
+            _retry_state.retry = False
+            _retry_state.deadline_at = None
+
+        if response is not None:
+            if response.status_code == 401 and refresh_auth and not auth_refreshed:
+                refresh_auth()
+                auth_refreshed = True
+                continue
+            retryable = UNPROCESSED_STATUS_CODES if not idempotent else RETRYABLE_STATUS_CODES
+            if response.status_code not in retryable:
+                return response
+
+        attempt += 1
+        delay = get_retry_delay(attempt, response, settings)
+        if (
+            attempt >= settings["attempts"]
+            or time.monotonic() + delay + connect_timeout > deadline_at
+        ):
+            if error:
+                raise error
+            return response
+        time.sleep(delay)
+
+
+def get_retry_delay(attempt, response, settings):
+    backoff = min(settings["max_delay"], settings["base_delay"] * 2 ** (attempt - 1))
+    delay = random.uniform(0, backoff)
+
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            try:
+                delay = max(delay, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return delay
+
+
+def get_retry_settings():
+    # Worker threads can't read the site config and use the defaults
+    conf = getattr(frappe.local, "conf", None) or {}
+    return dict(DEFAULT_RETRY_SETTINGS, **(conf.get("shipping_retry") or {}))
+
+
+class CircuitBreaker:
+    """Error rate circuit breaker of a carrier, shared by all workers through Redis.
+
+    Redis keys are not site specific since an outage of a carrier affects every site.
+    Only raw Redis commands are used so the breaker also works in worker threads.
+    """
+
+    def __init__(self, carrier):
+        self.carrier = carrier
+        self.settings = dict(DEFAULT_BREAKER_SETTINGS)
+        self.key = f"{BREAKER_KEY}:{carrier}"
+
+    def configure(self, settings):
+        self.settings = dict(DEFAULT_BREAKER_SETTINGS, **settings)
+
+    def before_call(self):
+        # Returns True for the trial call of a half-open breaker
+        redis = frappe.cache()
+        open_until = redis.get(f"{self.key}:open_until")
+        if open_until is None:
+            return False
+
+        remaining = float(open_until) - time.time()
+        if remaining <= 0 and redis.set(
+            f"{self.key}:trial", 1, nx=True, ex=self.settings["open_for"]
+        ):
+            return True
+
+        raise CarrierUnavailable(self.carrier, max(int(remaining), 1))
+
+    def record(self, success, trial=False):
+        redis = frappe.cache()
+        if trial:
+            if success:
+                redis.delete(f"{self.key}:open_until", f"{self.key}:trial")
+            else:
+                self.open()
+            return
+
+        window = int(self.settings["window"])
+        bucket = f"{self.key}:{int(time.time() // window)}"
+        pipeline = redis.pipeline()
+        pipeline.hincrby(bucket, "calls", 1)
+        pipeline.hincrby(bucket, "failures", 0 if success else 1)
+        pipeline.expire(bucket, 2 * window)
+        calls, failures = pipeline.execute()[:2]
+
+        if (
+            not success
+            and calls >= self.settings["min_calls"]
+            and failures / calls >= self.settings["error_rate"]
+        ):
+            self.open()
+
+    def open(self):
+        redis = frappe.cache()
+        open_for = self.settings["open_for"]
+        pipeline = redis.pipeline()
+        pipeline.set(f"{self.key}:open_until", time.time() + open_for, ex=10 * open_for)
+        pipeline.delete(f"{self.key}:trial")
+        # Start counting afresh once the trial call closes the breaker again
+        pipeline.delete(f"{self.key}:{int(time.time() // int(self.settings['window']))}")
+        pipeline.execute()
+
+    def get_state(self):
+        redis = frappe.cache()
+        open_until = redis.get(f"{self.key}:open_until")
+        window = int(self.settings["window"])
+        # Read through a pipeline, RedisWrapper.hgetall prefixes and unpickles
+        pipeline = redis.pipeline()
+        pipeline.hgetall(f"{self.key}:{int(time.time() // window)}")
+        counts = pipeline.execute()[0]
+        calls = int(counts.get(b"calls", 0))
+        failures = int(counts.get(b"failures", 0))
+
+        if open_until is None:
+            state = "Closed"
+        elif float(open_until) > time.time():
+            state = "Open"
+        else:
+            state = "Half Open"
+        return {
+            "state": state,
+            "open_until": float(open_until) if open_until is not None else None,
+            "calls": calls,
+            "failures": failures,
+            "error_rate": round(failures / calls, 4) if calls else 0,
+        }
+
+
+def get_breaker(carrier):
+    breaker = _breakers.get(carrier)
+    if not breaker:
+        with _sessions_lock:
+            breaker = _breakers.setdefault(carrier, CircuitBreaker(carrier))
+
+    # Site config is only readable on the request thread, workers keep the last one seen
+    conf = getattr(frappe.local, "conf", None)
+    if conf:
+        breaker.configure(conf.get("shipping_circuit_breaker") or {})
+    return breaker
+
+
+@frappe.whitelist()
+def get_circuit_breaker_state(carrier):
+    frappe.only_for("System Manager")
+    return get_breaker(carrier).get_state()
+
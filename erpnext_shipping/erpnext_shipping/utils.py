@@ -2,36 +2,178 @@
 # Copyright (c) 2020, Frappe Technologies and contributors
 # For license information, please see license.txt
 from __future__ import unicode_literals
+import sys
+from types import MappingProxyType
+
 import frappe
 from frappe import _
+from frappe.utils.password import get_decrypted_password
+from erpnext_shipping.erpnext_shipping.transport import CarrierUnavailable
+
+CARRIER_CONFIG_CACHE_KEY = "erpnext_shipping_carrier_config"
+CARRIER_PASSWORD_FIELDS = ("password", "webhook_token")
+ADDRESS_CACHE_KEY = "erpnext_shipping_address"
+CONTACT_CACHE_KEY = "erpnext_shipping_contact"
+COUNTRY_CODES_CACHE_KEY = "erpnext_shipping_country_codes"
+PARCEL_SERVICE_INDEX_CACHE_KEY = "erpnext_shipping_parcel_service_index"
+# Normalized tracking statuses after which a Shipment is no longer tracked
+FINAL_TRACKING_STATUSES = ("DELIVERED", "CANCELLED", "RETURNED", "RTO_DELIVERED")
+ADDRESS_FIELDS = [
+    "name",
+    "address_title",
+    "address_line1",
+    "address_line2",
+    "city",
+    "state",
+    "pincode",
+    "country",
+]
+
+# Decrypted carrier passwords of this worker, keyed by (site, carrier)
+# and tagged with the version of the cached settings they belong to
+_carrier_passwords = {}
+# Compiled tracking URL templates of this worker, keyed by template source
+_url_templates = {}
 
 
 def get_tracking_url(carrier, tracking_number):
     # Return the formatted Tracking URL.
     tracking_url = ""
-    url_reference = frappe.get_value("Parcel Service", carrier, "url_reference")
+    url_reference = get_parcel_service_index()["parcel_services"].get(carrier)
     if url_reference:
-        tracking_url = frappe.render_template(
-            url_reference, {"tracking_number": tracking_number}
+        tracking_url = get_url_template(url_reference).render(
+            {"tracking_number": tracking_number}
         )
     return tracking_url
 
 
+def get_url_template(url_reference):
+    # Compiled once per worker, the template source is its own cache key
+    template = _url_templates.get(url_reference)
+    if not template:
+        if ".__" in url_reference:
+            frappe.throw(_("Illegal template"))
+        template = frappe.get_jenv().from_string(url_reference)
+        _url_templates[url_reference] = template
+    return template
+
+
+def get_parcel_service_index():
+    """Returns Parcel Services, their Service Type aliases and preferred Service Types.
+
+    Built once and shared through Redis until a Parcel Service or Parcel Service
+    Type is changed.
+    """
+    return frappe.cache().get_value(
+        PARCEL_SERVICE_INDEX_CACHE_KEY, generator=load_parcel_service_index
+    )
+
+
+def load_parcel_service_index():
+    aliases = frappe.get_all(
+        "Parcel Service Type Alias",
+        filters={"parenttype": "Parcel Service Type"},
+        fields=["parent", "parcel_service", "parcel_type_alias"],
+    )
+    return {
+        "parcel_services": {
+            parcel_service.name: parcel_service.url_reference
+            for parcel_service in frappe.get_all(
+                "Parcel Service", fields=["name", "url_reference"]
+            )
+        },
+        "aliases": {
+            (alias.parcel_service, alias.parcel_type_alias): alias.parent for alias in aliases
+        },
+        "preferred": {
+            service_type.name: service_type.show_in_preferred_services_list
+            for service_type in frappe.get_all(
+                "Parcel Service Type", fields=["name", "show_in_preferred_services_list"]
+            )
+        },
+    }
+
+
+def clear_parcel_service_index():
+    frappe.cache().delete_value(PARCEL_SERVICE_INDEX_CACHE_KEY)
+
+
+def get_carrier_config(carrier):
+    """Returns the settings of a carrier Single as a read-only mapping.
+
+    Settings are shared by all workers through Redis and the passwords are decrypted
+    once per worker for every version of the settings.
+    """
+    settings = frappe.cache().hget(
+        CARRIER_CONFIG_CACHE_KEY, carrier, generator=lambda: load_carrier_settings(carrier)
+    )
+
+    key = (frappe.local.site, carrier)
+    version, passwords = _carrier_passwords.get(key, (None, None))
+    if version != settings["_version"]:
+        passwords = {
+            fieldname: get_decrypted_password(carrier, carrier, fieldname, raise_exception=False)
+            for fieldname in CARRIER_PASSWORD_FIELDS
+        }
+        _carrier_passwords[key] = (settings["_version"], passwords)
+
+    config = dict(settings)
+    config.update(passwords)
+    return MappingProxyType(config)
+
+
+def load_carrier_settings(carrier):
+    settings = frappe.db.get_singles_dict(carrier, cast=True)
+    for fieldname in CARRIER_PASSWORD_FIELDS:
+        settings.pop(fieldname, None)
+    settings["_version"] = frappe.generate_hash(length=10)
+    return dict(settings)
+
+
+def clear_carrier_config(carrier):
+    frappe.cache().hdel(CARRIER_CONFIG_CACHE_KEY, carrier)
+
+
 def get_address(address_name):
-    fields = [
-        "name",
-        "address_title",
-        "address_line1",
-        "address_line2",
-        "city",
-        "state",
-        "pincode",
-        "country",
-    ]
-    address = frappe.db.get_value("Address", address_name, fields, as_dict=1)
-    address.country_code = frappe.db.get_value(
-        "Country", address.country, "code"
-    ).upper()
+    # Addresses are cached for the request and in Redis until the Address is updated
+    address = frappe.cache().hget(
+        ADDRESS_CACHE_KEY, address_name, generator=lambda: load_address(address_name)
+    )
+    return frappe._dict(address)
+
+
+def get_addresses(address_names):
+    # Returns a dict of Addresses by name, loading all uncached ones in one query.
+    # Addresses without a postal code are left out, `get_address` raises for them.
+    addresses = {}
+    missing = []
+    for address_name in set(filter(None, address_names)):
+        address = frappe.cache().hget(ADDRESS_CACHE_KEY, address_name)
+        if address:
+            addresses[address_name] = frappe._dict(address)
+        else:
+            missing.append(address_name)
+
+    if missing:
+        for address in frappe.get_all(
+            "Address", filters={"name": ["in", missing]}, fields=ADDRESS_FIELDS
+        ):
+            if not (address.pincode or "").strip():
+                continue
+            address = prepare_address(address.name, address)
+            frappe.cache().hset(ADDRESS_CACHE_KEY, address.name, address)
+            addresses[address.name] = frappe._dict(address)
+
+    return addresses
+
+
+def load_address(address_name):
+    address = frappe.db.get_value("Address", address_name, ADDRESS_FIELDS, as_dict=1)
+    return prepare_address(address_name, address)
+
+
+def prepare_address(address_name, address):
+    address.country_code = get_country_code(address.country)
 
     if not address.pincode or address.pincode == "":
         frappe.throw(
@@ -45,7 +187,28 @@ def get_address(address_name):
     return address
 
 
+def get_country_code(country):
+    country_codes = frappe.cache().get_value(
+        COUNTRY_CODES_CACHE_KEY, generator=load_country_codes
+    )
+    return country_codes[country]
+
+
+def load_country_codes():
+    return {
+        country.name: (country.code or "").upper()
+        for country in frappe.get_all("Country", fields=["name", "code"])
+    }
+
+
 def get_contact(contact_name):
+    contact = frappe.cache().hget(
+        CONTACT_CACHE_KEY, contact_name, generator=lambda: load_contact(contact_name)
+    )
+    return frappe._dict(contact)
+
+
+def load_contact(contact_name):
     fields = ["first_name", "last_name", "email_id", "phone", "mobile_no", "gender"]
     contact = frappe.db.get_value("Contact", contact_name, fields, as_dict=1)
 
@@ -61,24 +224,61 @@ def get_contact(contact_name):
     return contact
 
 
+def clear_address_cache(doc, method=None):
+    frappe.cache().hdel(ADDRESS_CACHE_KEY, doc.name)
+
+
+def clear_contact_cache(doc, method=None):
+    frappe.cache().hdel(CONTACT_CACHE_KEY, doc.name)
+
+
+def clear_country_codes_cache(doc=None, method=None):
+    frappe.cache().delete_value(COUNTRY_CODES_CACHE_KEY)
+    # Cached Addresses carry the code of their Country
+    frappe.cache().delete_value(ADDRESS_CACHE_KEY)
+
+
 def match_parcel_service_type_carrier(shipment_prices, reference):
     from erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type import (
         match_parcel_service_type_alias,
     )
 
+    preferred_service_types = get_parcel_service_index()["preferred"]
     for idx, prices in enumerate(shipment_prices):
         service_name = match_parcel_service_type_alias(
             prices.get(reference[0]), prices.get(reference[1])
         )
-        is_preferred = frappe.db.get_value(
-            "Parcel Service Type", service_name, "show_in_preferred_services_list"
-        )
+        is_preferred = preferred_service_types.get(service_name)
         shipment_prices[idx].service_name = service_name
         shipment_prices[idx].is_preferred = is_preferred
     return shipment_prices
 
 
+def normalize_tracking_status(tracking_status):
+    # Delhivery statuses are mapped already, Aramex sends descriptions like "Out for Delivery"
+    return "_".join((tracking_status or "").upper().replace("-", " ").split())
+
+
+def is_final_tracking_status(tracking_status):
+    return normalize_tracking_status(tracking_status) in FINAL_TRACKING_STATUSES
+
+
 def show_error_alert(action):
+    # A carrier paused by its circuit breaker is expected, no need for an Error Log
+    error = sys.exc_info()[1]
+    if isinstance(error, CarrierUnavailable):
+        frappe.msgprint(
+            _("An Error occurred while {0}. {1}").format(
+                action,
+                _("{0} is not responding, calls are paused for {1} seconds").format(
+                    error.carrier, error.retry_after
+                ),
+            ),
+            indicator="orange",
+            alert=True,
+        )
+        return
+
     log = frappe.log_error(frappe.get_traceback())
     link_to_log = frappe.utils.get_link_to_form(
         "Error Log", log.name, "See what happened."
@@ -91,31 +291,8 @@ def show_error_alert(action):
 
 
 def update_tracking_info_daily():
-    # Daily scheduled event to update Tracking info for not delivered Shipments
-    # Also Updates the related Delivery Notes
-    shipments = frappe.get_all(
-        "Shipment",
-        filters={
-            "docstatus": 1,
-            "status": "Booked",
-            "shipment_id": ["!=", ""],
-            "tracking_status": ["!=", "Delivered"],
-        },
-    )
-    for shipment in shipments:
-        shipment_doc = frappe.get_doc("Shipment", shipment.name)
-        tracking_info = update_tracking(
-            shipment_doc.service_provider,
-            shipment_doc.shipment_id,
-            shipment_doc.shipment_delivery_notes,
-        )
+    # Daily scheduled event to catch up on the tracking info of Shipments due for a poll,
+    # split in shards refreshed by parallel background jobs
+    from erpnext_shipping.erpnext_shipping.tracking import start_tracking_refresh
 
-        if tracking_info:
-            fields = [
-                "awb_number",
-                "tracking_status",
-                "tracking_status_info",
-                "tracking_url",
-            ]
-            for field in fields:
-                shipment_doc.db_set(field, tracking_info.get(field))
+    start_tracking_refresh()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020, Frappe Technologies and contributors
+# For license information, please see license.txt
+from __future__ import unicode_literals
+import hashlib
+import hmac
+import json
+import re
+from datetime import datetime, timedelta
+
+import frappe
+from frappe import _
+from frappe.utils import get_datetime
+from erpnext_shipping.erpnext_shipping.utils import get_carrier_config
+from erpnext_shipping.erpnext_shipping.doctype.aramex.aramex import ARAMEX_PROVIDER, AramexUtils
+from erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery import (
+    DELHIVERY_PROVIDER,
+    DelhiveryUtils,
+)
+
+EVENT_QUEUE_KEY = "erpnext_shipping_tracking_events"
+EVENT_PROCESSING_KEY = "erpnext_shipping_tracking_events_processing"
+EVENT_SEEN_KEY = "erpnext_shipping_tracking_event"
+# Seconds an event is remembered to drop carrier retries of the same push
+EVENT_DEDUPE_TTL = 7 * 24 * 60 * 60
+EVENT_BATCH_SIZE = 500
+APPLY_LOCK_TIMEOUT = 5 * 60
+# Aramex JSON dates, milliseconds since the epoch in UTC and the zone of the sender
+ARAMEX_DATE_PATTERN = re.compile(r"^/Date\((-?\d+)([+-]\d{4})?\)/$")
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def delhivery():
+    # Status push of Delhivery, one Shipment or a list of Shipments per call
+    authenticate(DELHIVERY_PROVIDER)
+    return queue_events(get_delhivery_events(get_payload()))
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def aramex():
+    # Status push of Aramex, either tracking updates or TrackShipments shaped results
+    authenticate(ARAMEX_PROVIDER)
+    return queue_events(get_aramex_events(get_payload()))
+
+
+def authenticate(carrier):
+    config = get_carrier_config(carrier)
+    expected = config.get("webhook_token")
+    token = frappe.get_request_header("X-Webhook-Token") or frappe.form_dict.get("token")
+    if (
+        not config["enabled"]
+        or not expected
+        or not token
+        or not hmac.compare_digest(token.encode(), expected.encode())
+    ):
+        raise frappe.AuthenticationError(_("Invalid webhook token"))
+
+
+def get_payload():
+    try:
+        return json.loads(frappe.request.get_data(as_text=True) or "null")
+    except ValueError:
+        frappe.throw(_("Webhook payload is not valid JSON"))
+
+
+def get_delhivery_events(payload):
+    events = []
+    for item in payload if isinstance(payload, list) else [payload]:
+        if not isinstance(item, dict):
+            continue
+        shipment = item.get("Shipment")
+        if isinstance(shipment, dict):
+            status = shipment.get("Status") or {}
+            reference = shipment.get("LRN") or shipment.get("lrnum") or shipment.get("AWB")
+            event_time = status.get("StatusDateTime")
+            status = status.get("Status")
+        else:
+            reference = item.get("lrnum") or item.get("lrn") or item.get("awb")
+            event_time = item.get("timestamp") or item.get("status_time")
+            status = item.get("status")
+        events.append(get_event(DELHIVERY_PROVIDER, reference, event_time, status))
+    return events
+
+
+def get_aramex_events(payload):
+    if isinstance(payload, dict):
+        payload = payload.get("TrackingResults") or payload.get("Updates") or [payload]
+
+    events = []
+    for item in payload or []:
+        if not isinstance(item, dict):
+            continue
+        # TrackShipments results wrap the updates of an AWB, newest first
+        updates = item.get("Value") if "Key" in item else [item]
+        for update in (updates or [])[:1]:
+            events.append(
+                get_event(
+                    ARAMEX_PROVIDER,
+                    update.get("WaybillNumber") or item.get("Key"),
+                    update.get("UpdateDateTime"),
+                    update.get("UpdateDescription"),
+                )
+            )
+    return events
+
+
+def get_event(carrier, reference, event_time, status):
+    return {
+        "carrier": carrier,
+        "reference": str(reference or "").strip(),
+        "event_time": str(event_time or ""),
+        "status": str(status or "").strip(),
+    }
+
+
+def queue_events(events):
+    """Queues new events for `apply_tracking_events`, dropping the ones seen before."""
+    redis = frappe.cache()
+    queued = 0
+    for event in events:
+        if not event["reference"] or not event["status"]:
+            continue
+        if not redis.set(get_event_seen_key(event), 1, nx=True, ex=EVENT_DEDUPE_TTL):
+            continue
+        # Oldest events are at the tail, RedisWrapper.lpush prefixes the key with the site
+        redis.lpush(EVENT_QUEUE_KEY, json.dumps(event))
+        queued += 1
+
+    if queued:
+        frappe.enqueue(
+            "erpnext_shipping.erpnext_shipping.webhooks.apply_tracking_events",
+            queue="short",
+        )
+    return {"received": len(events), "queued": queued}
+
+
+def get_event_seen_key(event):
+    signature = hashlib.sha1(
+        "|".join(
+            [event["carrier"], event["reference"], event["event_time"], event["status"]]
+        ).encode()
+    ).hexdigest()
+    return frappe.cache().make_key(f"{EVENT_SEEN_KEY}:{signature}")
+
+
+def apply_tracking_events():
+    # Runs after each push and every minute as a safety net, one runner per site
+    redis = frappe.cache()
+    lock = redis.lock(redis.make_key("apply_tracking_events"), timeout=APPLY_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        while True:
+            events = claim_events(EVENT_BATCH_SIZE)
+            if not events:
+                break
+            try:
+                apply_events(events)
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                apply_events_one_by_one(events)
+            redis.delete(redis.make_key(EVENT_PROCESSING_KEY))
+    finally:
+        lock.release()
+
+
+def claim_events(count):
+    """Moves up to `count` events from the queue to the processing list.
+
+    Events stay in the processing list until they are committed, the ones left
+    there by a runner that died are claimed again first.
+    """
+    redis = frappe.cache()
+    queue = redis.make_key(EVENT_QUEUE_KEY)
+    processing = redis.make_key(EVENT_PROCESSING_KEY)
+
+    # Newest first in the processing list
+    events = redis.pipeline().lrange(processing, 0, -1).execute()[0][::-1]
+    if not events:
+        pipeline = redis.pipeline()
+        for idx in range(count):
+            pipeline.rpoplpush(queue, processing)
+        events = [event for event in pipeline.execute() if event]
+    return [json.loads(event) for event in events]
+
+
+def apply_events_one_by_one(events):
+    # Isolates the events a batch failed on, those that fail alone are logged and
+    # forgotten so a retried push of the carrier is queued again
+    for event in events:
+        try:
+            apply_events([event])
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(
+                title=_("Could not apply {0} tracking event").format(event["carrier"]),
+                message=f"{json.dumps(event, indent=1)}\n\n{frappe.get_traceback()}",
+            )
+            frappe.db.commit()
+            frappe.cache().delete(get_event_seen_key(event))
+
+
+def apply_events(events):
+    from erpnext_shipping.erpnext_shipping.shipping import (
+        set_tracking_info,
+        update_shipment_delivery_notes,
+    )
+
+    references = {event["reference"] for event in events}
+    shipments = {}
+    for shipment in frappe.get_all(
+        "Shipment",
+        filters={"docstatus": 1, "status": "Booked"},
+        or_filters={"shipment_id": ["in", references], "awb_number": ["in", references]},
+        fields=["name", "carrier", "shipment_id", "awb_number", "last_tracking_event_at"],
+    ):
+        for reference in (shipment.shipment_id, shipment.awb_number):
+            if reference:
+                shipments[(shipment.carrier, reference)] = shipment
+
+    # Only the most recent event of a Shipment decides its status, events older than
+    # the last one applied arrived late and are dropped
+    latest = {}
+    for position, event in enumerate(events):
+        shipment = shipments.get((event["carrier"], event["reference"]))
+        if not shipment:
+            continue
+        event_time = get_event_time(event)
+        if shipment.last_tracking_event_at and (
+            not event_time or event_time < get_datetime(shipment.last_tracking_event_at)
+        ):
+            continue
+        order = (event_time or datetime.min, position)
+        if shipment.name not in latest or order > latest[shipment.name][0]:
+            latest[shipment.name] = (order, shipment, event)
+
+    carriers = {}
+    delivery_note_tracking_info = {}
+    for (event_time, position), shipment, event in latest.values():
+        if shipment.carrier not in carriers:
+            # The token of Delhivery is only fetched for requests, mapping needs none
+            carriers[shipment.carrier] = (
+                AramexUtils() if shipment.carrier == ARAMEX_PROVIDER else DelhiveryUtils()
+            )
+        tracking_data = get_tracking_data(carriers[shipment.carrier], shipment, event)
+        previous, changed = set_tracking_info(shipment.name, tracking_data)
+        if event_time != datetime.min:
+            frappe.db.set_value(
+                "Shipment",
+                shipment.name,
+                "last_tracking_event_at",
+                event_time,
+                update_modified=False,
+            )
+        if changed:
+            delivery_note_tracking_info[shipment.name] = dict(
+                tracking_data, awb_number=shipment.awb_number
+            )
+
+    update_shipment_delivery_notes(delivery_note_tracking_info)
+
+
+def get_tracking_data(utils, shipment, event):
+    # Reuse the status mapping of the tracking APIs the payloads mirror
+    if shipment.carrier == ARAMEX_PROVIDER:
+        tracking_data = utils.get_tracking_info(
+            shipment.awb_number, {"Value": [{"UpdateDescription": event["status"]}]}
+        )
+    else:
+        tracking_data = utils.get_tracking_info(
+            shipment.awb_number, {"data": {"status": event["status"]}}
+        )
+    tracking_data["event_time"] = event["event_time"]
+    return tracking_data
+
+
+def get_event_time(event):
+    """Returns the time of the event as a naive datetime, or None if it has none.
+
+    Aramex sends `/Date(1700000000000+0000)/`, whose milliseconds are UTC.
+    """
+    event_time = event["event_time"].strip()
+    if not event_time:
+        return None
+
+    aramex_date = ARAMEX_DATE_PATTERN.match(event_time)
+    if aramex_date:
+        return datetime(1970, 1, 1) + timedelta(milliseconds=int(aramex_date.group(1)))
+
+    try:
+        return get_datetime(event_time).replace(tzinfo=None)
+    except Exception:
+        return None
@@ -36,7 +36,9 @@ app_license = "MIT"
 doctype_js = {
 	"Shipment" : "public/js/shipment.js"
 }
-# doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
+doctype_list_js = {
+	"Shipment" : "public/js/shipment_list.js"
+}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
 
@@ -93,20 +95,40 @@ doctype_js = {
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"Address": {
+		"on_update": "erpnext_shipping.erpnext_shipping.utils.clear_address_cache",
+		"on_trash": "erpnext_shipping.erpnext_shipping.utils.clear_address_cache"
+	},
+	"Contact": {
+		"on_update": "erpnext_shipping.erpnext_shipping.utils.clear_contact_cache",
+		"on_trash": "erpnext_shipping.erpnext_shipping.utils.clear_contact_cache"
+	},
+	"Country": {
+		"on_update": "erpnext_shipping.erpnext_shipping.utils.clear_country_codes_cache",
+		"on_trash": "erpnext_shipping.erpnext_shipping.utils.clear_country_codes_cache"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"erpnext_shipping.erpnext_shipping.doctype.delhivery.delhivery.poll_manifest_jobs",
+			"erpnext_shipping.erpnext_shipping.webhooks.apply_tracking_events",
+			"erpnext_shipping.erpnext_shipping.tracking.poll_due_shipments"
+		],
+		"*/5 * * * *": [
+			"erpnext_shipping.erpnext_shipping.metrics.flush_carrier_metrics"
+		]
+	},
+	"hourly": [
+		"erpnext_shipping.erpnext_shipping.tracking.resume_tracking_refresh"
+	],
 	"daily": [
-		"erpnext_shipping.utils.update_tracking_info_daily"
+		"erpnext_shipping.erpnext_shipping.utils.update_tracking_info_daily"
 	]
 }
 
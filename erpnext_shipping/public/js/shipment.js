@@ -3,11 +3,17 @@
 
 frappe.ui.form.on("Shipment", {
   refresh: function (frm) {
-    if (frm.doc.docstatus === 1 && !frm.doc.shipment_id) {
+    if (frm.doc.docstatus === 1 && !frm.doc.shipment_id && !frm.doc.delhivery_job_id) {
       frm.add_custom_button(__("Select Service"), function () {
         return frm.events.fetch_shipping_services(frm);
       });
     }
+    if (!frm.doc.shipment_id && frm.doc.tracking_status == "MANIFESTING") {
+      frm.dashboard.set_headline_alert(
+        __("Shipment is being manifested with {0}.", [frm.doc.carrier]),
+        "blue"
+      );
+    }
     if (frm.doc.shipment_id) {
       frm.add_custom_button(
         __("Print Shipping Label"),
@@ -16,6 +22,13 @@ frappe.ui.form.on("Shipment", {
         },
         __("Tools")
       );
+      frm.add_custom_button(
+        __("Refresh Shipping Label"),
+        function () {
+          return frm.events.print_shipping_label(frm, true);
+        },
+        __("Tools")
+      );
       if (frm.doc.tracking_status != "DELIVERED") {
         frm.add_custom_button(
           __("Update Tracking"),
@@ -62,6 +75,8 @@ frappe.ui.form.on("Shipment", {
         args: {
           pickup_address_name: frm.doc.pickup_address_name,
           delivery_address_name: frm.doc.delivery_address_name,
+          shipment_parcel: frm.doc.shipment_parcel,
+          pickup_date: frm.doc.pickup_date,
         },
         callback: function (r) {
           if (r.message && r.message.length) {
@@ -79,14 +94,16 @@ frappe.ui.form.on("Shipment", {
     }
   },
 
-  print_shipping_label: function (frm) {
+  print_shipping_label: function (frm, refresh) {
     frappe.call({
       method: "erpnext_shipping.erpnext_shipping.shipping.print_shipping_label",
       freeze: true,
       freeze_message: __("Printing Shipping Label"),
       args: {
+        shipment: frm.doc.name,
         awb_number: frm.doc.awb_number,
         carrier: frm.doc.carrier,
+        refresh: refresh ? 1 : 0,
       },
       callback: function (r) {
         if (r.message) {
@@ -97,15 +114,6 @@ frappe.ui.form.on("Shipment", {
             const file = new Blob([array], { type: "application/pdf" });
             const file_url = URL.createObjectURL(file);
             window.open(file_url);
-          } else if (frm.doc.carrier == "Delhivery") {
-            r.message.forEach(async (url) => {
-              let response = await fetch(url);
-              let data = await response.text();
-              let downloadLink = document.createElement("a");
-              downloadLink.href = data;
-              downloadLink.download = frm.doc.awb_number;
-              downloadLink.click();
-            });
           } else {
             if (Array.isArray(r.message)) {
               r.message.forEach((url) => window.open(url));
@@ -180,7 +188,7 @@ frappe.ui.form.on("Shipment", {
 });
 
 function select_from_available_services(frm, available_services) {
-  var headers = [__("Carrier"), ""];
+  var headers = [__("Carrier"), __("Price"), ""];
 
   frm.render_available_services = function (
     dialog,
@@ -345,6 +353,17 @@ function select_from_available_services(frm, available_services) {
         callback: function (r) {
           if (!r.exc) {
             frm.reload_doc();
+            if (r.message.job_id) {
+              frappe.msgprint({
+                message: __(
+                  "Shipment has been booked with {0}. The LR Number will be updated once it is manifested.",
+                  [r.message.carrier]
+                ),
+                title: __("Shipment Booked"),
+                indicator: "blue",
+              });
+              return;
+            }
             frappe.msgprint({
               message: __("Shipment {1} has been created with {0}.", [
                 r.message.carrier,
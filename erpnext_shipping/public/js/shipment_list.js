@@ -0,0 +1,90 @@
+// Copyright (c) 2020, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings["Shipment"] = frappe.listview_settings["Shipment"] || {};
+
+(function (settings) {
+  const onload = settings.onload;
+
+  settings.onload = function (listview) {
+    if (onload) onload(listview);
+
+    listview.page.add_actions_menu_item(__("Update Tracking"), function () {
+      const shipments = listview.get_checked_items(true);
+      if (!shipments.length) {
+        frappe.throw(__("Please select at least one Shipment"));
+      }
+      frappe.call({
+        method: "erpnext_shipping.erpnext_shipping.shipping.update_tracking_bulk",
+        args: {
+          shipments: shipments,
+        },
+        callback: function (r) {
+          if (r.exc) return;
+          if (r.message) {
+            frappe.show_alert({
+              message: __("Tracking update of {0} Shipments queued, refresh the list in a while", [
+                r.message,
+              ]),
+              indicator: "blue",
+            });
+          } else {
+            frappe.show_alert({
+              message: __("None of the selected Shipments has been booked yet"),
+              indicator: "orange",
+            });
+          }
+        },
+      });
+    });
+
+    listview.page.add_actions_menu_item(__("Print Shipping Labels"), function () {
+      const shipments = listview.get_checked_items(true);
+      if (!shipments.length) {
+        frappe.throw(__("Please select at least one Shipment"));
+      }
+      open_url_post(
+        "/api/method/erpnext_shipping.erpnext_shipping.shipping.print_shipping_labels",
+        { shipments: JSON.stringify(shipments) },
+        true
+      );
+    });
+
+    listview.page.add_actions_menu_item(__("Book with Aramex"), function () {
+      const shipments = listview.get_checked_items(true);
+      if (!shipments.length) {
+        frappe.throw(__("Please select at least one Shipment"));
+      }
+      frappe.call({
+        method: "erpnext_shipping.erpnext_shipping.shipping.create_shipments_bulk",
+        freeze: true,
+        freeze_message: __("Creating Shipments"),
+        args: {
+          shipments: shipments,
+        },
+        callback: function (r) {
+          if (r.exc) return;
+          const failed = r.message.filter((result) => result.error);
+          if (failed.length) {
+            frappe.msgprint({
+              message: failed
+                .map((result) => `${result.shipment}: ${result.error}`)
+                .join("<br>"),
+              title: __("{0} of {1} Shipments could not be booked", [
+                failed.length,
+                r.message.length,
+              ]),
+              indicator: "orange",
+            });
+          } else {
+            frappe.show_alert({
+              message: __("{0} Shipments booked", [r.message.length]),
+              indicator: "green",
+            });
+          }
+          listview.refresh();
+        },
+      });
+    });
+  };
+})(frappe.listview_settings["Shipment"]);